@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# Times grafana_updater.rewrite() on dashboards with thousands of panels
+# against the four recursive passes it replaced, one per rule.
+#
+#   python bench/grafana_rewrite.py --panels 1000 5000 20000
+
+import argparse
+import copy
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from safecast_deploy import grafana_updater  # noqa: E402
+
+TITLES = ['prd web CPU', 'prd web network', 'Worker CPU', 'Worker Network', 'Queue depth', 'Latency']
+
+
+# The rules GrafanaUpdater derives from the production environments.
+def rules():
+    return [
+        grafana_updater.Rule('LoadBalancerName', 'awseb-lb'),
+        grafana_updater.Rule('AutoScalingGroupName', 'awseb-web-asg', r'.*(web CPU|web network)'),
+        grafana_updater.Rule('AutoScalingGroupName', 'awseb-wrk-asg', r'(Worker CPU|Worker Network)'),
+        grafana_updater.Rule('QueueName', 'awseb-queue'),
+    ]
+
+
+# A dashboard laid out like ours: rows of panels, each with a few CloudWatch
+# targets, every one of them pointing at resources that have since been
+# replaced.
+def dashboard(panel_count, panels_per_row=10):
+    panels = []
+    for n in range(panel_count):
+        panels.append({
+            'title': TITLES[n % len(TITLES)],
+            'type': 'graph',
+            'targets': [
+                {
+                    'namespace': 'AWS/EC2',
+                    'metricName': 'CPUUtilization',
+                    'dimensions': {'AutoScalingGroupName': 'old-asg', 'LoadBalancerName': 'old-lb', 'QueueName': 'old-queue'},
+                }
+                for _ in range(3)
+            ],
+            'fieldConfig': {'defaults': {'unit': 'percent', 'thresholds': {'steps': [{'value': None}, {'value': 80}]}}},
+        })
+    rows = [
+        {'title': f'Row {n}', 'type': 'row', 'panels': panels[n:n + panels_per_row]}
+        for n in range(0, panel_count, panels_per_row)
+    ]
+    return {'title': 'api', 'panels': rows}
+
+
+# The implementation rewrite() replaced: a full recursive walk per rule.
+def four_pass_rewrite(dashboard, rules):
+    for rule in rules:
+        _update_key(dashboard, rule.key, rule.value, rule.title_pattern)
+
+
+def _update_key(obj, key, value, parent_title_pattern=None, in_panel=False):
+    if parent_title_pattern is None:
+        in_panel = True
+    if isinstance(obj, list):
+        for item in obj:
+            _update_key(item, key, value, parent_title_pattern, in_panel)
+    elif isinstance(obj, dict):
+        if parent_title_pattern is not None and 'title' in obj:
+            in_panel = bool(parent_title_pattern.match(obj['title']))
+        for curr_key in obj:
+            if in_panel and curr_key == key:
+                obj[curr_key] = value
+            else:
+                _update_key(obj[curr_key], key, value, parent_title_pattern, in_panel)
+
+
+def timed(function, board, repeat):
+    times = []
+    for _ in range(repeat):
+        board_copy = copy.deepcopy(board)
+        start = time.perf_counter()
+        function(board_copy, rules())
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--panels', type=int, nargs='+', default=[1000, 5000, 20000],
+                   help="Numbers of panels to benchmark.",)
+    p.add_argument('--repeat', type=int, default=5,
+                   help="How many times to time each rewrite; the median is reported.",)
+    args = p.parse_args()
+    print(f"{'panels':>8} {'four passes':>12} {'one pass':>10} {'unchanged':>10}")
+    for panel_count in args.panels:
+        board = dashboard(panel_count)
+        rewritten = copy.deepcopy(board)
+        grafana_updater.rewrite(rewritten, rules())
+        print(f"{panel_count:>8} {timed(four_pass_rewrite, board, args.repeat):>11.3f}s "
+              + f"{timed(grafana_updater.rewrite, board, args.repeat):>9.3f}s "
+              + f"{timed(grafana_updater.rewrite, rewritten, args.repeat):>9.3f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# Compares fetching the deployment history the old way, a full clone for
+# every deploy, with the local mirror, a shallow clone once and then an
+# incremental fetch, as the history grows. Runs against local bare
+# repositories over file://, so it needs git but no network.
+#
+#   python bench/history_mirror.py --sizes 100 1000 5000
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from safecast_deploy import git_logger  # noqa: E402
+
+# Roughly how many deploys of one app and env land in a monthly shard.
+ENTRIES_PER_MONTH = 30
+
+
+def entry(number):
+    month = number // ENTRIES_PER_MONTH
+    return {
+        'app': 'api',
+        'env': 'prd',
+        'event': 'same_env',
+        'completed_at': f'{2000 + month // 12}-{month % 12 + 1:02}-01T00:00:00+00:00',
+        'web': {'old_version': f'api-master-{number}', 'new_version': f'api-master-{number + 1}'},
+    }
+
+
+# Appends entries first..last-1 to the bare repository, one commit each,
+# in the sharded layout write_entry() produces.
+def add_commits(bare, first, last):
+    stream = []
+    shard, lines = None, []
+    for number in range(first, last):
+        result = entry(number)
+        path = os.path.relpath(git_logger._shard_path('', result))
+        if path != shard:
+            shard, lines = path, []
+            if first > 0 and number == first:
+                existing = subprocess.run(['git', '-C', bare, 'show', f'master:{path}'],
+                                          capture_output=True, text=True).stdout
+                lines = existing.splitlines(keepends=True)
+        lines.append(json.dumps(result, sort_keys=True) + '\n')
+        data = ''.join(lines).encode()
+        message = f'Entry {number}.'.encode()
+        stream.append(b'commit refs/heads/master\n')
+        stream.append(f'committer bench <bench@example.com> {1000000000 + number} +0000\n'.encode())
+        stream.append(b'data %d\n%s\n' % (len(message), message))
+        if number == first and first > 0:
+            stream.append(b'from refs/heads/master^0\n')
+        stream.append(f'M 100644 inline {path}\n'.encode())
+        stream.append(b'data %d\n%s\n' % (len(data), data))
+    subprocess.run(['git', '-C', bare, 'fast-import', '--quiet'], input=b''.join(stream), check=True)
+
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def measure(work_dir, size, repeat):
+    import git
+    bare = os.path.join(work_dir, f'history-{size}.git')
+    subprocess.run(['git', 'init', '--quiet', '--bare', '--initial-branch=master', bare], check=True)
+    add_commits(bare, 0, size)
+    url = 'file://' + bare
+
+    clones = []
+    for attempt in range(repeat):
+        path = os.path.join(work_dir, f'clone-{size}-{attempt}')
+        clones.append(timed(lambda: git.Repo.clone_from(url, path)))
+
+    mirror = os.path.join(work_dir, f'mirror-{size}')
+    first_use = timed(lambda: git_logger.open_mirror(url, mirror))
+    updates = []
+    for attempt in range(repeat):
+        # Another machine deploys between two uses of the mirror.
+        add_commits(bare, size + attempt, size + attempt + 1)
+        updates.append(timed(lambda: git_logger.open_mirror(url, mirror)))
+    return statistics.median(clones), first_use, statistics.median(updates)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000],
+                   help="Numbers of history entries to benchmark.",)
+    p.add_argument('--repeat', type=int, default=3,
+                   help="How many times to time each operation; the median is reported.",)
+    args = p.parse_args()
+    print(f"{'entries':>8} {'full clone':>11} {'mirror, first use':>18} {'mirror, update':>15}")
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size in args.sizes:
+            clone, first_use, update = measure(work_dir, size, args.repeat)
+            print(f"{size:>8} {clone:>10.3f}s {first_use:>17.3f}s {update:>14.3f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Times how long each deploy.py command takes to get ready to run, in a
+# fresh interpreter: building the argument parser, then importing the
+# modules the command loads when it is dispatched, up to its first AWS
+# call. Also reports each module's own import time.
+#
+#   python bench/startup_times.py --repeat 5
+
+import argparse
+import ast
+import inspect
+import os
+import statistics
+import subprocess
+import sys
+import textwrap
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import deploy  # noqa: E402
+
+# Heavy dependencies, to compare the commands' times with.
+DEPENDENCIES = ['boto3', 'git']
+
+STARTUP = '''
+import time
+start = time.perf_counter()
+import deploy
+deploy.build_parser()
+{imports}
+print(time.perf_counter() - start)
+'''
+
+
+# The modules a command imports when it runs: the one lazy_cli() loads, or
+# those the command's function in deploy.py imports.
+def command_modules(func):
+    if hasattr(func, 'module_name'):
+        return [func.module_name]
+    tree = ast.parse(textwrap.dedent(inspect.getsource(func)))
+    return [alias.name for node in ast.walk(tree) if isinstance(node, ast.Import) for alias in node.names]
+
+
+def median_startup(modules, repeat):
+    code = STARTUP.format(imports='\n'.join(f'import {module}' for module in modules))
+    durations = []
+    for _ in range(repeat):
+        res = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+        durations.append(float(res.stdout) * 1000)
+    return statistics.median(durations)
+
+
+# The cumulative time `python -X importtime` reports for the module in a
+# fresh interpreter, in which nothing else has been imported yet.
+def import_time(module):
+    res = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    for line in res.stderr.splitlines():
+        fields = [field.strip() for field in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1000
+    return float('nan')
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('-r', '--repeat', type=int, default=5,
+                   help="How many times to start each command; the median is reported.",)
+    args = p.parse_args()
+    _, commands = deploy.build_parser()
+    modules = {name: command_modules(parser.get_default('func')) for name, parser in sorted(commands.choices.items())}
+    print('{:<20} {:>12}  {}'.format('command', 'startup (ms)', 'modules'))
+    print('{:<20} {:>12.0f}'.format('(parser only)', median_startup([], args.repeat)))
+    for name, command_modules_ in modules.items():
+        print('{:<20} {:>12.0f}  {}'.format(name, median_startup(command_modules_, args.repeat), ', '.join(command_modules_)))
+    print()
+    print('{:<32} {:>12}'.format('module', 'import (ms)'))
+    for module in DEPENDENCIES + sorted({module for command_modules_ in modules.values() for module in command_modules_}):
+        print('{:<32} {:>12.0f}'.format(module, import_time(module)))
+
+
+if __name__ == '__main__':
+    main()
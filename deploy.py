@@ -9,22 +9,32 @@ if sys.version_info.major < 3 or sys.version_info.minor < 7:
     exit(1)
 
 import argparse
-import boto3
+import datetime
+import importlib
 import pprint
 import re
 import safecast_deploy
-import safecast_deploy.config_saver
-import safecast_deploy.grafana_updater
-import safecast_deploy.new_env
-import safecast_deploy.same_env
-import safecast_deploy.ssh
-import safecast_deploy.state
+import safecast_deploy.cache
+import safecast_deploy.timing
 import time
 
 
-def parse_args():
+# Returns the parser and the subparsers of its commands.
+def build_parser():
     p = argparse.ArgumentParser()
-    ps = p.add_subparsers()
+    p.add_argument('--aws-stats', action='store_true',
+                   help="Print the count, retries, throttles and latency of each AWS operation on stderr at the end.",)
+    p.add_argument('--metrics-textfile',
+                   help="Write the command's duration, phase timings and outcome to this file for Prometheus' textfile collector.",)
+    p.add_argument('--no-cache', action='store_true',
+                   help="Neither read nor write the local cache of Elastic Beanstalk responses.",)
+    p.add_argument('--refresh', action='store_true',
+                   help="Ignore cached Elastic Beanstalk responses, but store the fresh ones.",)
+    p.add_argument('--statsd', type=parse_address, metavar='HOST:PORT',
+                   help="Send the command's duration, phase timings and outcome to this StatsD server over UDP.",)
+    p.add_argument('--trace-file',
+                   help="Write the command's phase timings to this file in the Chrome trace event format.",)
+    ps = p.add_subparsers(dest='subcommand')
 
     list_arns_p = ps.add_parser('list_arns', help="List all currently recommended Ruby ARNS.")
     list_arns_p.set_defaults(func=run_list_arns)
@@ -45,6 +55,55 @@ def parse_args():
     desc_template_p.add_argument('template', help="The template's name.",)
     desc_template_p.set_defaults(func=run_desc_template)
 
+    exec_p = ps.add_parser('exec', help='Run a command over SSH on every instance of the selected environment.')
+    exec_p.add_argument('app',
+                        choices=apps,
+                        help="The target application.",)
+    exec_p.add_argument('env',
+                        choices=['dev', 'prd', ],
+                        help="The target environment.",)
+    exec_p.add_argument('role',
+                        choices=['web', 'wrk', ],
+                        help="The type of server.",)
+    exec_p.add_argument('command', nargs='+',
+                        help="The command to run. Put -- before it if it has options of its own.",)
+    exec_p.add_argument('-p', '--max-parallel', type=int, default=10,
+                        help="The maximum number of instances to run the command on at once.",)
+    exec_p.set_defaults(func=run_exec)
+
+    flush_history_p = ps.add_parser(
+        'flush_history',
+        help="Push any spooled deployment-history entries now, rather than waiting for the background flusher.")
+    flush_history_p.set_defaults(func=lazy_cli('git_logger', 'run_flush_cli'))
+
+    gc_versions_p = ps.add_parser(
+        'gc_versions', help="Delete old application versions that no retention rule keeps.")
+    gc_versions_p.add_argument('-a', '--app',
+                               choices=apps,
+                               help="Limit the cleanup to a specific application.")
+    gc_versions_p.add_argument('-k', '--keep', type=parse_non_negative, default=10,
+                               help="Keep this many of the newest versions of each branch.",)
+    gc_versions_p.add_argument('--keep-days', type=parse_non_negative, default=30,
+                               help="Keep every version updated within this many days.",)
+    gc_versions_p.add_argument('--deployed-days', type=parse_non_negative, default=90,
+                               help="Keep every version deployed to, or replaced in, an environment within this many days, "
+                               + "according to the deployment history. Versions running now are always kept.",)
+    gc_versions_p.add_argument('--dry-run', action='store_true',
+                               help="List the versions that would be deleted, without deleting them.",)
+    gc_versions_p.add_argument('--ignore-history', action='store_true',
+                               help="Delete versions even if the deployment history cannot be read, "
+                               + "which leaves only the versions running now protected as deployed.",)
+    gc_versions_p.add_argument('-p', '--max-parallel', type=int, default=4,
+                               help="The maximum number of deletions to run at once.",)
+    gc_versions_p.add_argument('--rate', type=float, default=5,
+                               help="The maximum number of deletions to start per second.",)
+    gc_versions_p.set_defaults(func=lazy_cli('version_gc'), refresh_cache=True)
+
+    migrate_history_p = ps.add_parser(
+        'migrate_history',
+        help="Convert deployment-history files from the old JSON array format to monthly JSON Lines shards.")
+    migrate_history_p.set_defaults(func=lazy_cli('git_logger', 'run_migrate_cli'))
+
     new_env_p = ps.add_parser('new_env', help="Create and switch to a completely new environment.")
     new_env_p.add_argument('app',
                            choices=apps,
@@ -58,7 +117,36 @@ def parse_args():
         '--no-update-templates', action='store_true',
         help="If this flag is set, the script will not update the Elastic Beanstalk environment templates "
         + "from the currently running environments before beginning the deployment.",)
-    new_env_p.set_defaults(func=run_new_env)
+    new_env_p.add_argument(
+        '--parallel-web', action='store_true',
+        help="Create the new web environment while the worker is being replaced. "
+        + "The CNAME swap still waits for the new worker to be healthy, and either failing stops the other.",)
+    new_env_p.add_argument(
+        '--drain-timeout', type=int, default=900,
+        help="The maximum number of seconds to wait for the old worker's instances to terminate.",)
+    new_env_p.add_argument(
+        '--dry-run', action='store_true',
+        help="Print the steps the deployment would take and how long they are expected to take, without changing anything.",)
+    new_env_p.set_defaults(func=run_new_env, refresh_cache=True)
+
+    release_p = ps.add_parser('release', help="Deploy new versions of several applications to an environment concurrently.")
+    release_p.add_argument('env',
+                           choices=environments,
+                           help="The target environment to deploy to.",)
+    for app in apps:
+        release_p.add_argument(f'--{app}', metavar='VERSION', help=f"The new {app} version to deploy.",)
+    release_p.add_argument('--arn',
+                           help="Create new environments using this ARN, as new_env does. "
+                           + "Otherwise the existing environments are updated in place, as same_env does.",)
+    release_p.add_argument('--max-parallel', type=int, default=3,
+                           help="The maximum number of applications to deploy at once.",)
+    release_p.add_argument('--no-update-templates', action='store_true',
+                           help="With --arn, do not update the environment templates before creating environments.",)
+    release_p.add_argument('--parallel-web', action='store_true',
+                           help="With --arn, create each new web environment while its worker is being replaced.",)
+    release_p.add_argument('--drain-timeout', type=int, default=900,
+                           help="With --arn, the maximum number of seconds to wait for each old worker to drain.",)
+    release_p.set_defaults(func=lazy_cli('release'), refresh_cache=True)
 
     same_env_p = ps.add_parser('same_env', help='Deploy a new version of the app to the existing environment.')
     same_env_p.add_argument('app',
@@ -68,20 +156,26 @@ def parse_args():
                             choices=environments,
                             help="The target environment to deploy to.",)
     same_env_p.add_argument('version', help="The new version to deploy.")
-    same_env_p.set_defaults(func=run_same_env)
+    same_env_p.add_argument(
+        '--dry-run', action='store_true',
+        help="Print the steps the deployment would take and how long they are expected to take, without changing anything.",)
+    same_env_p.set_defaults(func=run_same_env, refresh_cache=True)
 
     save_configs_p = ps.add_parser('save_configs',
                                    help="Overwrite the saved configuration templates from the current environments.")
     save_configs_p.add_argument('-a', '--app',
                                 choices=apps,
-                                help="Limit the overwrite to a specific application.")
+                                help="Limit the overwrite to a specific application. Defaults to api and ingest.")
     save_configs_p.add_argument('-e', '--env',
                                 choices=environments,
                                 help="Limit the overwrite to a specific environment.")
     save_configs_p.add_argument('-r', '--role',
                                 choices=['web', 'wrk'],
-                                help="Limit the overwrite to a specific role.")
-    save_configs_p.set_defaults(func=safecast_deploy.config_saver.run_cli)
+                                help="Limit the overwrite to a specific role. Defaults to web; "
+                                + "worker templates are only overwritten with --role wrk.")
+    save_configs_p.add_argument('--force', action='store_true',
+                                help="Rewrite templates even if they already match their running environment.")
+    save_configs_p.set_defaults(func=lazy_cli('config_saver'), refresh_cache=True)
 
     ssh_p = ps.add_parser('ssh', help='SSH to the selected environment.')
     ssh_p.add_argument('app',
@@ -97,30 +191,115 @@ def parse_args():
                        help="Choose a specific server. Otherwise, will connect to the first server found.",)
     ssh_p.set_defaults(func=run_ssh)
 
+    status_p = ps.add_parser('status', help="Show the version, health and instance count of every environment.")
+    status_p.add_argument('-a', '--app',
+                          choices=apps,
+                          help="Limit the table to a specific application.")
+    status_p.add_argument('-w', '--watch', type=int, nargs='?', const=30, metavar='SECONDS',
+                          help="Keep refreshing the table, every 30 seconds unless given, until interrupted.",)
+    status_p.set_defaults(func=lazy_cli('status'))
+
     update_grafana_p = ps.add_parser('update_grafana', help='Update the Grafana dashboard for the given application to match the running environment.')
     update_grafana_p.add_argument(
         'app',
-        choices=apps,
+        nargs='?',
+        choices=['api', 'ingest'],
         help="The target application.",)
-    update_grafana_p.set_defaults(func=safecast_deploy.grafana_updater.run_cli)
+    update_grafana_p.add_argument(
+        '--all', action='store_true',
+        help="Update the dashboards of every application concurrently.",)
+    update_grafana_p.set_defaults(func=lazy_cli('grafana_updater'))
 
     versions_p = ps.add_parser('versions', help='List the deployable versions for this environment, sorted by age.')
     versions_p.add_argument('app',
                             choices=apps,
                             help="The target application.",)
+    versions_p.add_argument('-b', '--branch',
+                            help="Only list versions built from this (cleaned) branch name.",)
+    versions_p.add_argument('-s', '--since', type=parse_since,
+                            help="Only list versions updated at or after this ISO 8601 date or time.",)
+    versions_p.add_argument('-n', '--limit', type=int,
+                            help="Only list this many of the most recent matching versions.",)
     versions_p.set_defaults(func=run_versions)
 
+    return p, ps
+
+
+def parse_args():
+    p, _ = build_parser()
     args = p.parse_args()
     if 'func' in args:
-        args.func(args)
+        # Commands that change environments always start from fresh metadata.
+        safecast_deploy.cache.configure(
+            enabled=not args.no_cache,
+            refresh=args.refresh or getattr(args, 'refresh_cache', False),
+        )
+        succeeded = False
+        try:
+            args.func(args)
+            succeeded = True
+        except SystemExit as e:
+            succeeded = not e.code
+            raise
+        finally:
+            if args.trace_file is not None:
+                safecast_deploy.timing.recorder.write_chrome_trace(args.trace_file)
+            if args.aws_stats:
+                safecast_deploy.timing.recorder.print_aws_calls(sys.stderr)
+            if args.metrics_textfile is not None or args.statsd is not None:
+                metrics = importlib.import_module('safecast_deploy.metrics')
+                labels = {key: getattr(args, key, None) for key in ('app', 'env', 'role')}
+                labels['command'] = args.subcommand
+                metrics.export(labels, succeeded, textfile=args.metrics_textfile, statsd=args.statsd)
     else:
         p.error("too few arguments")
 
 
+# Subcommand modules, and through them boto3 and GitPython, are only
+# imported once their command runs, which keeps --help and quick commands
+# fast.
+def lazy_cli(module_name, function_name='run_cli'):
+    def run(args):
+        module = importlib.import_module(run.module_name)
+        getattr(module, function_name)(args)
+    run.module_name = 'safecast_deploy.' + module_name
+    return run
+
+
+def parse_since(value):
+    try:
+        since = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("not an ISO 8601 date or time: " + value)
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=datetime.timezone.utc)
+    return since
+
+
+def parse_non_negative(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("not a whole number: " + value)
+    if number < 0:
+        raise argparse.ArgumentTypeError("must not be negative: " + value)
+    return number
+
+
+def parse_address(value):
+    host, _, port = value.rpartition(':')
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError("not a HOST:PORT address: " + value)
+    return (host, int(port))
+
 
 def run_list_arns(args):
-    c = boto3.client('elasticbeanstalk')
-    platforms = c.list_platform_versions(
+    import safecast_deploy.aws
+    c = safecast_deploy.aws.client('elasticbeanstalk')
+    platforms = safecast_deploy.cache.call(
+        c,
+        'list_platform_versions',
+        'platforms',
         Filters=[
             {
                 'Type': 'ProgrammingLanguageName',
@@ -139,12 +318,18 @@ def run_list_arns(args):
 
 
 def run_desc_metadata(args):
+    import safecast_deploy.state
+    start = time.monotonic()
     state = safecast_deploy.state.State(args.app)
-    pprint.PrettyPrinter(stream=sys.stderr).pprint(state.env_metadata)
+    state.prefetch_resources()
+    print("Loaded metadata for {} in {:.2f} seconds.".format(args.app, time.monotonic() - start), file=sys.stderr)
+    pprint.PrettyPrinter(stream=sys.stderr).pprint(
+        {env: record.to_dict() for env, record in state.env_metadata.items()})
 
 
 def run_desc_template(args):
-    c = boto3.client('elasticbeanstalk')
+    import safecast_deploy.aws
+    c = safecast_deploy.aws.client('elasticbeanstalk')
     template = c.describe_configuration_settings(
         ApplicationName=args.app,
         TemplateName=args.template,
@@ -153,39 +338,62 @@ def run_desc_template(args):
 
 
 def run_new_env(args):
+    import safecast_deploy.new_env
+    import safecast_deploy.planner
+    import safecast_deploy.state
     state = safecast_deploy.state.State(
         args.app,
         args.env,
         new_version=args.version,
         new_arn=args.arn
     )
-    safecast_deploy.new_env.NewEnv(state, not args.no_update_templates).run()
+    deployer = safecast_deploy.new_env.NewEnv(state, not args.no_update_templates, args.parallel_web, args.drain_timeout)
+    if args.dry_run:
+        safecast_deploy.planner.Planner(deployer, 'new_env').run()
+    else:
+        deployer.run()
 
 
 def run_same_env(args):
+    import safecast_deploy.planner
+    import safecast_deploy.same_env
+    import safecast_deploy.state
     state = safecast_deploy.state.State(
         args.app,
         args.env,
         new_version=args.version,
     )
-    safecast_deploy.same_env.SameEnv(state).run()
+    deployer = safecast_deploy.same_env.SameEnv(state)
+    if args.dry_run:
+        safecast_deploy.planner.Planner(deployer, 'same_env').run()
+    else:
+        deployer.run()
+
+
+def run_exec(args):
+    import safecast_deploy.ssh
+    import safecast_deploy.state
+    state = safecast_deploy.state.State(args.app, args.env)
+    safecast_deploy.ssh.Exec(state, args).run()
 
 
 def run_ssh(args):
+    import safecast_deploy.ssh
+    import safecast_deploy.state
     state = safecast_deploy.state.State(args.app, args.env)
     safecast_deploy.ssh.Ssh(state, args).run()
 
 
 def run_versions(args):
+    import safecast_deploy.state
     state = safecast_deploy.state.State(args.app)
-    print(*state.available_versions, sep='\n')
+    versions = state.versions.filter(branch=args.branch, since=args.since, limit=args.limit)
+    print(*[v.label for v in versions], sep='\n')
 
 
 def main():
     parse_args()
     # TODO method to switch to maintenance page
-    #
-    # TODO method to clean out old versions
 
 
 if __name__ == '__main__':
@@ -1,9 +1,71 @@
+import concurrent.futures
+import contextvars
 import datetime
 import sys
+import threading
 import time
 
 
+class SystemClock:
+    def monotonic(self):
+        return time.monotonic()
+
+    # Seconds since the epoch, for timestamps kept between runs.
+    def time(self):
+        return time.time()
+
+    def sleep(self, secs):
+        time.sleep(secs)
+
+    # Sleeps until the threading.Event is set or secs have passed, and
+    # returns whether it was set.
+    def wait(self, event, secs):
+        return event.wait(secs)
+
+    # Threads are started through the clock, so that a test clock can keep
+    # track of them and only move time once all of them are waiting on it.
+    # They run in a copy of the starting thread's context variables, such
+    # as the prefix release gives each app's output.
+    def executor(self, max_workers):
+        return ContextThreadPoolExecutor(max_workers=max_workers)
+
+    # Runs function in a daemon thread and returns a Future of its result.
+    def start(self, function, name):
+        future = concurrent.futures.Future()
+        context = contextvars.copy_context()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                result = context.run(function)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        threading.Thread(target=run, name=name, daemon=True).start()
+        return future
+
+
+class ContextThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+_clock = SystemClock()
+
+
+def get_clock():
+    return _clock
+
+
+def set_clock(clock):
+    global _clock
+    _clock = clock
+
+
 def verbose_sleep(secs):
     end_time = (datetime.datetime.now() + datetime.timedelta(seconds=secs)).isoformat()
     print("Sleeping for " + str(secs) + " seconds until " + end_time, file=sys.stderr)
-    time.sleep(secs)
+    _clock.sleep(secs)
@@ -0,0 +1,158 @@
+import random
+import sys
+import threading
+import time
+
+from safecast_deploy import get_clock, timing
+
+THROTTLING_CODES = {'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException'}
+TRANSIENT_CODES = {'InternalFailure', 'InternalError', 'RequestTimeout', 'ServiceUnavailable'}
+TRANSIENT_STATUSES = {500, 502, 503, 504}
+MAX_ATTEMPTS = 8
+# Retries wait a random time of up to BACKOFF_BASE * 2 ** retry seconds,
+# capped at BACKOFF_CAP.
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 20
+# Calls per second and burst size allowed per service before any throttling.
+RATE = 10
+BURST = 20
+
+_client_factory = None
+_session = None
+_clients = {}
+_lock = threading.Lock()
+
+
+# Every AWS client is created here so that all calls share the rate limit,
+# are retried and counted, and so the tests can substitute their fake
+# backend. Clients are shared by the whole process: credentials are only
+# resolved once, and callers in different threads get the same client,
+# which boto3 allows, rather than creating their own, which it does not.
+def client(service_name):
+    with _lock:
+        if service_name not in _clients:
+            factory = _session_client if _client_factory is None else _client_factory
+            _clients[service_name] = Client(factory(service_name), TokenBucket(RATE, BURST))
+        return _clients[service_name]
+
+
+def session():
+    global _session
+    if _session is None:
+        # boto3 takes a noticeable share of startup time, so commands that
+        # never reach AWS do not import it.
+        import boto3
+        _session = boto3.session.Session()
+    return _session
+
+
+def _session_client(service_name):
+    from botocore.config import Config
+    # Retries happen in Client, which also slows every caller down when
+    # AWS starts throttling.
+    return session().client(service_name, config=Config(retries={'mode': 'standard', 'total_max_attempts': 1}))
+
+
+def set_client_factory(factory):
+    global _client_factory
+    with _lock:
+        _client_factory = factory
+        _clients.clear()
+
+
+# A token bucket shared by every caller of one service. Throttling halves
+# its rate, and each successful call wins a little of it back.
+class TokenBucket:
+    def __init__(self, rate, burst, min_rate=0.5):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self._tokens = burst
+        self._updated = None
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        clock = get_clock()
+        with self._lock:
+            now = clock.monotonic()
+            if self._updated is not None:
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Taking a token into debt reserves the caller's place in line.
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay:
+            clock.sleep(delay)
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+
+# Wraps a boto3 client. Each API call waits for the service's token
+# bucket, is retried with jittered exponential backoff when AWS throttles
+# it or fails transiently, and is counted and timed, retries included.
+class Client:
+    def __init__(self, client, bucket):
+        self._client = client
+        self._bucket = bucket
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr) or name.startswith('_') or name in ('get_paginator', 'get_waiter', 'can_paginate'):
+            return attr
+
+        def call(*args, **kwargs):
+            return self._call(name, attr, args, kwargs)
+        return call
+
+    def _call(self, operation, method, args, kwargs):
+        clock = get_clock()
+        start = time.perf_counter()
+        retries = 0
+        throttles = 0
+        try:
+            while True:
+                self._bucket.acquire()
+                try:
+                    response = method(*args, **kwargs)
+                except Exception as e:
+                    reason = _retry_reason(e)
+                    if reason is None or retries + 1 >= MAX_ATTEMPTS:
+                        raise
+                    if reason == 'throttled':
+                        throttles += 1
+                        self._bucket.throttled()
+                    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** retries))
+                    retries += 1
+                    print(f"WARN: {operation} was {reason}, retrying in {delay:.1f} seconds "
+                          + f"(attempt {retries + 1} of {MAX_ATTEMPTS}).", file=sys.stderr)
+                    clock.sleep(delay)
+                    continue
+                self._bucket.succeeded()
+                return response
+        finally:
+            timing.recorder.record_call(operation, time.perf_counter() - start, retries, throttles)
+
+
+# Returns 'throttled' or 'transient' for errors worth retrying, or None.
+def _retry_reason(error):
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        if response.get('Error', {}).get('Code') in THROTTLING_CODES:
+            return 'throttled'
+        if (response.get('Error', {}).get('Code') in TRANSIENT_CODES
+                or response.get('ResponseMetadata', {}).get('HTTPStatusCode') in TRANSIENT_STATUSES):
+            return 'transient'
+        return None
+    botocore_exceptions = sys.modules.get('botocore.exceptions')
+    if botocore_exceptions is not None and isinstance(
+            error, (botocore_exceptions.ConnectionError, botocore_exceptions.HTTPClientError)):
+        return 'transient'
+    return None
@@ -0,0 +1,97 @@
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from safecast_deploy import get_clock
+
+# Seconds a cached response stays valid, per operation.
+TTLS = {
+    'describe_application_versions': 300,
+    'describe_environment_resources': 60,
+    'describe_environments': 60,
+    'describe_instances': 300,
+    'list_platform_versions': 6 * 60 * 60,
+}
+
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'safecast_deploy')
+
+
+def _encode(obj):
+    if isinstance(obj, datetime.datetime):
+        return {'__datetime__': obj.isoformat()}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _decode(obj):
+    if '__datetime__' in obj:
+        return datetime.datetime.fromisoformat(obj['__datetime__'])
+    return obj
+
+
+class ResponseCache:
+    def __init__(self, directory, enabled=True, refresh=False):
+        self.directory = directory
+        self.enabled = enabled
+        self.refresh = refresh
+
+    def call(self, client, operation, scope, **kwargs):
+        path = self._path(scope, operation, kwargs)
+        if self.enabled and not self.refresh:
+            response = self._read(path, TTLS[operation])
+            if response is not None:
+                return response
+        response = getattr(client, operation)(**kwargs)
+        response.pop('ResponseMetadata', None)
+        if self.enabled:
+            self._write(path, response)
+        return response
+
+    def invalidate(self, scope):
+        shutil.rmtree(os.path.join(self.directory, 'responses', scope), ignore_errors=True)
+
+    def _path(self, scope, operation, kwargs):
+        key = hashlib.sha256(json.dumps(kwargs, sort_keys=True, default=_encode).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, 'responses', scope, f'{operation}-{key[:16]}.json')
+
+    def _read(self, path, ttl):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f, object_hook=_decode)
+        except (OSError, ValueError):
+            return None
+        if get_clock().time() - entry['stored_at'] > ttl:
+            return None
+        return entry['response']
+
+    def _write(self, path, response):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'stored_at': get_clock().time(), 'response': response}, f, default=_encode)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"WARN: could not write to the response cache: {e}", file=sys.stderr)
+
+
+_cache = ResponseCache(cache_dir())
+
+
+def configure(enabled=True, refresh=False):
+    _cache.enabled = enabled
+    _cache.refresh = refresh
+
+
+def call(client, operation, scope, **kwargs):
+    return _cache.call(client, operation, scope, **kwargs)
+
+
+def invalidate(scope):
+    _cache.invalidate(scope)
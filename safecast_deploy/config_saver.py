@@ -1,80 +1,145 @@
 import datetime
 import pprint
 import sys
+import time
 
-from safecast_deploy import git_logger, state, verbose_sleep
+from safecast_deploy import aws, cache, get_clock, git_logger, state, timing
+
+TEMPLATE_DELETE_TIMEOUT = 60
+# The apps whose templates are saved when no app is given. reporting's
+# templates are only rewritten when it is asked for explicitly.
+DEFAULT_APPS = ['api', 'ingest']
 
 
 def run_cli(args):
-    ConfigSaver(app=args.app, env=args.env, role=args.role).run()
+    ConfigSaver(app=args.app, env=args.env, role=args.role, force=args.force).run()
 
 
+# Saves the configuration of the running environments to the templates new
+# environments are created from. Templates that already match their
+# environment are left alone, so this is cheap to run often.
 class ConfigSaver:
-    def __init__(self, app=None, env=None, role=None):
+    def __init__(self, app=None, env=None, role=None, eb_client=None, force=False):
         self.app = app
         self.env = env
         self.role = role
-        self.states = {}
-        if app is None:
-            self.states['api'] = state.State('api')
-            self.states['ingest'] = state.State('ingest')
-            self.states['reporting'] = state.State('reporting')
-            self._c = self.states['api'].eb_client
-        else:
-            self.states[app] = state.State(app)
-            self._c = self.states[app].eb_client
+        self.force = force
+        start = time.monotonic()
+        apps = DEFAULT_APPS if app is None else [app]
+        self._c = aws.client('elasticbeanstalk') if eb_client is None else eb_client
+        with timing.span('load_metadata'), \
+                get_clock().executor(len(apps)) as executor:
+            self.states = dict(zip(apps, executor.map(self._load_state, apps)))
+        print("Loaded metadata for {} in {:.2f} seconds.".format(', '.join(apps), time.monotonic() - start),
+              file=sys.stderr)
         self.completed_list = []
 
+    def _load_state(self, app):
+        app_state = state.State(app, eb_client=self._c)
+        # Touch the lazily loaded metadata so discovery happens in the pool.
+        app_state.env_metadata
+        return app_state
+
     def run(self):
-        for app in self.states:
-            env_metadata = self.states[app].env_metadata
-            if self.app is None:
-                self.process_app('api')
-                self.process_app('ingest')
-            else:
-                self.process_app(app)
-        git_logger.log_result(self.completed_list)
+        with timing.span('save_configs') as save_span:
+            targets = self._targets()
+            with timing.span('compare'), \
+                    get_clock().executor(state.MAX_WORKERS) as executor:
+                saved = dict(zip(self.states, executor.map(self._saved_templates, self.states)))
+                changes = list(executor.map(lambda target: self._changes(target, saved[target[0]]), targets))
+            stale = []
+            for target, target_changes in zip(targets, changes):
+                app, env, role, template_name = target
+                if target_changes:
+                    stale.append((target, target_changes))
+                else:
+                    print(f"Template {app}/{template_name} matches "
+                          + f"{self.states[app].env_metadata[template_name].name}, leaving it unchanged.",
+                          file=sys.stderr)
+            with get_clock().executor(state.MAX_WORKERS) as executor:
+                list(executor.map(lambda args: self.process_role(*args, save_span), stale))
+        self.completed_list.sort(key=lambda entry: (entry['app'], entry['env'], entry['role']))
+        if self.completed_list:
+            git_logger.log_result(self.completed_list)
         pprint.PrettyPrinter(stream=sys.stderr).pprint(self.completed_list)
 
-    def process_app(self, app):
-        if self.env is None:
-            self.process_env(app, 'dev')
-            self.process_env(app, 'prd')
-        else:
-            self.process_env(app, self.env)
+    # Every (app, env, role, template name) selected by the arguments.
+    # Worker templates are only rewritten when the wrk role is asked for,
+    # as they always have been.
+    def _targets(self):
+        targets = []
+        for app, app_state in self.states.items():
+            for env in (['dev', 'prd'] if self.env is None else [self.env]):
+                for role in (['web'] if self.role is None else [self.role]):
+                    template_name = env if role == 'web' else f'{env}-wrk'
+                    if template_name not in app_state.env_metadata:
+                        print(f"WARN: No running {role} environment for {app} {env}, skipping template {template_name}.",
+                              file=sys.stderr)
+                        continue
+                    targets.append((app, env, role, template_name))
+        return targets
+
+    def _saved_templates(self, app):
+        res = self._c.describe_applications(ApplicationNames=[app])
+        return set(res['Applications'][0].get('ConfigurationTemplates', []))
 
-    def process_env(self, app, env):
-        template_names = {
-            'web': env,
-            'wrk': '{}-wrk'.format(env),
+    # Describes how the saved template differs from its running
+    # environment; an empty list means the template is up to date.
+    def _changes(self, target, saved_templates):
+        app, env, role, template_name = target
+        if template_name not in saved_templates:
+            return ['template does not exist']
+        env_name = self.states[app].env_metadata[template_name].name
+        running = self._settings(ApplicationName=app, EnvironmentName=env_name)
+        saved = self._settings(ApplicationName=app, TemplateName=template_name)
+        changes = []
+        if running['platform'] != saved['platform']:
+            changes.append(f"platform: {saved['platform']} -> {running['platform']}")
+        for key in sorted(running['options'].keys() | saved['options'].keys(), key=lambda k: tuple(map(str, k))):
+            if running['options'].get(key) != saved['options'].get(key):
+                changes.append("{} {}: {!r} -> {!r}".format(
+                    key[0], key[2], saved['options'].get(key), running['options'].get(key)))
+        if self.force and not changes:
+            changes.append('rewrite forced')
+        return changes
+
+    def _settings(self, **kwargs):
+        settings = self._c.describe_configuration_settings(**kwargs)['ConfigurationSettings'][0]
+        return {
+            'platform': settings.get('PlatformArn', settings.get('SolutionStackName')),
+            'options': {
+                (option['Namespace'], option.get('ResourceName'), option['OptionName']): option.get('Value')
+                for option in settings.get('OptionSettings', [])
+            },
         }
-        if self.role is None:
-            self.process_role(app, env, 'web', template_names)
-            if self.states[app].has_worker:
-                self.process_role(app, env, 'wrk', template_names)
-        else:
-            self.process_role(app, env, self.role, template_names)
 
-    def process_role(self, app, env, role, template_names):
+    def process_role(self, target, changes, parent_span=None):
+        app, env, role, template_name = target
         start_time = datetime.datetime.now(datetime.timezone.utc)
-        template_name = template_names[role]
-        env_id = self.states[app].env_metadata[template_name]['api_env']['EnvironmentId']
-        env_name = self.states[app].env_metadata[template_name]['name']
-        print(f"Starting update of template {template_name} from {env_name}", file=sys.stderr)
-        self._c.delete_configuration_template(
-            ApplicationName=app,
-            TemplateName=template_name,
-        )
-        verbose_sleep(5)
-        self._c.create_configuration_template(
-            ApplicationName=app,
-            TemplateName=template_name,
-            EnvironmentId=env_id,
-        )
-        print(f"Completed update of template {template_name} from {env_name}", file=sys.stderr)
+        env_id = self.states[app].env_metadata[template_name].env_id
+        env_name = self.states[app].env_metadata[template_name].name
+        print(f"Starting update of template {app}/{template_name} from {env_name}: " + '; '.join(changes),
+              file=sys.stderr)
+        with timing.span(f'template {app}/{template_name}', parent_span) as template_span:
+            if changes != ['template does not exist']:
+                with timing.span('delete'):
+                    self._c.delete_configuration_template(
+                        ApplicationName=app,
+                        TemplateName=template_name,
+                    )
+                    self._wait_for_template_deleted(app, template_name)
+            with timing.span('create'):
+                self._c.create_configuration_template(
+                    ApplicationName=app,
+                    TemplateName=template_name,
+                    EnvironmentId=env_id,
+                )
+        cache.invalidate(app)
+        print(f"Completed update of template {app}/{template_name} from {env_name}", file=sys.stderr)
         completed_time = datetime.datetime.now(datetime.timezone.utc)
         self.completed_list.append({
             'app': app,
+            'changes': changes,
             'completed_at': completed_time,
             'elapsed_time': (completed_time - start_time).total_seconds(),
             'env': env,
@@ -82,5 +147,20 @@ class ConfigSaver:
             'role': role,
             'source_env_name': env_name,
             'started_at': start_time,
-            'template_name': template_name
+            'template_name': template_name,
+            'timings': {'spans': [template_span.to_dict(template_span.start)]},
         })
+
+    # Creating a template with the name of one that is still being deleted
+    # fails, so poll until it is gone rather than sleeping a fixed time.
+    def _wait_for_template_deleted(self, app, template_name):
+        clock = get_clock()
+        deadline = clock.monotonic() + TEMPLATE_DELETE_TIMEOUT
+        interval = 0.5
+        while template_name in self._saved_templates(app):
+            if clock.monotonic() >= deadline:
+                print(f"Template {app}/{template_name} was not deleted within {TEMPLATE_DELETE_TIMEOUT} seconds. "
+                      + "Aborting further operations.", file=sys.stderr)
+                exit(1)
+            clock.sleep(interval)
+            interval = min(interval * 2, 5)
@@ -1,8 +1,22 @@
+import contextlib
 import datetime
-import git
+import fcntl
 import json
 import os
+import subprocess
+import sys
 import tempfile
+import uuid
+
+from safecast_deploy import cache, get_clock, timing
+
+REPO_URL = 'git@github.com:Safecast/deployment-history.git'
+PUSH_ATTEMPTS = 3
+# Delays between attempts made by the background flusher when GitHub is
+# unreachable. Entries that still fail stay spooled for the next flush.
+FLUSH_RETRY_DELAYS = [30, 120, 600]
+
+_background_flush = True
 
 
 class Iso8601DateTimeEncoder(json.JSONEncoder):
@@ -12,32 +26,290 @@ class Iso8601DateTimeEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+def mirror_path():
+    return os.path.join(cache.cache_dir(), 'deployment-history')
+
+
+# Held by everything that uses the mirror: the flusher between reading
+# the spool and pushing, and readers, since opening the mirror resets it
+# to the remote and would wipe out a flush's uncommitted changes.
+@contextlib.contextmanager
+def history_lock():
+    os.makedirs(cache.cache_dir(), exist_ok=True)
+    with open(os.path.join(cache.cache_dir(), 'deployment-history.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+# The local mirror is cloned shallowly once, then brought up to date with
+# an incremental fetch, which only transfers commits made since the last
+# deploy from this machine. Callers must hold history_lock().
+def open_mirror(url=None, path=None):
+    # GitPython is slow to import and most commands only spool entries.
+    import git
+    if url is None:
+        url = REPO_URL
+    if path is None:
+        path = mirror_path()
+    if not os.path.isdir(os.path.join(path, '.git')):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return git.Repo.clone_from(url, path, depth=1, single_branch=True)
+    repo = git.Repo(path)
+    # Also discards anything left behind by an interrupted write.
+    _update(repo)
+    return repo
+
+
+def spool_dir():
+    return os.path.join(cache.cache_dir(), 'history-spool')
+
+
+# Entries are first written to a durable local spool, so a deploy neither
+# waits on GitHub nor loses its record when GitHub is unreachable. A
+# detached flusher process commits and pushes them afterwards.
 def log_result(result):
-    with tempfile.TemporaryDirectory() as temp_dir:
-        repo = git.Repo.clone_from('git@github.com:Safecast/deployment-history.git', temp_dir)
-        # TODO automatically create dirs and files as necessary
-        if isinstance(result, list):
-            for item in result:
-                write_entry(item, temp_dir, repo)
-        else:
-            write_entry(result, temp_dir, repo)
-        repo.index.commit("Updated entry.")
-        repo.remotes.origin.push()
-
-
-def write_entry(result, temp_dir, repo):
-    log_file_path = os.path.join(temp_dir, result['app'], (result['env'] + '.json'))
-
-    if not os.path.exists(os.path.dirname(log_file_path)):
-        os.mkdir(os.path.dirname(log_file_path))
-
-    if os.path.exists(log_file_path):
-        with open(log_file_path, 'r', encoding='utf-8', newline='\n') as f:
-            history = json.load(f)
-    else:
-        history = []
-
-    history.insert(0, result)
-    with open(log_file_path, 'w', encoding='utf-8', newline='\n') as f:
-        json.dump(history, f, indent=2, sort_keys=True, cls=Iso8601DateTimeEncoder)
+    with timing.span('history'):
+        spool_entries(result if isinstance(result, list) else [result])
+        if _background_flush:
+            start_background_flush()
+
+
+# With the background flush disabled, entries stay spooled until an
+# explicit flush; the tests use this to stay offline.
+def set_background_flush(enabled):
+    global _background_flush
+    _background_flush = enabled
+
+
+def spool_entries(entries):
+    os.makedirs(spool_dir(), exist_ok=True)
+    name = '{}-{}.json'.format(datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S%f'), uuid.uuid4().hex)
+    fd, temp_path = tempfile.mkstemp(dir=spool_dir(), suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(entries, f, sort_keys=True, cls=Iso8601DateTimeEncoder)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, os.path.join(spool_dir(), name))
+
+
+def start_background_flush():
+    os.makedirs(spool_dir(), exist_ok=True)
+    log_path = os.path.join(spool_dir(), 'flush.log')
+    with open(log_path, 'a') as log:
+        subprocess.Popen(
+            [sys.executable, '-m', 'safecast_deploy.git_logger'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            start_new_session=True,
+        )
+    print(f"History entry spooled, pushing it to deployment-history in the background (log: {log_path}).",
+          file=sys.stderr)
+
+
+def run_flush_cli(args):
+    count = flush()
+    print(f"Pushed {count} spooled history entries.", file=sys.stderr)
+
+
+# Commits every spooled entry in a single commit and only then removes
+# them from the spool. Returns the number of entries pushed.
+def flush(url=None, path=None):
+    os.makedirs(spool_dir(), exist_ok=True)
+    with history_lock():
+        spooled = []
+        entries = []
+        for spool_path in _spool_files():
+            try:
+                entries.extend(_read_spool_file(spool_path))
+            except ValueError as e:
+                _quarantine(spool_path, e)
+                continue
+            spooled.append(spool_path)
+        if not spooled:
+            return 0
+
+        def write_entries(repo):
+            for entry in entries:
+                write_entry(entry, repo.working_tree_dir, repo)
+
+        message = "Updated entry." if len(entries) == 1 else f"Updated {len(entries)} entries."
+        with timing.span('open_mirror'):
+            repo = open_mirror(url, path)
+        with timing.span('commit_and_push'):
+            _commit_and_push(repo, write_entries, message)
+        for spool_path in spooled:
+            os.remove(spool_path)
+        return len(entries)
+
+
+# The entries still waiting in the spool, such as those of deploys whose
+# background flush failed. Callers that also read the mirror should hold
+# history_lock(), so entries are not missed while a flush moves them.
+def read_spool():
+    entries = []
+    for spool_path in _spool_files():
+        try:
+            entries.extend(_read_spool_file(spool_path))
+        except (OSError, ValueError) as e:
+            print(f"WARN: could not read the spooled history file {spool_path}: {e}", file=sys.stderr)
+    return entries
+
+
+def _spool_files():
+    if not os.path.isdir(spool_dir()):
+        return []
+    return sorted(os.path.join(spool_dir(), name) for name in os.listdir(spool_dir()) if name.endswith('.json'))
+
+
+# Raises ValueError for a file that could never be flushed: one that is not
+# JSON, or has an entry that cannot be filed in the history.
+def _read_spool_file(spool_path):
+    with open(spool_path, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise ValueError("not a list of entries")
+    for entry in entries:
+        try:
+            _shard_path('', entry)
+        except (AttributeError, KeyError, TypeError) as e:
+            raise ValueError(f"malformed entry {entry!r}: {e!r}")
+    return entries
+
+
+# Moves a spooled file that can never be flushed out of the way, so it does
+# not hold back the entries spooled after it.
+def _quarantine(spool_path, error):
+    quarantine_dir = os.path.join(spool_dir(), 'quarantine')
+    os.makedirs(quarantine_dir, exist_ok=True)
+    quarantine_path = os.path.join(quarantine_dir, os.path.basename(spool_path))
+    os.replace(spool_path, quarantine_path)
+    print(f"WARN: could not read the spooled history file {spool_path}, moved it to {quarantine_path}: {error}",
+          file=sys.stderr)
+
+
+def _flush_with_retries():
+    import git
+    for delay in FLUSH_RETRY_DELAYS + [None]:
+        try:
+            with timing.span('flush'):
+                count = flush()
+            print(f"{datetime.datetime.now().isoformat()} Pushed {count} spooled history entries.", file=sys.stderr)
+            print(json.dumps(timing.recorder.to_dict(), sort_keys=True), file=sys.stderr)
+            return
+        except (git.GitCommandError, OSError) as e:
+            print(f"{datetime.datetime.now().isoformat()} WARN: flushing the history spool failed: {e}", file=sys.stderr)
+            if delay is None:
+                print("Entries remain spooled; run `deploy.py flush_history` to retry.", file=sys.stderr)
+                exit(1)
+            get_clock().sleep(delay)
+
+
+def _commit_and_push(repo, apply_changes, message):
+    import git
+    for attempt in range(1, PUSH_ATTEMPTS + 1):
+        apply_changes(repo)
+        repo.index.commit(message)
+        try:
+            repo.git.push('origin', 'HEAD:' + repo.active_branch.name)
+            return
+        except git.GitCommandError:
+            if attempt == PUSH_ATTEMPTS:
+                raise
+            # Someone else pushed first. Rather than recloning, fetch their
+            # commits and replay our changes on top of them.
+            print("WARN: pushing the deployment history failed, retrying on top of the remote changes.",
+                  file=sys.stderr)
+            _update(repo)
+
+
+def _update(repo):
+    branch = repo.active_branch.name
+    repo.remotes.origin.fetch(branch)
+    repo.git.reset('--hard', f'origin/{branch}')
+
+
+def _month(entry):
+    timestamp = entry.get('completed_at') or entry.get('started_at')
+    if isinstance(timestamp, datetime.datetime):
+        return timestamp.strftime('%Y-%m')
+    if timestamp is None:
+        return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m')
+    # Entries read back from JSON carry ISO 8601 strings.
+    return timestamp[:7]
+
+
+def _shard_path(repo_dir, entry):
+    # Entries spanning several apps, such as releases, are filed by event.
+    return os.path.join(repo_dir, entry.get('app', entry['event']), entry['env'], _month(entry) + '.jsonl')
+
+
+# History is stored as one JSON object per line, in monthly shards under
+# <app>/<env>/, oldest first. Writing an entry appends a single line, so
+# the cost of a write and the size of its diff do not grow with history.
+def write_entry(result, repo_dir, repo):
+    log_file_path = _shard_path(repo_dir, result)
+    os.makedirs(os.path.dirname(log_file_path), exist_ok=True)
+    with open(log_file_path, 'a', encoding='utf-8', newline='\n') as f:
+        f.write(json.dumps(result, sort_keys=True, cls=Iso8601DateTimeEncoder) + '\n')
     repo.index.add(log_file_path)
+
+
+def read_history(app, env, repo_dir=None):
+    if repo_dir is None:
+        repo_dir = mirror_path()
+    env_dir = os.path.join(repo_dir, app, env)
+    if os.path.isdir(env_dir):
+        shards = sorted((name for name in os.listdir(env_dir) if name.endswith('.jsonl')), reverse=True)
+        for shard in shards:
+            with open(os.path.join(env_dir, shard), 'r', encoding='utf-8', newline='\n') as f:
+                lines = f.readlines()
+            for line in reversed(lines):
+                if line.strip():
+                    yield json.loads(line)
+    # Files in the old format are already newest first.
+    legacy_path = os.path.join(repo_dir, app, env + '.json')
+    if os.path.exists(legacy_path):
+        with open(legacy_path, 'r', encoding='utf-8', newline='\n') as f:
+            yield from json.load(f)
+
+
+def run_migrate_cli(args):
+    with history_lock():
+        _commit_and_push(open_mirror(), migrate_legacy_files, "Migrated history to monthly JSON Lines shards.")
+
+
+def migrate_legacy_files(repo):
+    repo_dir = repo.working_tree_dir
+    for app in sorted(os.listdir(repo_dir)):
+        app_dir = os.path.join(repo_dir, app)
+        if app.startswith('.') or not os.path.isdir(app_dir):
+            continue
+        for name in sorted(os.listdir(app_dir)):
+            legacy_path = os.path.join(app_dir, name)
+            if not name.endswith('.json') or not os.path.isfile(legacy_path):
+                continue
+            with open(legacy_path, 'r', encoding='utf-8', newline='\n') as f:
+                history = json.load(f)
+            shards = {}
+            for entry in reversed(history):
+                shards.setdefault(_shard_path(repo_dir, entry), []).append(entry)
+            for shard_path, entries in shards.items():
+                os.makedirs(os.path.dirname(shard_path), exist_ok=True)
+                existing = ''
+                if os.path.exists(shard_path):
+                    with open(shard_path, 'r', encoding='utf-8', newline='\n') as f:
+                        existing = f.read()
+                # Legacy entries predate anything already in the new format.
+                with open(shard_path, 'w', encoding='utf-8', newline='\n') as f:
+                    for entry in entries:
+                        f.write(json.dumps(entry, sort_keys=True) + '\n')
+                    f.write(existing)
+                repo.index.add(shard_path)
+            repo.index.remove([legacy_path], working_tree=True)
+            print(f"Migrated {len(history)} entries from {app}/{name}.", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    _flush_with_retries()
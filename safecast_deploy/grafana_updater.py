@@ -1,108 +1,219 @@
 import getpass
+import http.client
 import json
 import os
 import re
-import urllib
+import threading
 
 import sys
 from urllib.parse import urlparse
 
-from safecast_deploy import state
+from safecast_deploy import aws, get_clock, state
+
+GRAFANA_URL = 'https://grafana.safecast.cc'
+DASHBOARD_UIDS = {
+    'api': 'W7c552kZz',
+    'ingest': 'MoVFmrdZz',
+}
 
 
 def run_cli(args):
+    if args.all == (args.app is not None):
+        print("ERROR: Specify either an application or --all.", file=sys.stderr)
+        exit(1)
     if 'GRAFANA_API_KEY' in os.environ:
         grafana_api_key = os.environ['GRAFANA_API_KEY']
     else:
         grafana_api_key = getpass.getpass('Enter the Grafana API key (will not be echoed): ')
-    GrafanaUpdater(args.app, grafana_api_key).run()
+    apps = list(DASHBOARD_UIDS) if args.all else [args.app]
+    # GRAFANA_URL can point the updater at a local stand-in for Grafana.
+    pool = ConnectionPool(os.environ.get('GRAFANA_URL', GRAFANA_URL))
+    eb_client = aws.client('elasticbeanstalk')
+    try:
+        with get_clock().executor(len(apps)) as executor:
+            futures = [
+                executor.submit(lambda app: GrafanaUpdater(app, grafana_api_key, pool, eb_client).run(), app)
+                for app in apps
+            ]
+            for future in futures:
+                future.result()
+    finally:
+        pool.close()
+
+
+# Keeps HTTP connections to one server open between requests, so the
+# fetch and push, and the updates for several dashboards, share them.
+class ConnectionPool:
+    def __init__(self, base_url, size=4, timeout=30):
+        parsed = urlparse(base_url)
+        if parsed.scheme == 'https':
+            self._connection_class = http.client.HTTPSConnection
+        else:
+            self._connection_class = http.client.HTTPConnection
+        self._host = parsed.netloc
+        self._path_prefix = parsed.path.rstrip('/')
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    # Returns the response status and body.
+    def request(self, method, path, body=None, headers=None):
+        while True:
+            conn, reused = self._acquire()
+            try:
+                conn.request(method, self._path_prefix + path, body=body, headers=headers or {})
+                res = conn.getresponse()
+                data = res.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                # The server closed a connection that sat idle; retry once
+                # on a fresh one.
+                if reused:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            if res.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            return res.status, data
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._connection_class(self._host, timeout=self.timeout), False
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
 
 
 class GrafanaUpdater:
-    def __init__(self, app, grafana_api_key):
-        self.state = state.State(app)
+    def __init__(self, app, grafana_api_key, pool=None, eb_client=None):
+        self.app = app
+        self.state = state.State(app, eb_client=eb_client)
         self.grafana_api_key = grafana_api_key
-        if app == 'api':
-            self.dashboard_uid = 'W7c552kZz'
-        elif app == 'ingest':
-            self.dashboard_uid = 'MoVFmrdZz'
+        self.pool = ConnectionPool(GRAFANA_URL) if pool is None else pool
+        self.dashboard_uid = DASHBOARD_UIDS.get(app)
 
     def run(self):
         dashboard = self._get_dashboard()
+        changes = rewrite(dashboard, self._rules())
+        for change in changes:
+            print("Panel {!r}: {} {!r} -> {!r}".format(change['panel'], change['key'], change['old'], change['new']),
+                  file=sys.stderr)
+        if not changes:
+            # Pushing would only add an identical version to the history.
+            print(f"The {self.app} dashboard already matches the running environment, not pushing it.",
+                  file=sys.stderr)
+            return
+        print(f"Changed {len(changes)} values in the {self.app} dashboard, pushing it.", file=sys.stderr)
+        self._push_dashboard(dashboard)
 
-        metadata = self.state.env_metadata['prd']
-        env_resources = metadata['api_resources']
-        self._update_key(dashboard, 'LoadBalancerName', env_resources['LoadBalancers'][0]['Name'])
-        self._update_key(
-            dashboard,
-            'AutoScalingGroupName',
-            env_resources['AutoScalingGroups'][0]['Name'],
-            parent_title_pattern=re.compile(r'.*(web CPU|web network)')
-        )
-
-        metadata = self.state.env_metadata['prd-wrk']
-        env_resources = metadata['api_resources']
-        self._update_key(
-            dashboard,
-            'AutoScalingGroupName',
-            env_resources['AutoScalingGroups'][0]['Name'],
-            parent_title_pattern=re.compile(r'(Worker CPU|Worker Network)')
-        )
+    def _rules(self):
+        env_resources = self.state.env_metadata['prd'].resources
+        rules = [
+            Rule('LoadBalancerName', env_resources['LoadBalancers'][0]['Name']),
+            Rule('AutoScalingGroupName', env_resources['AutoScalingGroups'][0]['Name'], r'.*(web CPU|web network)'),
+        ]
 
+        env_resources = self.state.env_metadata['prd-wrk'].resources
         queue_url = [q['URL'] for q in env_resources['Queues'] if q['Name'] == 'WorkerQueue'][0]
         queue_name = urlparse(queue_url).path.split('/')[-1]
-        self._update_key(
-            dashboard,
-            'QueueName',
-            queue_name
-        )
-
-        self._push_dashboard(dashboard)
+        rules += [
+            Rule('AutoScalingGroupName', env_resources['AutoScalingGroups'][0]['Name'], r'(Worker CPU|Worker Network)'),
+            Rule('QueueName', queue_name),
+        ]
+        return rules
 
     def _get_dashboard(self):
-        req = urllib.request.Request(
-            f'https://grafana.safecast.cc/api/dashboards/uid/{self.dashboard_uid}',
+        status, data = self.pool.request(
+            'GET',
+            f'/api/dashboards/uid/{self.dashboard_uid}',
             headers={
                 'Authorization': f'Bearer {self.grafana_api_key}',
-            }
+            },
         )
-        res = urllib.request.urlopen(req)
-        if res.getcode() != 200:
-            print('ERROR: Could not fetch the dashboard; HTTP status code was ' + res.getcode(), file=sys.stderr)
+        if status != 200:
+            print(f'ERROR: Could not fetch the {self.app} dashboard; HTTP status code was {status}', file=sys.stderr)
             exit(1)
-        return json.loads(res.read())['dashboard']
+        return json.loads(data)['dashboard']
 
     def _push_dashboard(self, dashboard):
         req_body = {
             'dashboard': dashboard,
             'folderId': 37,
         }
-        req_body_data = bytearray(json.dumps(req_body), 'utf-8')
-        req = urllib.request.Request(
-            f'https://grafana.safecast.cc/api/dashboards/db',
-            data=req_body_data,
+        status, data = self.pool.request(
+            'POST',
+            '/api/dashboards/db',
+            body=json.dumps(req_body).encode('utf-8'),
             headers={
                 'Authorization': f'Bearer {self.grafana_api_key}',
                 'Content-Type': 'application/json; charset=utf-8',
             },
-            method='POST',
         )
-        res = urllib.request.urlopen(req)
-        if res.getcode() != 200:
-            print('ERROR: Could not fetch the dashboard; HTTP status code was ' + res.getcode(), file=sys.stderr)
+        if status != 200:
+            print(f'ERROR: Could not push the {self.app} dashboard; HTTP status code was {status}', file=sys.stderr)
             exit(1)
 
-    def _update_key(self, obj, key, value, parent_title_pattern=None, in_panel=False):
-        if parent_title_pattern is None:
-            in_panel = True
+
+# Sets `key` to `value` wherever it appears in the dashboard, limited to
+# objects under a dict whose title matches `title_pattern`, if one is given.
+class Rule:
+    __slots__ = ('key', 'value', 'title_pattern')
+
+    def __init__(self, key, value, title_pattern=None):
+        self.key = key
+        self.value = value
+        self.title_pattern = None if title_pattern is None else re.compile(title_pattern)
+
+
+# Applies every rule in a single iterative walk of the dashboard, matching
+# each title against each distinct pattern once. Where several rules set
+# the same key, the last one that applies wins. Returns the values that
+# changed, along with the title of the panel they belong to.
+def rewrite(dashboard, rules):
+    rules_by_key = {}
+    for rule in rules:
+        rules_by_key.setdefault(rule.key, []).append(rule)
+    patterns = list({rule.title_pattern for rule in rules if rule.title_pattern is not None})
+    changes = []
+    # Each entry holds an object, the title of its nearest titled ancestor
+    # and which title patterns that ancestor matched.
+    stack = [(dashboard, None, frozenset())]
+    while stack:
+        obj, title, matched = stack.pop()
         if isinstance(obj, list):
-            for item in obj:
-                self._update_key(item, key, value, parent_title_pattern, in_panel)
-        elif isinstance(obj, dict):
-            if parent_title_pattern is not None and 'title' in obj:
-                in_panel = bool(parent_title_pattern.match(obj['title']))
-            for curr_key in obj:
-                if in_panel and curr_key == key:
-                    obj[curr_key] = value
-                else:
-                    self._update_key(obj[curr_key], key, value, parent_title_pattern, in_panel)
+            stack.extend((item, title, matched) for item in obj)
+            continue
+        if not isinstance(obj, dict):
+            continue
+        if 'title' in obj and isinstance(obj['title'], str):
+            title = obj['title']
+            matched = frozenset(pattern for pattern in patterns if pattern.match(title))
+        for key, child in obj.items():
+            rule = None
+            for candidate in rules_by_key.get(key, ()):
+                if candidate.title_pattern is None or candidate.title_pattern in matched:
+                    rule = candidate
+            if rule is None:
+                if isinstance(child, (dict, list)):
+                    stack.append((child, title, matched))
+            elif child != rule.value:
+                obj[key] = rule.value
+                changes.append({'panel': title, 'key': key, 'old': child, 'new': rule.value})
+    return changes
@@ -0,0 +1,151 @@
+import os
+import socket
+import sys
+
+from safecast_deploy import timing
+
+# Name: (help, StatsD type). Names ending in _seconds are sent to StatsD
+# as timers in milliseconds.
+METRICS = {
+    'duration_seconds': ("Wall time of the whole command.", 'ms'),
+    'phase_duration_seconds': ("Wall time of each phase, summed when a phase runs more than once.", 'ms'),
+    'health_wait_seconds': ("Time spent waiting for environments to become Ready with Ok health.", 'ms'),
+    'success': ("1 if the command succeeded, 0 if it failed.", 'g'),
+    'aws_calls': ("AWS API calls made, not counting retries.", 'c'),
+    'aws_retries': ("AWS API calls retried after throttling or a transient error.", 'c'),
+    'completed_timestamp_seconds': ("Unix time at which the command finished.", None),
+}
+PREFIX = 'safecast_deploy'
+ROLE_SPANS = {'web': 'web', 'worker': 'wrk'}
+# Stays under a typical MTU so packets are not fragmented.
+MAX_PACKET = 1400
+
+
+# Builds the metrics for the command that just ran from the spans and AWS
+# call counts the recorder collected. labels usually hold the command,
+# app, env and role it was given; spans for a deploy's web and worker
+# phases and for each app of a release refine role and app.
+def collect(labels, succeeded, recorder=None):
+    recorder = recorder or timing.recorder
+    now = recorder.clock.monotonic()
+    labels = {key: value for key, value in labels.items() if value is not None}
+    phases = {}
+    health_waits = {}
+
+    def walk(spans, path, span_labels):
+        for span in spans:
+            child_labels = dict(span_labels)
+            child_path = path + (span.name,)
+            if child_path[0] == 'release' and len(child_path) == 2:
+                child_labels['app'] = span.name
+            elif span.name in ROLE_SPANS:
+                child_labels['role'] = ROLE_SPANS[span.name]
+            # A release's app spans become the app label, not a phase.
+            phase = child_path[:1] + child_path[2:] if child_path[0] == 'release' else child_path
+            seconds = (now if span.end is None else span.end) - span.start
+            key = _label_key(dict(child_labels, phase='/'.join(phase)))
+            phases[key] = phases.get(key, 0) + seconds
+            if span.name == 'wait_for_green':
+                key = _label_key(child_labels)
+                health_waits[key] = health_waits.get(key, 0) + seconds
+            walk(span.children, child_path, child_labels)
+
+    roots, aws_stats = recorder.snapshot()
+    walk(roots, (), labels)
+    aws_calls = sum(stats['calls'] for stats in aws_stats.values())
+    aws_retries = sum(stats['retries'] for stats in aws_stats.values())
+    samples = [
+        ('duration_seconds', labels, now - recorder.origin),
+        ('success', labels, 1 if succeeded else 0),
+        ('aws_calls', labels, aws_calls),
+        ('aws_retries', labels, aws_retries),
+        ('completed_timestamp_seconds', labels, recorder.clock.time()),
+    ]
+    samples += [('phase_duration_seconds', dict(key), seconds) for key, seconds in sorted(phases.items())]
+    samples += [('health_wait_seconds', dict(key), seconds) for key, seconds in sorted(health_waits.items())]
+    return samples
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+# Writes the samples in the Prometheus text format for node_exporter's
+# textfile collector. The file is replaced atomically so the collector
+# never reads half of it.
+def write_textfile(path, samples):
+    lines = []
+    for name, (help_text, _) in METRICS.items():
+        matching = [(labels, value) for sample_name, labels, value in samples if sample_name == name]
+        if not matching:
+            continue
+        lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {PREFIX}_{name} gauge")
+        for labels, value in matching:
+            label_text = ','.join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items()))
+            lines.append(f"{PREFIX}_{name}{{{label_text}}} {_number(value)}")
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(temp_path, path)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return str(value) if isinstance(value, int) else f'{value:.3f}'
+
+
+# Sends the samples to a StatsD server over UDP, with labels as DogStatsD
+# tags, which statsd_exporter and Datadog both understand. A run also
+# counts towards safecast_deploy.runs, tagged with its outcome.
+def send_statsd(address, samples, succeeded):
+    lines = []
+    for name, labels, value in samples:
+        statsd_type = METRICS[name][1]
+        if statsd_type is None:
+            continue
+        if statsd_type == 'ms':
+            name = name[:-len('_seconds')]
+            value = round(value * 1000)
+        lines.append(f"{PREFIX}.{name}:{value}|{statsd_type}{_tags(labels)}")
+    run_labels = dict(samples[0][1], outcome='success' if succeeded else 'failure')
+    lines.append(f"{PREFIX}.runs:1|c{_tags(run_labels)}")
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for packet in _packets(lines):
+            sock.sendto(packet.encode('utf-8'), address)
+
+
+def _tags(labels):
+    if not labels:
+        return ''
+    return '|#' + ','.join(f'{key}:{value}' for key, value in sorted(labels.items()))
+
+
+def _packets(lines):
+    packet = ''
+    for line in lines:
+        if packet and len(packet) + 1 + len(line) > MAX_PACKET:
+            yield packet
+            packet = ''
+        packet = line if not packet else packet + '\n' + line
+    if packet:
+        yield packet
+
+
+# Exports the metrics of the command that just ran. A monitoring outage
+# must not fail a deploy, so errors are only reported.
+def export(labels, succeeded, textfile=None, statsd=None):
+    samples = collect(labels, succeeded)
+    if textfile is not None:
+        try:
+            write_textfile(textfile, samples)
+        except OSError as e:
+            print(f"WARN: Could not write metrics to {textfile}: {e}", file=sys.stderr)
+    if statsd is not None:
+        try:
+            send_statsd(statsd, samples, succeeded)
+        except OSError as e:
+            print(f"WARN: Could not send metrics to {statsd[0]}:{statsd[1]}: {e}", file=sys.stderr)
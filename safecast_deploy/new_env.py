@@ -2,82 +2,199 @@ import datetime
 import pprint
 import sys
 
-from safecast_deploy import config_saver, git_logger, verbose_sleep
+from safecast_deploy import cache, config_saver, get_clock, git_logger, timing, verbose_sleep
+from safecast_deploy.waiters import DrainWaiter, EventTailer, HealthWaiter
 
 
 class NewEnv:
-    def __init__(self, state, update_templates):
+    def __init__(self, state, update_templates, parallel_web=False, drain_timeout=900):
         self.state = state
         self._c = state.eb_client
         self.update_templates = update_templates
+        self.parallel_web = parallel_web
+        self.drain_timeout = drain_timeout
 
     def run(self):
+        result = self.deploy()
+        self._print_result(result)
+        git_logger.log_result(result)
+
+    def deploy(self):
         self.start_time = datetime.datetime.now(datetime.timezone.utc)
-        if self.update_templates:
-            config_saver.ConfigSaver(
-                app=self.state.app, env=self.state.env
-            ).run()
-        # Handle the worker environment first, to ensure that database
-        # migrations are applied
+        try:
+            with timing.span('new_env'), EventTailer(self._c, self.state.app, since=self.start_time) as self._events:
+                self._events.follow(*(self.state.env_metadata[self.state.subenvs[role]].name
+                                      for role in self.state.deployed_roles))
+                if self.update_templates:
+                    with timing.span('save_templates'):
+                        config_saver.ConfigSaver(
+                            app=self.state.app, env=self.state.env, eb_client=self._c
+                        ).run()
+                # Handle the worker environment first, to ensure that database
+                # migrations are applied
+                self._calculate_new_envs()
+                self._events.follow(*(metadata['name'] for metadata in self.new_env_metadata.values()))
+                if self.state.has_worker and self.parallel_web:
+                    # The new web environment comes up alongside the worker rollout,
+                    # but only the worker finishing allows the CNAME swap, so
+                    # migrations have still run before it takes traffic.
+                    with get_clock().executor(1) as executor:
+                        worker = executor.submit(self._handle_worker, timing.current_span())
+                        # A failed worker rollout stops the wait for the web
+                        # environment at once rather than after its timeout.
+                        worker.add_done_callback(self._cancel_on_failure)
+                        try:
+                            try:
+                                self._create_web()
+                            except BaseException:
+                                self._stop_worker(worker)
+                                raise
+                            print("Waiting for the worker rollout to complete before swapping.", file=sys.stderr)
+                            worker.result()
+                        except BaseException:
+                            if worker.done() and worker.exception() is not None:
+                                self._terminate_new_web()
+                            raise
+                else:
+                    if self.state.has_worker:
+                        self._handle_worker()
+                    self._create_web()
+                self._swap_web()
+        finally:
+            # Even a deploy that stopped partway has changed environments.
+            cache.invalidate(self.state.app)
+        return self._generate_result()
+
+    # The steps deploy() would take, as (phase, description) pairs. Phases
+    # match the timing spans recorded by a real run.
+    def plan(self):
         self._calculate_new_envs()
+        old_web = self.state.env_metadata[self.state.subenvs['web']].name
+        new_web = self.new_env_metadata['web']['name']
+        steps = []
+        if self.update_templates:
+            steps.append(('save_templates', f"Recreate the saved configuration templates for {self.state.env} from the running environments"))
         if self.state.has_worker:
-            self._handle_worker()
-        self._handle_web()
-        result = self._generate_result()
-        self._print_result(result)
-        git_logger.log_result(result)
+            old_wrk = self.state.env_metadata[self.state.subenvs['wrk']].name
+            new_wrk = self.new_env_metadata['wrk']['name']
+            steps += [
+                ('worker/scale_down', f"update_environment {old_wrk}: Auto Scaling group MinSize=0, MaxSize=0"),
+                ('worker/drain', f"Wait up to {self.drain_timeout} seconds for {old_wrk} to have no instances"),
+                ('worker/create', f"create_environment {new_wrk} from template {self.state.subenvs['wrk']} "
+                 + f"with {self.state.new_version} on {self.state.new_arn}"),
+                ('worker/wait_for_green', f"Wait for {new_wrk} to be Ready with Ok health"),
+                ('worker/terminate', f"terminate_environment {old_wrk}"),
+            ]
+        steps += [
+            ('web/create', f"create_environment {new_web} from template {self.state.subenvs['web']} "
+             + f"with {self.state.new_version} on {self.state.new_arn}"
+             + (", alongside the worker steps" if self.state.has_worker and self.parallel_web else "")),
+            ('web/wait_for_green', f"Wait for {new_web} to be Ready with Ok health"),
+            ('swap/swap_cnames', f"swap_environment_cnames {old_web} <-> {new_web}"),
+            ('swap/settle', "Wait 120 seconds for DNS to settle"),
+            ('swap/terminate', f"terminate_environment {old_web}"),
+        ]
+        return steps
+
+    def _handle_worker(self, parent_span=None):
+        with timing.span('worker', parent_span):
+            # First, turn off the current worker to avoid any concurrency issues
+            print("Setting the worker tier to scale to 0.", file=sys.stderr)
+            since = datetime.datetime.now(datetime.timezone.utc)
+            with timing.span('scale_down'):
+                self._c.update_environment(
+                    ApplicationName=self.state.app,
+                    EnvironmentName=self.state.env_metadata[self.state.subenvs['wrk']].name,
+                    OptionSettings=[
+                        {
+                            'ResourceName': 'AWSEBAutoScalingGroup',
+                            'Namespace': 'aws:autoscaling:asg',
+                            'OptionName': 'MaxSize',
+                            'Value': '0',
+                        },
+                        {
+                            'ResourceName': 'AWSEBAutoScalingGroup',
+                            'Namespace': 'aws:autoscaling:asg',
+                            'OptionName': 'MinSize',
+                            'Value': '0'
+                        },
+                    ])
+            print("Waiting for the old worker instances to terminate.", file=sys.stderr)
+            with timing.span('drain'):
+                DrainWaiter(
+                    self._c,
+                    self.state.env_metadata[self.state.subenvs['wrk']].name,
+                    timeout=self.drain_timeout,
+                    since=since,
+                    tailer=self._events,
+                ).wait()
+            print("Creating the new worker environment.", file=sys.stderr)
+            since = datetime.datetime.now(datetime.timezone.utc)
+            with timing.span('create'):
+                self._c.create_environment(
+                    ApplicationName=self.state.app,
+                    EnvironmentName=self.new_env_metadata['wrk']['name'],
+                    PlatformArn=self.state.new_arn,
+                    TemplateName=self.state.subenvs['wrk'],
+                    VersionLabel=self.state.new_version,
+                )
+            self._wait_for_green(self.new_env_metadata['wrk']['name'], since)
+            print("Terminating the old worker environment.", file=sys.stderr)
+            with timing.span('terminate'):
+                self._c.terminate_environment(EnvironmentName=self.state.env_metadata[self.state.subenvs['wrk']].name)
+
+    def _create_web(self):
+        with timing.span('web'):
+            print("Creating the new Web environment.", file=sys.stderr)
+            since = datetime.datetime.now(datetime.timezone.utc)
+            with timing.span('create'):
+                self._c.create_environment(
+                    ApplicationName=self.state.app,
+                    EnvironmentName=self.new_env_metadata['web']['name'],
+                    PlatformArn=self.state.new_arn,
+                    TemplateName=self.state.subenvs['web'],
+                    VersionLabel=self.state.new_version,
+                )
+            self._wait_for_green(self.new_env_metadata['web']['name'], since)
 
-    def _handle_worker(self):
-        # First, turn off the current worker to avoid any concurrency issues
-        print("Setting the worker tier to scale to 0.", file=sys.stderr)
-        self._c.update_environment(
-            ApplicationName=self.state.app,
-            EnvironmentName=self.state.env_metadata[self.state.subenvs['wrk']]['name'],
-            OptionSettings=[
-                {
-                    'ResourceName': 'AWSEBAutoScalingGroup',
-                    'Namespace': 'aws:autoscaling:asg',
-                    'OptionName': 'MaxSize',
-                    'Value': '0',
-                },
-                {
-                    'ResourceName': 'AWSEBAutoScalingGroup',
-                    'Namespace': 'aws:autoscaling:asg',
-                    'OptionName': 'MinSize',
-                    'Value': '0'
-                },
-            ])
-        verbose_sleep(480)
-        print("Creating the new worker environment.", file=sys.stderr)
-        self._c.create_environment(
-            ApplicationName=self.state.app,
-            EnvironmentName=self.new_env_metadata['wrk']['name'],
-            PlatformArn=self.state.new_arn,
-            TemplateName=self.state.subenvs['wrk'],
-            VersionLabel=self.state.new_version,
-        )
-        self._wait_for_green(self.new_env_metadata['wrk']['name'])
-        print("Terminating the old worker environment.", file=sys.stderr)
-        self._c.terminate_environment(EnvironmentName=self.state.env_metadata[self.state.subenvs['wrk']]['name'])
-
-    def _handle_web(self):
-        print("Creating the new Web environment.", file=sys.stderr)
-        self._c.create_environment(
-            ApplicationName=self.state.app,
-            EnvironmentName=self.new_env_metadata['web']['name'],
-            PlatformArn=self.state.new_arn,
-            TemplateName=self.state.subenvs['web'],
-            VersionLabel=self.state.new_version,
-        )
-        self._wait_for_green(self.new_env_metadata['web']['name'])
-        print("Swapping web environment CNAMEs.", file=sys.stderr)
-        self._c.swap_environment_cnames(
-            SourceEnvironmentName=self.state.env_metadata[self.state.subenvs['web']]['name'],
-            DestinationEnvironmentName=self.new_env_metadata['web']['name'],
-        )
-        verbose_sleep(120)
-        print("Terminating the old web environment.", file=sys.stderr)
-        self._c.terminate_environment(EnvironmentName=self.state.env_metadata[self.state.subenvs['web']]['name'])
+    def _cancel_on_failure(self, worker):
+        if not worker.cancelled() and worker.exception() is not None:
+            self._events.cancel("the worker rollout failed.")
+
+    # Leaving the executor waits for the worker, so a failed web rollout
+    # stops the worker's waits rather than sitting through them unannounced.
+    def _stop_worker(self, worker):
+        if worker.done():
+            return
+        print("The web rollout failed, stopping the worker rollout and waiting for it to stop. "
+              + f"Check {self.state.env_metadata[self.state.subenvs['wrk']].name} and "
+              + f"{self.new_env_metadata['wrk']['name']}, which may be scaled down or partly created.",
+              file=sys.stderr)
+        self._events.cancel("the web rollout failed.")
+
+    # The new web environment never took traffic, so nothing is lost by
+    # removing it; the old one keeps serving.
+    def _terminate_new_web(self):
+        name = self.new_env_metadata['web']['name']
+        print(f"Terminating the new web environment {name}, since the worker rollout failed.", file=sys.stderr)
+        try:
+            self._c.terminate_environment(EnvironmentName=name)
+        except Exception as e:
+            print(f"WARN: Could not terminate {name}, terminate it by hand: {e}", file=sys.stderr)
+
+    def _swap_web(self):
+        with timing.span('swap'):
+            print("Swapping web environment CNAMEs.", file=sys.stderr)
+            with timing.span('swap_cnames'):
+                self._c.swap_environment_cnames(
+                    SourceEnvironmentName=self.state.env_metadata[self.state.subenvs['web']].name,
+                    DestinationEnvironmentName=self.new_env_metadata['web']['name'],
+                )
+            with timing.span('settle'):
+                verbose_sleep(120)
+            print("Terminating the old web environment.", file=sys.stderr)
+            with timing.span('terminate'):
+                self._c.terminate_environment(EnvironmentName=self.state.env_metadata[self.state.subenvs['web']].name)
 
     def _generate_result(self):
         completed_time = datetime.datetime.now(datetime.timezone.utc)
@@ -88,12 +205,13 @@ class NewEnv:
             'env': self.state.env,
             'event': 'new_env',
             'started_at': self.start_time,
+            'timings': timing.recorder.to_dict(),
             'web': {
                 'new_env': self.new_env_metadata['web']['name'],
                 'new_version': self.state.new_version,
                 'new_version_parsed': self.state.new_versions_parsed['web'],
-                'old_env': self.state.env_metadata[self.state.subenvs['web']]['name'],
-                'old_version': self.state.env_metadata[self.state.subenvs['web']]['version'],
+                'old_env': self.state.env_metadata[self.state.subenvs['web']].name,
+                'old_version': self.state.env_metadata[self.state.subenvs['web']].version,
                 'old_version_parsed': self.state.old_versions_parsed['web'],
             },
 
@@ -102,10 +220,10 @@ class NewEnv:
 
         if self.state.has_worker:
             result['wrk'] = {
-                'env': self.state.env_metadata[self.state.subenvs['wrk']]['name'],
+                'env': self.state.env_metadata[self.state.subenvs['wrk']].name,
                 'new_version': self.state.new_version,
                 'new_version_parsed': self.state.new_versions_parsed['wrk'],
-                'old_version': self.state.env_metadata[self.state.subenvs['wrk']]['version'],
+                'old_version': self.state.env_metadata[self.state.subenvs['wrk']].version,
                 'old_version_parsed': self.state.old_versions_parsed['wrk'],
             }
             self._add_git('wrk', result)
@@ -118,12 +236,15 @@ class NewEnv:
             'ingest': 'ingest',
             'reporting': 'reporting',
         }
-        if 'git_commit' in self.state.old_versions_parsed[tier] \
-           and 'git_commit' in self.state.new_versions_parsed[tier]:
+        # Labels that are not CircleCI builds, such as `eb deploy` bundles,
+        # parse to None.
+        old_parsed = self.state.old_versions_parsed[tier] or {}
+        new_parsed = self.state.new_versions_parsed[tier] or {}
+        if 'git_commit' in old_parsed and 'git_commit' in new_parsed:
             result[tier]['github_diff'] = 'https://github.com/Safecast/{}/compare/{}...{}'.format(
                 repo_names[self.state.app],
-                self.state.old_versions_parsed[tier]['git_commit'],
-                self.state.new_versions_parsed[tier]['git_commit']
+                old_parsed['git_commit'],
+                new_parsed['git_commit']
             )
 
     def _print_result(self, result):
@@ -150,26 +271,13 @@ class NewEnv:
         }
 
     def _balance_env_num(self):
-        web_num = (self.state.env_metadata[self.state.subenvs['web']]['num'] + 1) % 1000
+        web_num = (self.state.env_metadata[self.state.subenvs['web']].num + 1) % 1000
         if self.state.has_worker:
-            wrk_num = (self.state.env_metadata[self.state.subenvs['wrk']]['num'] + 1) % 1000
+            wrk_num = (self.state.env_metadata[self.state.subenvs['wrk']].num + 1) % 1000
             return max(web_num, wrk_num)
         else:
             return web_num
 
-    def _wait_for_green(self, env_name):
-        verbose_sleep(70)
-        wait_seconds = 0
-        while wait_seconds < 2000:
-            health = self._c.describe_environment_health(
-                EnvironmentName=env_name,
-                AttributeNames=['HealthStatus', ]
-            )['HealthStatus']
-            if health == 'Ok':
-                print("Environment health has returned to normal.", file=sys.stderr)
-                return
-            verbose_sleep(40)
-            wait_seconds += 40
-        print("Environment health did not return to normal within 2000 seconds. Aborting further operations.",
-              file=sys.stderr)
-        exit(1)
+    def _wait_for_green(self, env_name, since):
+        with timing.span('wait_for_green'):
+            HealthWaiter(self._c, env_name, timeout=2000, since=since, tailer=self._events).wait()
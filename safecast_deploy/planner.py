@@ -0,0 +1,96 @@
+import datetime
+import statistics
+import sys
+
+from safecast_deploy import git_logger
+
+# How many past deploys of the same kind the predictions are based on.
+HISTORY_DEPTH = 20
+
+
+# Prints what a deploy would do, without calling any mutating AWS
+# operation, along with how long each phase took in recent deploys of the
+# same app and environment.
+class Planner:
+    def __init__(self, deployer, event):
+        self.deployer = deployer
+        self.event = event
+        self.state = deployer.state
+
+    def run(self):
+        steps = self.deployer.plan()
+        elapsed, phases = self._past_durations()
+        print(f"Dry run: {self.event} of {self.state.new_version} to {self.state.app} {self.state.env}"
+              + ("" if self.state.new_arn is None else f" on {self.state.new_arn}") + ".", file=sys.stderr)
+        width = max(len(phase) for phase, _ in steps)
+        predicted = {}
+        for phase, description in steps:
+            if phases.get(phase):
+                predicted[phase] = statistics.median(phases[phase])
+            print(f"  {phase:<{width}}  {_format(predicted.get(phase)):>7}  {description}", file=sys.stderr)
+        if not elapsed:
+            print(f"No previous {self.event} deploys of {self.state.app} {self.state.env} in the deployment history, "
+                  + "so no duration is predicted.", file=sys.stderr)
+            return
+        if len(predicted) == len(steps):
+            total = self._total(predicted)
+        else:
+            # Older entries have no phase timings; fall back to the totals.
+            total = statistics.median(elapsed)
+        print(f"Predicted duration: {_format(total)} (median of the last {len(elapsed)} {self.event} deploys, "
+              + f"which took between {_format(min(elapsed))} and {_format(max(elapsed))}).", file=sys.stderr)
+
+    # The worker and web phases overlap when the web environment is
+    # created in parallel.
+    def _total(self, predicted):
+        groups = {}
+        for phase, seconds in predicted.items():
+            group = phase.split('/')[0]
+            groups[group] = groups.get(group, 0) + seconds
+        if getattr(self.deployer, 'parallel_web', False) and 'worker' in groups:
+            groups['web'] = max(groups.pop('worker'), groups['web'])
+        return sum(groups.values())
+
+    def _past_durations(self):
+        import git
+        elapsed = []
+        phases = {}
+        with git_logger.history_lock():
+            try:
+                git_logger.open_mirror()
+            except git.GitCommandError as e:
+                print(f"WARN: could not update the deployment history, using the local copy: {e}", file=sys.stderr)
+            for entry in git_logger.read_history(self.state.app, self.state.env):
+                if entry.get('event') != self.event:
+                    continue
+                elapsed.append(entry['elapsed_time'])
+                root = _find_span(entry.get('timings', {}).get('spans', []), self.event)
+                if root is not None:
+                    for phase, duration in _span_durations(root):
+                        phases.setdefault(phase, []).append(duration)
+                if len(elapsed) == HISTORY_DEPTH:
+                    break
+        return elapsed, phases
+
+
+def _find_span(spans, name):
+    for span in spans:
+        if span['name'] == name:
+            return span
+        found = _find_span(span.get('children', []), name)
+        if found is not None:
+            return found
+
+
+def _span_durations(span, prefix=''):
+    for child in span.get('children', []):
+        path = prefix + child['name']
+        if child['duration'] is not None:
+            yield path, child['duration']
+        yield from _span_durations(child, path + '/')
+
+
+def _format(seconds):
+    if seconds is None:
+        return '?'
+    return str(datetime.timedelta(seconds=round(seconds)))
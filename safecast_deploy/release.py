@@ -0,0 +1,150 @@
+import contextvars
+import datetime
+import pprint
+import sys
+import threading
+
+from safecast_deploy import aws, get_clock, git_logger, new_env, same_env, state, timing
+
+APPS = ['api', 'ingest', 'reporting']
+
+
+def run_cli(args):
+    versions = {app: getattr(args, app) for app in APPS if getattr(args, app) is not None}
+    if not versions:
+        print("ERROR: Specify a version for at least one application.", file=sys.stderr)
+        exit(1)
+    Release(
+        args.env,
+        versions,
+        arn=args.arn,
+        max_parallel=args.max_parallel,
+        update_templates=not args.no_update_templates,
+        parallel_web=args.parallel_web,
+        drain_timeout=args.drain_timeout,
+    ).run()
+
+
+# Prefixes each line written to stderr with the app being deployed, so
+# output from concurrent deploys stays readable. The prefix is a context
+# variable, so the threads a deploy starts through the clock, such as its
+# event tailer and parallel worker rollout, inherit it; partial lines are
+# buffered per thread.
+class PrefixedStream:
+    def __init__(self, stream):
+        self._stream = stream
+        self._lock = threading.Lock()
+        self._prefix = contextvars.ContextVar('prefix', default=None)
+        self._local = threading.local()
+
+    def set_prefix(self, prefix):
+        self._prefix.set(prefix)
+
+    def write(self, text):
+        prefix = self._prefix.get()
+        if prefix is None:
+            return self._stream.write(text)
+        *lines, self._local.buffer = (getattr(self._local, 'buffer', '') + text).split('\n')
+        with self._lock:
+            for line in lines:
+                self._stream.write(f'[{prefix}] {line}\n')
+        return len(text)
+
+    def flush(self):
+        self._stream.flush()
+
+
+# Deploys several apps to the same environment at once. Each app still
+# deploys its worker before its web tier; only the apps run concurrently.
+class Release:
+    def __init__(self, env, versions, arn=None, max_parallel=3, update_templates=True, parallel_web=False, drain_timeout=900):
+        self.env = env
+        self.versions = versions
+        self.arn = arn
+        self.max_parallel = max_parallel
+        self.update_templates = update_templates
+        self.parallel_web = parallel_web
+        self.drain_timeout = drain_timeout
+        self._c = aws.client('elasticbeanstalk')
+
+    def run(self):
+        start_time = datetime.datetime.now(datetime.timezone.utc)
+        stderr = sys.stderr
+        sys.stderr = PrefixedStream(stderr)
+        try:
+            states = self._load_states()
+            with timing.span('release') as release_span, \
+                    get_clock().executor(self.max_parallel) as executor:
+                futures = {
+                    app: executor.submit(self._deploy_app, app, app_state, release_span) for app, app_state in states.items()
+                }
+            results = {}
+            failed = []
+            for app, future in futures.items():
+                try:
+                    results[app] = future.result()
+                except SystemExit:
+                    # The reason has already been printed by the failing step.
+                    failed.append(app)
+                except Exception as e:
+                    print(f"ERROR: Deploying {app} failed: {e!r}", file=stderr)
+                    failed.append(app)
+        finally:
+            sys.stderr = stderr
+        # Timings are recorded for the whole process, so keep one copy.
+        for app_result in results.values():
+            app_result.pop('timings', None)
+        completed_time = datetime.datetime.now(datetime.timezone.utc)
+        result = {
+            'apps': results,
+            'completed_at': completed_time,
+            'elapsed_time': (completed_time - start_time).total_seconds(),
+            'env': self.env,
+            'event': 'release',
+            'failed_apps': failed,
+            'started_at': start_time,
+            'timings': timing.recorder.to_dict(),
+        }
+        pprint.PrettyPrinter(stream=sys.stderr).pprint(result)
+        if results:
+            git_logger.log_result(result)
+        if failed:
+            print("Release failed for: " + ', '.join(failed), file=sys.stderr)
+            exit(1)
+        print("Release completed.", file=sys.stderr)
+
+    # Every app's version is looked up and checked before any app is
+    # deployed, so one bad version cannot leave the release half applied.
+    def _load_states(self):
+        with timing.span('load_states'), \
+                get_clock().executor(self.max_parallel) as executor:
+            futures = {app: executor.submit(self._load_state, app) for app in self.versions}
+        states = {}
+        invalid = []
+        for app, future in futures.items():
+            try:
+                states[app] = future.result()
+            except SystemExit:
+                # State has already printed why.
+                invalid.append(app)
+        if invalid:
+            print("ERROR: Nothing was deployed, since the release is invalid for: " + ', '.join(invalid), file=sys.stderr)
+            exit(1)
+        return states
+
+    def _load_state(self, app):
+        sys.stderr.set_prefix(app)
+        return state.State(
+            app,
+            self.env,
+            new_version=self.versions[app],
+            new_arn=self.arn,
+            eb_client=self._c,
+        )
+
+    def _deploy_app(self, app, app_state, parent_span):
+        sys.stderr.set_prefix(app)
+        with timing.span(app, parent_span):
+            if self.arn is None:
+                return same_env.SameEnv(app_state).deploy()
+            return new_env.NewEnv(app_state, self.update_templates, self.parallel_web, self.drain_timeout).deploy()
@@ -2,7 +2,8 @@ import datetime
 import pprint
 import sys
 
-from safecast_deploy import git_logger, verbose_sleep
+from safecast_deploy import cache, git_logger, timing
+from safecast_deploy.waiters import EventTailer, HealthWaiter
 
 
 class SameEnv:
@@ -11,25 +12,51 @@ class SameEnv:
         self._c = state.eb_client
 
     def run(self):
-        self.start_time = datetime.datetime.now(datetime.timezone.utc)
-        # Handle the worker environment first, to ensure that database
-        # migrations are applied
-        self._handle_worker()
-        self._handle_web()
-        result = self._generate_result()
+        result = self.deploy()
         self._print_result(result)
         git_logger.log_result(result)
 
+    def deploy(self):
+        self.start_time = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            with timing.span('same_env'), EventTailer(self._c, self.state.app, since=self.start_time) as self._events:
+                self._events.follow(*(self.state.env_metadata[self.state.subenvs[role]].name
+                                      for role in self.state.deployed_roles))
+                # Handle the worker environment first, to ensure that database
+                # migrations are applied
+                self._handle_worker()
+                self._handle_web()
+        finally:
+            # Even a deploy that stopped partway has changed environments.
+            cache.invalidate(self.state.app)
+        return self._generate_result()
+
+    # The steps deploy() would take, as (phase, description) pairs. Phases
+    # match the timing spans recorded by a real run.
+    def plan(self):
+        steps = []
+        for role, phase in [('wrk', 'worker'), ('web', 'web')]:
+            if role == 'wrk' and not self.state.has_worker:
+                continue
+            env_name = self.state.env_metadata[self.state.subenvs[role]].name
+            steps += [
+                (f'{phase}/update', f"update_environment {env_name} to {self.state.new_version}"),
+                (f'{phase}/wait_for_green', f"Wait for {env_name} to be Ready with Ok health"),
+            ]
+        return steps
+
     def _handle_worker(self):
         if self.state.has_worker:
-            print("Deploying to the worker.", file=sys.stderr)
-            env_name = self.state.env_metadata[self.state.subenvs['wrk']]['name']
-            self._update_environment(env_name)
+            with timing.span('worker'):
+                print("Deploying to the worker.", file=sys.stderr)
+                env_name = self.state.env_metadata[self.state.subenvs['wrk']].name
+                self._update_environment(env_name)
 
     def _handle_web(self):
-        print("Deploying to the web instances.", file=sys.stderr)
-        env_name = self.state.env_metadata[self.state.subenvs['web']]['name']
-        self._update_environment(env_name)
+        with timing.span('web'):
+            print("Deploying to the web instances.", file=sys.stderr)
+            env_name = self.state.env_metadata[self.state.subenvs['web']].name
+            self._update_environment(env_name)
 
     def _generate_result(self):
         completed_time = datetime.datetime.now(datetime.timezone.utc)
@@ -40,11 +67,12 @@ class SameEnv:
             'env': self.state.env,
             'event': 'same_env',
             'started_at': self.start_time,
+            'timings': timing.recorder.to_dict(),
             'web': {
-                'env': self.state.env_metadata[self.state.subenvs['web']]['name'],
+                'env': self.state.env_metadata[self.state.subenvs['web']].name,
                 'new_version': self.state.new_version,
                 'new_version_parsed': self.state.new_versions_parsed['web'],
-                'old_version': self.state.env_metadata[self.state.subenvs['web']]['version'],
+                'old_version': self.state.env_metadata[self.state.subenvs['web']].version,
                 'old_version_parsed': self.state.old_versions_parsed['web'],
             },
         }
@@ -52,10 +80,10 @@ class SameEnv:
 
         if self.state.has_worker:
             result['wrk'] = {
-                'env': self.state.env_metadata[self.state.subenvs['wrk']]['name'],
+                'env': self.state.env_metadata[self.state.subenvs['wrk']].name,
                 'new_version': self.state.new_version,
                 'new_version_parsed': self.state.new_versions_parsed['wrk'],
-                'old_version': self.state.env_metadata[self.state.subenvs['wrk']]['version'],
+                'old_version': self.state.env_metadata[self.state.subenvs['wrk']].version,
                 'old_version_parsed': self.state.old_versions_parsed['wrk'],
             }
             self._add_git('wrk', result)
@@ -68,12 +96,15 @@ class SameEnv:
             'ingest': 'ingest',
             'reporting': 'reporting',
         }
-        if 'git_commit' in self.state.old_versions_parsed[role] \
-           and 'git_commit' in self.state.new_versions_parsed[role]:
+        # Labels that are not CircleCI builds, such as `eb deploy` bundles,
+        # parse to None.
+        old_parsed = self.state.old_versions_parsed[role] or {}
+        new_parsed = self.state.new_versions_parsed[role] or {}
+        if 'git_commit' in old_parsed and 'git_commit' in new_parsed:
             result[role]['github_diff'] = 'https://github.com/Safecast/{}/compare/{}...{}'.format(
                 repo_names[self.state.app],
-                self.state.old_versions_parsed[role]['git_commit'],
-                self.state.new_versions_parsed[role]['git_commit']
+                old_parsed['git_commit'],
+                new_parsed['git_commit']
             )
 
     def _print_result(self, result):
@@ -81,27 +112,16 @@ class SameEnv:
         print("Deployment completed.", file=sys.stderr)
 
     def _update_environment(self, env_name):
-        self._c.update_environment(
-            ApplicationName=self.state.app,
-            EnvironmentName=env_name,
-            VersionLabel=self.state.new_version,
-        )
+        since = datetime.datetime.now(datetime.timezone.utc)
+        with timing.span('update'):
+            self._c.update_environment(
+                ApplicationName=self.state.app,
+                EnvironmentName=env_name,
+                VersionLabel=self.state.new_version,
+            )
         print("Waiting for instance health to return to normal.", file=sys.stderr)
-        self._wait_for_green(env_name)
+        self._wait_for_green(env_name, since)
 
-    def _wait_for_green(self, env_name):
-        verbose_sleep(70)
-        wait_seconds = 0
-        while wait_seconds < 1200:
-            health = self._c.describe_environment_health(
-                EnvironmentName=env_name,
-                AttributeNames=['HealthStatus', ]
-            )['HealthStatus']
-            if health == 'Ok':
-                print("Environment health has returned to normal.", file=sys.stderr)
-                return
-            verbose_sleep(40)
-            wait_seconds += 40
-        print("Environment health did not return to normal within 1200 seconds. Aborting further operations.",
-              file=sys.stderr)
-        exit(1)
+    def _wait_for_green(self, env_name, since):
+        with timing.span('wait_for_green'):
+            HealthWaiter(self._c, env_name, timeout=1200, since=since, tailer=self._events).wait()
@@ -1,7 +1,10 @@
-import boto3
 import os
 import pprint
+import subprocess
 import sys
+import threading
+
+from safecast_deploy import aws, cache, get_clock
 
 
 class Ssh:
@@ -11,19 +14,90 @@ class Ssh:
         self.select = args.select
 
     def run(self):
-        c = self.state.eb_client
-        ec2_c = boto3.client('ec2')
-        env_resources = c.describe_environment_resources(
-            EnvironmentName=self.state.env_metadata[self.state.subenvs[self.role]]['name'])['EnvironmentResources']
-        if self.select and len(env_resources['Instances']) > 1:
+        public_dns = self.resolve_public_dns()
+        print("Connecting to " + public_dns, file=sys.stderr)
+        os.execvp('ssh', ['ssh'] + ssh_options() + ['ec2-user@' + public_dns, ])
+
+    def resolve_public_dns(self):
+        hosts = resolve_hosts(self.state, self.role)
+        if self.select and len(hosts) > 1:
             choices = ''
-            for index, instance in enumerate(env_resources['Instances']):
-                choices += "{}) {}\n".format(index, instance['Id'])
+            for index, (instance_id, _) in enumerate(hosts):
+                choices += "{}) {}\n".format(index, instance_id)
             env_num = int(input("Select from below instances:\n" + choices))
         else:
             env_num = 0
-        instance_id = env_resources['Instances'][env_num]['Id']
-        instances = ec2_c.describe_instances(InstanceIds=[instance_id, ])
-        public_dns = instances['Reservations'][0]['Instances'][0]['PublicDnsName']
-        print("Connecting to " + public_dns, file=sys.stderr)
-        os.execvp('ssh', ['ssh', 'ec2-user@' + public_dns, ])
+        return hosts[env_num][1]
+
+
+# Returns (instance ID, public DNS name) pairs for every instance of the
+# environment, with a single describe_instances call. Both lookups are
+# cached briefly, so repeated connections make no AWS calls at all; use
+# --refresh if an instance has been replaced since.
+def resolve_hosts(state, role):
+    env_name = state.env_metadata[state.subenvs[role]].name
+    env_resources = cache.call(state.eb_client, 'describe_environment_resources', state.app,
+                               EnvironmentName=env_name)['EnvironmentResources']
+    instance_ids = [instance['Id'] for instance in env_resources['Instances']]
+    if not instance_ids:
+        return []
+    res = cache.call(aws.client('ec2'), 'describe_instances', state.app, InstanceIds=instance_ids)
+    public_dns = {
+        instance['InstanceId']: instance['PublicDnsName']
+        for reservation in res['Reservations']
+        for instance in reservation['Instances']
+    }
+    return [(instance_id, public_dns[instance_id]) for instance_id in instance_ids]
+
+
+# Shares one master connection per host between ssh invocations, and keeps
+# it open for a while afterwards, so reconnecting skips the handshake.
+def ssh_options():
+    control_dir = os.path.join(cache.cache_dir(), 'ssh')
+    os.makedirs(control_dir, mode=0o700, exist_ok=True)
+    return [
+        '-o', 'ControlMaster=auto',
+        '-o', 'ControlPath=' + os.path.join(control_dir, '%C'),
+        '-o', 'ControlPersist=10m',
+    ]
+
+
+# Runs one command on every instance of an environment, streaming each
+# line of output prefixed with the instance it came from.
+class Exec:
+    def __init__(self, state, args):
+        self.state = state
+        self.role = args.role
+        self.command = args.command
+        self.max_parallel = args.max_parallel
+        self._output_lock = threading.Lock()
+
+    def run(self):
+        hosts = resolve_hosts(self.state, self.role)
+        if not hosts:
+            print("ERROR: The environment has no instances.", file=sys.stderr)
+            exit(1)
+        print("Running `{}` on {} instances.".format(' '.join(self.command), len(hosts)), file=sys.stderr)
+        with get_clock().executor(self.max_parallel) as executor:
+            exit_codes = list(executor.map(self._run_on_host, hosts))
+        print("\nInstance             Public DNS                                          Exit code", file=sys.stderr)
+        for (instance_id, public_dns), exit_code in zip(hosts, exit_codes):
+            print(f"{instance_id:<20} {public_dns:<51} {exit_code}", file=sys.stderr)
+        failed = sum(1 for exit_code in exit_codes if exit_code != 0)
+        if failed:
+            print(f"The command failed on {failed} of {len(hosts)} instances.", file=sys.stderr)
+            exit(1)
+
+    def _run_on_host(self, host):
+        instance_id, public_dns = host
+        proc = subprocess.Popen(
+            ['ssh', '-o', 'BatchMode=yes'] + ssh_options() + ['ec2-user@' + public_dns, '--'] + self.command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        for line in proc.stdout:
+            with self._output_lock:
+                sys.stdout.write(f"[{instance_id}] " + line.decode('utf-8', errors='replace').rstrip('\n') + '\n')
+                sys.stdout.flush()
+        return proc.wait()
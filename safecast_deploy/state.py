@@ -1,15 +1,65 @@
-import boto3
 import re
 import sys
 
+from safecast_deploy import aws, cache, get_clock
+from safecast_deploy.versions import VersionCatalog, parse_version
 
+# Upper bound on concurrent AWS calls made while discovering metadata.
+MAX_WORKERS = 8
+
+
+class EnvRecord:
+    __slots__ = ('name', 'env_id', 'num', 'version', 'status', 'health', 'health_status', 'platform_arn', 'cname',
+                 'date_updated', '_resources', '_load_resources')
+
+    def __init__(self, api_env, num, load_resources):
+        self.name = api_env['EnvironmentName']
+        self.env_id = api_env['EnvironmentId']
+        self.num = num
+        self.version = api_env.get('VersionLabel')
+        self.status = api_env.get('Status')
+        self.health = api_env.get('Health')
+        self.health_status = api_env.get('HealthStatus')
+        self.platform_arn = api_env.get('PlatformArn')
+        self.cname = api_env.get('CNAME')
+        self.date_updated = api_env.get('DateUpdated')
+        self._resources = None
+        self._load_resources = load_resources
+
+    # Fetched from describe_environment_resources on first access only.
+    @property
+    def resources(self):
+        if self._resources is None:
+            self._resources = self._load_resources(self.name)
+        return self._resources
+
+    def to_dict(self):
+        return {
+            'cname': self.cname,
+            'date_updated': self.date_updated,
+            'env_id': self.env_id,
+            'health': self.health,
+            'health_status': self.health_status,
+            'name': self.name,
+            'num': self.num,
+            'platform_arn': self.platform_arn,
+            'resources': self._resources,
+            'status': self.status,
+            'version': self.version,
+        }
+
+
+# Everything beyond the constructor arguments is fetched from AWS the
+# first time it is needed and then kept, so commands only pay for the
+# metadata they actually use.
 class State:
     def __init__(
             self,
             app,
             env=None,
             new_version=None,
-            new_arn=None):
+            new_arn=None,
+            eb_client=None):
         self.app = app
         self.env = env
         self.new_version = new_version
@@ -20,89 +70,105 @@ class State:
             'wrk': '{}-wrk'.format(env),
         }
 
-        self.eb_client = boto3.client('elasticbeanstalk')
+        # Defaults to the client shared by the whole process.
+        self.eb_client = aws.client('elasticbeanstalk') if eb_client is None else eb_client
         self._c = self.eb_client
-        self._identify_current_envs()
-        self._classify_available_versions()
+        self._env_metadata = None
+        self._versions = None
+        self.old_versions_parsed = {}
+        self.new_versions_parsed = {}
         self._validate_version()
 
+    @property
+    def env_metadata(self):
+        if self._env_metadata is None:
+            self._env_metadata = self._identify_current_envs()
+        return self._env_metadata
+
+    @property
+    def has_worker(self):
+        return self.subenvs['wrk'] in self.env_metadata
+
+    @property
+    def deployed_roles(self):
+        return ['web', 'wrk'] if self.has_worker else ['web']
+
+    @property
+    def versions(self):
+        if self._versions is None:
+            self._versions = VersionCatalog(self._c, self.app)
+        return self._versions
+
+    @property
+    def available_versions(self):
+        return [v.label for v in self.versions.all() if not v.failed]
+
+    @property
+    def failed_versions(self):
+        return [v.label for v in self.versions.all() if v.failed]
+
+    def prefetch_resources(self):
+        with get_clock().executor(MAX_WORKERS) as executor:
+            # Reading the property in the pool memoizes each record's resources.
+            list(executor.map(lambda record: record.resources, self.env_metadata.values()))
+
     def _validate_version(self):
         if self.new_version is None:
             return
-        if self.new_version in self.failed_versions:
-            print("ERROR: New version is marked as 'failed' at AWS and cannot be deployed.", file=sys.stderr)
-            exit(1)
-        if self.new_version not in self.available_versions:
+        version = self.versions.lookup(self.new_version)
+        if version is None:
             print("ERROR: New version was not found at AWS.", file=sys.stderr)
             exit(1)
-        self.old_versions_parsed = {
-            'web': self._parse_version(self.env_metadata[self.subenvs['web']]['version'])
-        }
-        self.new_versions_parsed = {
-            'web': self._parse_version(self.new_version)
-        }
-        if self.has_worker:
-            self.old_versions_parsed['wrk'] = self._parse_version(self.env_metadata[self.subenvs['wrk']]['version'])
-            self.new_versions_parsed['wrk'] = self._parse_version(self.new_version)
+        if version.failed:
+            print("ERROR: New version is marked as 'failed' at AWS and cannot be deployed.", file=sys.stderr)
+            exit(1)
+        # Parsed before anything is deployed, so that writing the history
+        # entry afterwards cannot fail on them.
+        for role in self.deployed_roles:
+            self.old_versions_parsed[role] = self._parse_version(self.env_metadata[self.subenvs[role]].version)
+            self.new_versions_parsed[role] = self._parse_version(self.new_version)
 
     def _parse_version(self, version_str):
-        if version_str is None:
-            return
-        git_hash_pattern = re.compile(r'^(?P<app>(api|ingest|reporting))-(?P<clean_branch_name>.+)-(?P<build_num>\d+)-(?P<commit>[0-9a-f]{40})$')
-        no_git_hash_pattern = re.compile(r'^(?P<app>(api|ingest|reporting))-(?P<clean_branch_name>.+)-(?P<build_num>\d+)$')
-        git_match = git_hash_pattern.match(version_str)
-        no_git_match = no_git_hash_pattern.match(version_str)
-        if git_match:
-            match = git_match
-            parsed_version = {
-                'git_commit': match.group('commit')
-            }
-        elif no_git_match:
-            match = no_git_match
-            parsed_version = {}
-        # TODO: var is undefined if an `eb deploy` bundle is in use, would be good have a fallback for that case
-        parsed_version.update({
-            'app': match.group('app'),
-            'circleci_build_num': match.group('build_num'),
-            'clean_branch_name': match.group('clean_branch_name'),
-        })
+        parsed_version = parse_version(version_str)
+        if parsed_version is None and version_str is not None:
+            print(f"WARN: {version_str} is not a CircleCI build label, so the history entry will not link to its commit.",
+                  file=sys.stderr)
         return parsed_version
 
-    def _identify_current_envs(self):
-        api_envs = self._c.describe_environments(
-            ApplicationName=self.app, IncludeDeleted=False)['Environments']
+    # Every recognized environment of the app as (env, record) pairs, such
+    # as ('prd-wrk', record). Unlike env_metadata, an env may appear more
+    # than once, as it does while new_env is replacing it.
+    def discover_envs(self, use_cache=True):
+        kwargs = {
+            'ApplicationName': self.app,
+            'IncludeDeleted': False,
+        }
+        if use_cache:
+            api_envs = cache.call(self._c, 'describe_environments', self.app, **kwargs)['Environments']
+        else:
+            api_envs = self._c.describe_environments(**kwargs)['Environments']
         name_pattern = re.compile('safecast' + self.app + r'-(?P<env>(dev|dev-wrk|prd|prd-wrk))-(?P<num>\d{3})')
-        self.env_metadata = {}
+        envs = []
         for api_env in api_envs:
             match = name_pattern.fullmatch(api_env['EnvironmentName'])
             if match is None:
                 print('WARN: unrecognized environment ' + api_env['EnvironmentName'], file=sys.stderr)
                 continue
-            env = match.group('env')
-            if env in self.env_metadata:
+            envs.append((match.group('env'), EnvRecord(api_env, int(match.group('num')), self._describe_resources)))
+        return envs
+
+    def _identify_current_envs(self):
+        env_metadata = {}
+        for env, record in self.discover_envs():
+            if env in env_metadata:
                 print("More than one "
                       + env
                       + """ environment was found, which one is the current environment?\n
                       TODO implement this once it becomes a problem. Exiting.
                       """, file=sys.stderr)
                 exit(1)
-            self.env_metadata[match.group('env')] = {
-                'api_env': api_env,
-                'api_resources': self._c.describe_environment_resources(EnvironmentName=api_env['EnvironmentName'])['EnvironmentResources'],
-                'name': api_env['EnvironmentName'],
-                'num': int(match.group('num')),
-                'version': api_env['VersionLabel'],
-            }
-        self.has_worker = self.subenvs['wrk'] in self.env_metadata
-
-    def _classify_available_versions(self):
-        self.api_versions = sorted(
-            self._c.describe_application_versions(
-                ApplicationName=self.app
-            )['ApplicationVersions'],
-            key=lambda i: i['DateUpdated'],
-        )
-        self.available_versions = [o['VersionLabel'] for o in self.api_versions
-                                   if o['Status'] != 'FAILED']
-        self.failed_versions = [o['VersionLabel'] for o in self.api_versions
-                                if o['Status'] == 'FAILED']
+            env_metadata[env] = record
+        return env_metadata
+
+    def _describe_resources(self, env_name):
+        return self._c.describe_environment_resources(EnvironmentName=env_name)['EnvironmentResources']
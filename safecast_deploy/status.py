@@ -0,0 +1,86 @@
+import datetime
+import sys
+
+from safecast_deploy import aws, get_clock, state
+
+APPS = ['api', 'ingest', 'reporting']
+COLUMNS = ['app', 'env', 'name', 'version', 'status', 'health', 'instances', 'platform']
+
+
+def run_cli(args):
+    fleet = FleetStatus(APPS if args.app is None else [args.app])
+    fleet.refresh()
+    fleet.print_table()
+    if args.watch is None:
+        return
+    try:
+        while True:
+            get_clock().sleep(args.watch)
+            changed = fleet.refresh()
+            if changed:
+                fleet.print_table(changed)
+            else:
+                print(f"{datetime.datetime.now().strftime('%H:%M:%S')} No changes.", file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+
+
+# Health, version, platform and instance count of every environment of
+# the given apps. Refreshing re-describes the environments, which is one
+# call per app, but only counts the instances of environments that have
+# changed or are still in the middle of a change.
+class FleetStatus:
+    def __init__(self, apps):
+        eb_client = aws.client('elasticbeanstalk')
+        self.states = [state.State(app, eb_client=eb_client) for app in apps]
+        self.rows = {}
+        self._instances = {}
+
+    # Returns the names of the environments that changed.
+    def refresh(self):
+        with get_clock().executor(state.MAX_WORKERS) as executor:
+            discovered = list(executor.map(lambda app_state: app_state.discover_envs(use_cache=False), self.states))
+            records = {}
+            for app_state, envs in zip(self.states, discovered):
+                for env, record in envs:
+                    records[record.name] = (app_state.app, env, record)
+            stale = [
+                record for _, _, record in records.values()
+                if record.status != 'Ready' or self._instances.get(record.name, (None,))[0] != record.date_updated
+            ]
+            counts = executor.map(lambda record: len(record.resources['Instances']), stale)
+            for record, count in zip(stale, counts):
+                self._instances[record.name] = (record.date_updated, count)
+        rows = {
+            name: {
+                'app': app,
+                'env': env,
+                'name': name,
+                'version': record.version or '',
+                'status': record.status or '',
+                'health': '/'.join(h for h in (record.health, record.health_status) if h),
+                'instances': str(self._instances[name][1]),
+                'platform': (record.platform_arn or '').split('platform/')[-1],
+            }
+            for name, (app, env, record) in sorted(records.items(), key=lambda item: (item[1][0], item[1][1], item[0]))
+        }
+        for name in list(self._instances):
+            if name not in rows:
+                del self._instances[name]
+        changed = {name for name in rows.keys() | self.rows.keys() if rows.get(name) != self.rows.get(name)}
+        self.rows = rows
+        return changed
+
+    # Marks changed environments with a '*'; environments that are gone
+    # are listed after the table.
+    def print_table(self, changed=()):
+        widths = {
+            column: max([len(column)] + [len(row[column]) for row in self.rows.values()]) for column in COLUMNS
+        }
+        print(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        print('  ' + '  '.join(column.upper().ljust(widths[column]) for column in COLUMNS).rstrip())
+        for name, row in self.rows.items():
+            marker = '* ' if name in changed else '  '
+            print(marker + '  '.join(row[column].ljust(widths[column]) for column in COLUMNS).rstrip())
+        for name in sorted(set(changed) - self.rows.keys()):
+            print(f"- {name} is gone")
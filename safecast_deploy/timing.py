@@ -0,0 +1,162 @@
+import contextlib
+import json
+import threading
+
+from safecast_deploy import get_clock
+
+
+class Span:
+    __slots__ = ('name', 'start', 'end', 'thread_id', 'children')
+
+    def __init__(self, name, start, thread_id):
+        self.name = name
+        self.start = start
+        self.end = None
+        self.thread_id = thread_id
+        self.children = []
+
+    def to_dict(self, origin):
+        span = {
+            'name': self.name,
+            'offset': round(self.start - origin, 3),
+            'duration': None if self.end is None else round(self.end - self.start, 3),
+        }
+        if self.children:
+            span['children'] = [child.to_dict(origin) for child in self.children]
+        return span
+
+    def copy(self):
+        span = Span(self.name, self.start, self.thread_id)
+        span.end = self.end
+        span.children = [child.copy() for child in self.children]
+        return span
+
+
+# Records nested phase timings and per-operation AWS call statistics for
+# the current command. Spans nest per thread; work handed to another
+# thread passes its parent span explicitly.
+class Recorder:
+    def __init__(self):
+        # Spans keep the clock they started with, so they stay consistent
+        # if the tests swap the clock afterwards.
+        self.clock = get_clock()
+        self.origin = self.clock.monotonic()
+        self.roots = []
+        self.aws_calls = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def span(self, name, parent=None):
+        stack = self._stack()
+        if parent is None and stack:
+            parent = stack[-1]
+        span = Span(name, self.clock.monotonic(), threading.get_ident())
+        with self._lock:
+            (self.roots if parent is None else parent.children).append(span)
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            span.end = self.clock.monotonic()
+            stack.pop()
+
+    # seconds includes the time spent waiting for the rate limit and
+    # between retries.
+    def record_call(self, operation, seconds, retries=0, throttles=0):
+        with self._lock:
+            stats = self.aws_calls.setdefault(operation, {
+                'calls': 0, 'retries': 0, 'throttles': 0, 'total_seconds': 0.0, 'max_seconds': 0.0,
+            })
+            stats['calls'] += 1
+            stats['retries'] += retries
+            stats['throttles'] += throttles
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    # Copies of the spans and AWS call statistics recorded so far, taken
+    # at once, for reports made while other threads may still record.
+    def snapshot(self):
+        with self._lock:
+            return (
+                [span.copy() for span in self.roots],
+                {operation: dict(stats) for operation, stats in self.aws_calls.items()},
+            )
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'aws_calls': {
+                    operation: {
+                        'calls': stats['calls'],
+                        'max_seconds': round(stats['max_seconds'], 3),
+                        'retries': stats['retries'],
+                        'throttles': stats['throttles'],
+                        'total_seconds': round(stats['total_seconds'], 3),
+                    }
+                    for operation, stats in sorted(self.aws_calls.items())
+                },
+                'spans': [span.to_dict(self.origin) for span in self.roots],
+            }
+
+    # Prints one line per AWS operation, busiest first, and a total.
+    def print_aws_calls(self, file):
+        with self._lock:
+            rows = sorted(self.aws_calls.items(), key=lambda item: (-item[1]['total_seconds'], item[0]))
+            rows = [(operation, dict(stats)) for operation, stats in rows]
+        header = '{:<40} {:>6} {:>8} {:>10} {:>10} {:>10} {:>10}'
+        line = '{:<40} {:>6} {:>8} {:>10} {:>10.3f} {:>10.3f} {:>10.3f}'
+        print(header.format('operation', 'calls', 'retries', 'throttles', 'total_s', 'mean_s', 'max_s'), file=file)
+        totals = {'calls': 0, 'retries': 0, 'throttles': 0, 'total_seconds': 0.0, 'max_seconds': 0.0}
+        for operation, stats in rows:
+            print(line.format(operation, stats['calls'], stats['retries'], stats['throttles'], stats['total_seconds'],
+                              stats['total_seconds'] / stats['calls'], stats['max_seconds']), file=file)
+            for key in ('calls', 'retries', 'throttles', 'total_seconds'):
+                totals[key] += stats[key]
+            totals['max_seconds'] = max(totals['max_seconds'], stats['max_seconds'])
+        print(line.format('total', totals['calls'], totals['retries'], totals['throttles'], totals['total_seconds'],
+                          totals['total_seconds'] / max(totals['calls'], 1), totals['max_seconds']), file=file)
+
+    # Writes the spans in the Chrome trace event format, which can be
+    # opened in chrome://tracing or https://ui.perfetto.dev.
+    def write_chrome_trace(self, path):
+        events = []
+
+        def add(span):
+            end = span.end if span.end is not None else self.clock.monotonic()
+            events.append({
+                'name': span.name,
+                'ph': 'X',
+                'pid': 1,
+                'tid': span.thread_id,
+                'ts': int((span.start - self.origin) * 1e6),
+                'dur': int((end - span.start) * 1e6),
+            })
+            for child in span.children:
+                add(child)
+
+        with self._lock:
+            for root in self.roots:
+                add(root)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def current(self):
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+
+recorder = Recorder()
+
+
+def span(name, parent=None):
+    return recorder.span(name, parent)
+
+
+def current_span():
+    return recorder.current()
@@ -0,0 +1,171 @@
+import datetime
+import sys
+import threading
+
+from safecast_deploy import aws, cache, get_clock, git_logger, state
+
+APPS = ['api', 'ingest', 'reporting']
+ENVS = ['dev', 'prd']
+
+
+def run_cli(args):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    eb_client = aws.client('elasticbeanstalk')
+    collectors = [
+        VersionCollector(
+            state.State(app, eb_client=eb_client),
+            keep_per_branch=args.keep,
+            keep_since=now - datetime.timedelta(days=args.keep_days),
+            deployed_since=now - datetime.timedelta(days=args.deployed_days),
+        )
+        for app in (APPS if args.app is None else [args.app])
+    ]
+    # Every app is planned before any version is deleted, so a missing
+    # history stops the whole run rather than the apps after the first.
+    plans = [collector.plan() for collector in collectors]
+    problems = [collector.history_problem for collector in collectors if collector.history_problem is not None]
+    if problems and not args.dry_run and not args.ignore_history:
+        for problem in problems:
+            print(f"ERROR: {problem}.", file=sys.stderr)
+        print("Recently deployed versions cannot be protected, so nothing was deleted. "
+              + "Pass --ignore-history to delete anyway.", file=sys.stderr)
+        exit(1)
+    failed = False
+    for collector, plan in zip(collectors, plans):
+        failed |= not collector.run(plan, dry_run=args.dry_run, max_parallel=args.max_parallel, rate=args.rate)
+    if failed:
+        exit(1)
+
+
+# Spaces out calls made from several threads to at most `rate` a second.
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next = None
+        self._lock = threading.Lock()
+
+    def wait(self):
+        clock = get_clock()
+        with self._lock:
+            now = clock.monotonic()
+            start = now if self._next is None else max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            clock.sleep(start - now)
+
+
+# Deletes the application versions of one app that no retention rule keeps:
+# the newest `keep_per_branch` of each branch, anything updated since
+# `keep_since`, whatever is running now, and anything deployed to or
+# replaced in an environment since `deployed_since`. The last rule needs
+# the deployment history; plan() sets history_problem when it could not
+# be read.
+class VersionCollector:
+    def __init__(self, state, keep_per_branch, keep_since, deployed_since):
+        self.state = state
+        self.keep_per_branch = keep_per_branch
+        self.keep_since = keep_since
+        self.deployed_since = deployed_since
+        self.history_problem = None
+        self._c = state.eb_client
+
+    # Carries out a plan() and returns whether every deletion succeeded.
+    def run(self, plan, dry_run=False, max_parallel=4, rate=5):
+        app = self.state.app
+        keep, delete = plan
+        reasons = {}
+        for reason in keep.values():
+            reasons[reason] = reasons.get(reason, 0) + 1
+        print(f"{app}: keeping {len(keep)} versions ("
+              + ', '.join(f"{count} {reason}" for reason, count in sorted(reasons.items()))
+              + f"), {'would delete' if dry_run else 'deleting'} {len(delete)}.", file=sys.stderr)
+        if self.history_problem is not None:
+            print(f"WARN: {self.history_problem}; recently deployed versions may not be protected.", file=sys.stderr)
+        if dry_run:
+            for version in delete:
+                print(f"  {version.label}  {version.date_updated.isoformat()}  {version.status}")
+            return True
+        limiter = RateLimiter(rate)
+        errors = []
+
+        def delete_version(version):
+            limiter.wait()
+            try:
+                self._c.delete_application_version(ApplicationName=app, VersionLabel=version.label)
+            except Exception as e:
+                errors.append((version.label, e))
+                print(f"ERROR: Could not delete {version.label}: {e}", file=sys.stderr)
+            else:
+                print(f"Deleted {version.label}", file=sys.stderr)
+
+        with get_clock().executor(max_parallel) as executor:
+            list(executor.map(delete_version, delete))
+        cache.invalidate(app)
+        if errors:
+            print(f"{app}: {len(errors)} of {len(delete)} deletions failed.", file=sys.stderr)
+        return not errors
+
+    # Returns ({label: reason kept}, [versions to delete, oldest first]).
+    def plan(self):
+        keep = {}
+        for label in self._deployed_labels():
+            keep[label] = 'deployed now'
+        for label in self._recently_deployed_labels():
+            keep.setdefault(label, 'recently deployed')
+        by_branch = {}
+        for version in self.state.versions.all():
+            by_branch.setdefault(version.branch, []).append(version)
+            if version.date_updated >= self.keep_since:
+                keep.setdefault(version.label, 'recently updated')
+        for versions in by_branch.values():
+            # Failed builds do not take up one of a branch's slots.
+            if self.keep_per_branch > 0:
+                for version in [v for v in versions if not v.failed][-self.keep_per_branch:]:
+                    keep.setdefault(version.label, 'newest on their branch')
+        keep = {label: reason for label, reason in keep.items() if label in self.state.versions.by_label}
+        delete = [version for version in self.state.versions.all() if version.label not in keep]
+        return keep, delete
+
+    def _deployed_labels(self):
+        return {record.version for record in self.state.env_metadata.values()}
+
+    def _recently_deployed_labels(self):
+        import git
+        app = self.state.app
+        labels = set()
+        found = False
+        with git_logger.history_lock():
+            try:
+                git_logger.open_mirror()
+            except git.GitCommandError as e:
+                # The local copy may miss recent deploys, but still helps a dry run.
+                self.history_problem = f"Could not update the deployment history ({e})"
+            entries = []
+            for env in ENVS:
+                entries += git_logger.read_history(app, env)
+                entries += git_logger.read_history('release', env)
+            # Entries not pushed yet are the most recent of all.
+            entries += git_logger.read_spool()
+        for entry in app_entries(app, entries):
+            found = True
+            completed_at = datetime.datetime.fromisoformat(entry['completed_at'])
+            if completed_at < self.deployed_since:
+                continue
+            for role in ('web', 'wrk'):
+                if role in entry:
+                    labels.update(entry[role].get(key) for key in ('new_version', 'old_version'))
+        if not found and self.history_problem is None:
+            self.history_problem = f"No deployment history found for {app}"
+        labels.discard(None)
+        return labels
+
+
+# The entries of one app's deploys, including those that were part of a
+# release.
+def app_entries(app, entries):
+    for entry in entries:
+        if entry.get('event') == 'release':
+            if app in entry.get('apps', {}):
+                yield entry['apps'][app]
+        elif entry.get('app') == app:
+            yield entry
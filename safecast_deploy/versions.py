@@ -0,0 +1,138 @@
+import functools
+import re
+
+from safecast_deploy import cache
+
+GIT_HASH_PATTERN = re.compile(
+    r'^(?P<app>(api|ingest|reporting))-(?P<clean_branch_name>.+)-(?P<build_num>\d+)-(?P<commit>[0-9a-f]{40})$')
+NO_GIT_HASH_PATTERN = re.compile(r'^(?P<app>(api|ingest|reporting))-(?P<clean_branch_name>.+)-(?P<build_num>\d+)$')
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse(version_str):
+    match = GIT_HASH_PATTERN.match(version_str)
+    if match:
+        parsed_version = {
+            'git_commit': match.group('commit')
+        }
+    else:
+        match = NO_GIT_HASH_PATTERN.match(version_str)
+        parsed_version = {}
+    # TODO: an `eb deploy` bundle has no recognizable label, would be good to have a fallback for that case
+    if match is None:
+        return None
+    parsed_version.update({
+        'app': match.group('app'),
+        'circleci_build_num': match.group('build_num'),
+        'clean_branch_name': match.group('clean_branch_name'),
+    })
+    return parsed_version
+
+
+def parse_version(version_str):
+    if version_str is None:
+        return
+    parsed_version = _parse(version_str)
+    # Copy, since callers embed the result in history entries.
+    return None if parsed_version is None else dict(parsed_version)
+
+
+class AppVersion:
+    __slots__ = ('label', 'status', 'date_updated', 'parsed')
+
+    def __init__(self, api_version):
+        self.label = api_version['VersionLabel']
+        self.status = api_version['Status']
+        self.date_updated = api_version['DateUpdated']
+        self.parsed = _parse(self.label)
+
+    @property
+    def failed(self):
+        return self.status == 'FAILED'
+
+    @property
+    def branch(self):
+        return None if self.parsed is None else self.parsed['clean_branch_name']
+
+    @property
+    def build_num(self):
+        return None if self.parsed is None else int(self.parsed['circleci_build_num'])
+
+
+# Streams every page of describe_application_versions, indexing versions
+# by label, branch and CircleCI build number as they arrive. Lookups only
+# read as many pages as they need to.
+class VersionCatalog:
+    PAGE_SIZE = 1000
+
+    def __init__(self, eb_client, app):
+        self._c = eb_client
+        self.app = app
+        self.by_label = {}
+        self.by_branch = {}
+        self.by_build = {}
+        self._pages = self._iter_pages()
+        self._complete = False
+
+    def __iter__(self):
+        yield from list(self.by_label.values())
+        while self._load_next_page():
+            yield from self._last_page
+
+    def __contains__(self, label):
+        return self.lookup(label) is not None
+
+    def lookup(self, label):
+        while label not in self.by_label and self._load_next_page():
+            pass
+        return self.by_label.get(label)
+
+    def all(self):
+        self._load_all()
+        return sorted(self.by_label.values(), key=lambda v: v.date_updated)
+
+    def filter(self, branch=None, since=None, limit=None, include_failed=False):
+        self._load_all()
+        if branch is None:
+            candidates = self.by_label.values()
+        else:
+            candidates = self.by_branch.get(branch, [])
+        matches = sorted(
+            (v for v in candidates
+             if (include_failed or not v.failed) and (since is None or v.date_updated >= since)),
+            key=lambda v: v.date_updated)
+        if limit is not None:
+            matches = matches[-limit:] if limit > 0 else []
+        return matches
+
+    def _load_all(self):
+        while self._load_next_page():
+            pass
+
+    def _load_next_page(self):
+        if self._complete:
+            return False
+        try:
+            page = next(self._pages)
+        except StopIteration:
+            self._complete = True
+            return False
+        self._last_page = [AppVersion(api_version) for api_version in page]
+        for version in self._last_page:
+            self.by_label[version.label] = version
+            if version.parsed is not None:
+                self.by_branch.setdefault(version.branch, []).append(version)
+                self.by_build.setdefault(version.build_num, []).append(version)
+        return True
+
+    def _iter_pages(self):
+        kwargs = {
+            'ApplicationName': self.app,
+            'MaxRecords': self.PAGE_SIZE,
+        }
+        while True:
+            res = cache.call(self._c, 'describe_application_versions', self.app, **kwargs)
+            yield res['ApplicationVersions']
+            if not res.get('NextToken'):
+                return
+            kwargs['NextToken'] = res['NextToken']
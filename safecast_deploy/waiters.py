@@ -0,0 +1,273 @@
+import abc
+import datetime
+import sys
+import threading
+
+from safecast_deploy import get_clock
+
+FAILURE_SEVERITIES = ('ERROR', 'FATAL')
+
+
+# Tails describe_events for one environment, or for every environment of
+# an application, only asking for events at or after the newest one
+# already seen.
+class EventCursor:
+    def __init__(self, eb_client, env_name=None, since=None, app=None):
+        self._c = eb_client
+        self.env_name = env_name
+        self.app = app
+        if since is None:
+            since = datetime.datetime.now(datetime.timezone.utc)
+        self._start_time = since
+        self._seen = set()
+
+    def poll(self):
+        kwargs = {
+            'StartTime': self._start_time,
+        }
+        if self.env_name is not None:
+            kwargs['EnvironmentName'] = self.env_name
+        if self.app is not None:
+            kwargs['ApplicationName'] = self.app
+        events = []
+        while True:
+            res = self._c.describe_events(**kwargs)
+            events.extend(res['Events'])
+            if 'NextToken' not in res:
+                break
+            kwargs['NextToken'] = res['NextToken']
+        new_events = []
+        for event in sorted(events, key=lambda e: e['EventDate']):
+            key = (event['EventDate'], event['Message'])
+            if key in self._seen:
+                continue
+            self._seen.add(key)
+            new_events.append(event)
+        if new_events:
+            # StartTime is inclusive, so events sharing the newest
+            # timestamp come back once more and are dropped above.
+            self._start_time = new_events[-1]['EventDate']
+        return new_events
+
+
+# Follows the events of one application in a background thread, printing
+# those of the environments being changed as they arrive, including
+# between waits. Waiters watching an environment are woken as soon as an
+# error event for it arrives, rather than at their next health poll.
+class EventTailer:
+    def __init__(self, eb_client, app, since=None, initial_interval=5, max_interval=20, backoff=1.5):
+        self._cursor = EventCursor(eb_client, since=since, app=app)
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self._followed = set()
+        self._failures = []
+        self._watches = []
+        self._cancel_reason = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._name = f'events-{app}'
+        self._done = None
+
+    def __enter__(self):
+        self._done = get_clock().start(self._run, self._name)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._done.result()
+
+    def follow(self, *env_names):
+        with self._lock:
+            self._followed.update(env_names)
+
+    def watch(self, env_name, since):
+        watch = Watch(env_name, since)
+        with self._lock:
+            self._followed.add(env_name)
+            self._watches.append(watch)
+            failures = list(self._failures)
+            cancel_reason = self._cancel_reason
+        # Errors may have arrived before the waiter started watching.
+        for event in failures:
+            watch.notify(event)
+        if cancel_reason is not None:
+            watch.cancel(cancel_reason)
+        return watch
+
+    # Fails every wait using this tailer, now and later, for when one part
+    # of a deploy fails and the others should stop waiting.
+    def cancel(self, reason):
+        with self._lock:
+            self._cancel_reason = reason
+            watches = list(self._watches)
+        for watch in watches:
+            watch.cancel(reason)
+
+    # Returns the number of new events.
+    def poll(self):
+        try:
+            events = self._cursor.poll()
+        except Exception as e:
+            # The waiters still poll health, so a missed poll is harmless.
+            print(f"WARN: could not fetch Elastic Beanstalk events: {e}", file=sys.stderr)
+            return 0
+        with self._lock:
+            followed = set(self._followed)
+            watches = list(self._watches)
+            self._failures.extend(e for e in events if e['Severity'] in FAILURE_SEVERITIES)
+        for event in events:
+            if event.get('EnvironmentName') not in followed:
+                continue
+            print_event(event)
+            for watch in watches:
+                watch.notify(event)
+        return len(events)
+
+    # Polls often while events are arriving and backs off while it is quiet.
+    def _run(self):
+        clock = get_clock()
+        interval = self.initial_interval
+        while not clock.wait(self._stop, interval):
+            if self.poll():
+                interval = self.initial_interval
+            else:
+                interval = min(interval * self.backoff, self.max_interval)
+
+
+class Watch:
+    def __init__(self, env_name, since):
+        self.env_name = env_name
+        self.since = since
+        self.failure = None
+        self.reason = None
+        self.failed = threading.Event()
+
+    def notify(self, event):
+        if (event['Severity'] in FAILURE_SEVERITIES and event.get('EnvironmentName') == self.env_name
+                and (self.since is None or event['EventDate'] >= self.since) and self.failure is None):
+            self.failure = event
+            self._fail(f"Elastic Beanstalk reported an error for {self.env_name}.")
+
+    def cancel(self, reason):
+        self._fail(f"Stopped waiting for {self.env_name}: {reason}")
+
+    def _fail(self, reason):
+        if self.reason is None:
+            self.reason = reason
+            self.failed.set()
+
+
+# Polls quickly right after a change and backs off towards max_interval,
+# returning as soon as _check reports the environment has settled. Error
+# events fail the wait immediately rather than waiting for the timeout;
+# with a tailer, they and EventTailer.cancel also cut a sleep between
+# polls short.
+class Waiter(abc.ABC):
+    timeout_message = "Environment {env_name} did not settle within {timeout} seconds."
+
+    def __init__(
+            self,
+            eb_client,
+            env_name,
+            timeout,
+            since=None,
+            initial_interval=5,
+            max_interval=30,
+            backoff=1.5,
+            tailer=None):
+        self._c = eb_client
+        self.env_name = env_name
+        self.timeout = timeout
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        if tailer is None:
+            self._events = EventCursor(eb_client, env_name, since)
+            self._watch = None
+        else:
+            self._events = None
+            self._watch = tailer.watch(env_name, since)
+
+    def wait(self):
+        clock = get_clock()
+        deadline = clock.monotonic() + self.timeout
+        interval = self.initial_interval
+        while True:
+            self._check_events()
+            done, description = self._check()
+            if done:
+                return
+            remaining = deadline - clock.monotonic()
+            if remaining <= 0:
+                self._fail(self.timeout_message.format(env_name=self.env_name, timeout=self.timeout))
+            delay = min(interval, remaining)
+            print(f"{description}; checking again in {delay:.0f} seconds.", file=sys.stderr)
+            if self._watch is None:
+                clock.sleep(delay)
+            else:
+                clock.wait(self._watch.failed, delay)
+            interval = min(interval * self.backoff, self.max_interval)
+
+    # Returns (done, description of the current state).
+    @abc.abstractmethod
+    def _check(self):
+        pass
+
+    def _status(self):
+        return self._c.describe_environment_health(
+            EnvironmentName=self.env_name,
+            AttributeNames=['Status', 'HealthStatus', ]
+        )
+
+    def _check_events(self):
+        if self._watch is not None:
+            if self._watch.reason is not None:
+                self._fail(self._watch.reason)
+            return
+        for event in self._events.poll():
+            print_event(event)
+            if event['Severity'] in FAILURE_SEVERITIES:
+                self._fail(f"Elastic Beanstalk reported an error for {self.env_name}.")
+
+    def _fail(self, message):
+        print(message + " Aborting further operations.", file=sys.stderr)
+        exit(1)
+
+
+class HealthWaiter(Waiter):
+    timeout_message = "Environment health did not return to normal within {timeout} seconds."
+
+    def _check(self):
+        health = self._status()
+        status = health.get('Status')
+        health_status = health.get('HealthStatus')
+        if status == 'Ready' and health_status == 'Ok':
+            print("Environment health has returned to normal.", file=sys.stderr)
+            return True, None
+        if status in ('Terminating', 'Terminated'):
+            self._fail(f"Environment {self.env_name} is {status}.")
+        return False, f"Environment {self.env_name} is {status} with health {health_status}"
+
+
+# Waits for an environment whose Auto Scaling group was set to zero to
+# finish the update and have no instances left.
+class DrainWaiter(Waiter):
+    timeout_message = "Environment {env_name} still had running instances after {timeout} seconds."
+
+    def _check(self):
+        status = self._status().get('Status')
+        instances = self._c.describe_environment_resources(
+            EnvironmentName=self.env_name)['EnvironmentResources']['Instances']
+        if status == 'Ready' and not instances:
+            print(f"Environment {self.env_name} has no instances left.", file=sys.stderr)
+            return True, None
+        return False, f"Environment {self.env_name} is {status} with {len(instances)} instances"
+
+
+def print_event(event):
+    print("{} {} {}: {}".format(
+        event['EventDate'].isoformat(),
+        event['Severity'],
+        event.get('EnvironmentName', ''),
+        event['Message']), file=sys.stderr)
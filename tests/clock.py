@@ -0,0 +1,188 @@
+import concurrent.futures
+import contextvars
+import functools
+import itertools
+import threading
+
+# Real seconds a sleeper waits to be woken before giving up, which only
+# happens when a participant blocks on something other than the clock.
+STALL_SECONDS = 30
+# The wall-clock time at which a clock starts: 2020-01-01T00:00:00Z.
+EPOCH = 1577836800.0
+
+
+# A clock whose time only moves when every participant is waiting on it.
+# The participants are the thread that created the clock and the threads
+# started through its executor() and start(); each holds a turn to run,
+# gives it up while it sleeps, waits on an event or waits for one of the
+# clock's futures, and hands it on when it finishes. Once no turn is held,
+# the clock wakes one sleeper: one whose event was set first, otherwise
+# the earliest due, moving time up to it. Threads woken at the same
+# moment therefore run one after the other, in the order they went to
+# sleep, so simulated deploys take as long as their logic dictates. Like
+# the system clock's, its threads run in a copy of their starter's context.
+class DeterministicClock:
+    def __init__(self, start=0.0):
+        self._now = start
+        self._cond = threading.Condition()
+        # The creating thread holds the first turn.
+        self._running = 1
+        # Sleeping threads, by ident, as (wake-up time, order, event or None).
+        self._sleepers = {}
+        self._order = itertools.count()
+
+    def monotonic(self):
+        with self._cond:
+            return self._now
+
+    def time(self):
+        return EPOCH + self.monotonic()
+
+    def sleep(self, secs):
+        self._block(secs, None)
+
+    def wait(self, event, secs):
+        return self._block(secs, event)
+
+    def executor(self, max_workers):
+        return ClockExecutor(self, max_workers)
+
+    def start(self, function, name):
+        future = ClockFuture(self)
+        self._spawn()
+        function = functools.partial(contextvars.copy_context().run, function)
+        threading.Thread(target=self._run, args=(future, function), name=name, daemon=True).start()
+        return future
+
+    def _block(self, secs, event):
+        ident = threading.get_ident()
+        with self._cond:
+            if event is not None and event.is_set():
+                return True
+            self._sleepers[ident] = (self._now + max(secs, 0), next(self._order), event)
+            self._yield()
+            # Whoever wakes a sleeper gives it a turn and removes it.
+            while ident in self._sleepers:
+                if not self._cond.wait(STALL_SECONDS):
+                    raise RuntimeError("The clock stalled: a participant is blocked outside the clock.")
+        return None if event is None else event.is_set()
+
+    # Called with the condition held by a participant giving up its turn.
+    def _yield(self):
+        self._running -= 1
+        if self._running > 0:
+            return
+        if not self._sleepers:
+            raise RuntimeError("Every participant is waiting for another, and none for the clock.")
+        ident = min(self._sleepers, key=self._wake_order)
+        wake_at, _, event = self._sleepers.pop(ident)
+        if event is None or not event.is_set():
+            self._now = max(self._now, wake_at)
+        self._running += 1
+        self._cond.notify_all()
+
+    def _wake_order(self, ident):
+        wake_at, order, event = self._sleepers[ident]
+        return (event is None or not event.is_set(), wake_at, order)
+
+    def _spawn(self):
+        with self._cond:
+            self._running += 1
+
+    # Gives up the calling thread's turn until future is done.
+    def _await(self, future):
+        with self._cond:
+            if future.done():
+                return
+            future.clock_waiters += 1
+            self._yield()
+
+    # Runs function with a turn the caller already took, then passes a
+    # turn to every thread waiting for its future.
+    def _run(self, future, function):
+        try:
+            settle(future, function)
+        finally:
+            self._finish(future)
+
+    def _finish(self, future, keep_turn=False):
+        with self._cond:
+            self._running += future.clock_waiters
+            future.clock_waiters = 0
+            if not keep_turn:
+                self._yield()
+
+
+def settle(future, function):
+    if not future.set_running_or_notify_cancel():
+        return
+    try:
+        result = function()
+    except BaseException as e:
+        future.set_exception(e)
+    else:
+        future.set_result(result)
+
+
+class ClockFuture(concurrent.futures.Future):
+    def __init__(self, clock):
+        super().__init__()
+        self._clock = clock
+        self.clock_waiters = 0
+
+    def result(self, timeout=None):
+        self._clock._await(self)
+        return super().result(timeout)
+
+    def exception(self, timeout=None):
+        self._clock._await(self)
+        return super().exception(timeout)
+
+
+# Runs up to max_workers tasks at once, each in a participant thread. A
+# queued task takes over the thread, and the turn, of the task before it,
+# so waiting in the queue does not hold time back.
+class ClockExecutor(concurrent.futures.Executor):
+    def __init__(self, clock, max_workers):
+        self._clock = clock
+        self._max_workers = max_workers
+        self._active = 0
+        self._queue = []
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = ClockFuture(self._clock)
+        task = (future, functools.partial(contextvars.copy_context().run, fn, *args, **kwargs))
+        with self._lock:
+            self._futures.append(future)
+            if self._active == self._max_workers:
+                self._queue.append(task)
+                return future
+            self._active += 1
+        self._clock._spawn()
+        threading.Thread(target=self._work, args=(task,), daemon=True).start()
+        return future
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._lock:
+            futures = list(self._futures)
+        if cancel_futures:
+            for future in futures:
+                future.cancel()
+        if wait:
+            for future in futures:
+                self._clock._await(future)
+                concurrent.futures.wait([future])
+
+    def _work(self, task):
+        while task is not None:
+            future, function = task
+            try:
+                settle(future, function)
+            finally:
+                with self._lock:
+                    task = self._queue.pop(0) if self._queue else None
+                    if task is None:
+                        self._active -= 1
+                self._clock._finish(future, keep_turn=task is not None)
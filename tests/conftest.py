@@ -0,0 +1,59 @@
+import subprocess
+
+import pytest
+
+import safecast_deploy
+from safecast_deploy import aws, cache, git_logger, timing
+
+from clock import DeterministicClock
+from fake_aws import FakeAws
+
+
+@pytest.fixture
+def clock():
+    clock = DeterministicClock()
+    previous_clock = safecast_deploy.get_clock()
+    safecast_deploy.set_clock(clock)
+    try:
+        yield clock
+    finally:
+        safecast_deploy.set_clock(previous_clock)
+
+
+# Points every AWS client at a fresh fake backend, running on the
+# deterministic clock, with nothing cached and history entries only
+# spooled to a throwaway directory.
+@pytest.fixture
+def backend(clock, tmp_path, monkeypatch):
+    backend = FakeAws(clock)
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    monkeypatch.setattr(timing, 'recorder', timing.Recorder())
+    aws.set_client_factory(backend.client)
+    monkeypatch.setattr(cache, '_cache', cache.ResponseCache(cache.cache_dir(), enabled=False))
+    git_logger.set_background_flush(False)
+    try:
+        yield backend
+    finally:
+        aws.set_client_factory(None)
+        git_logger.set_background_flush(True)
+
+
+# A local stand-in for the deployment-history repository, with one commit
+# on master, which the mirror and flushes then use.
+@pytest.fixture
+def history_repo(backend, tmp_path, monkeypatch):
+    bare = tmp_path / 'deployment-history.git'
+    seed = tmp_path / 'seed'
+    for args in (
+        ['init', '--quiet', '--bare', '--initial-branch=master', str(bare)],
+        ['init', '--quiet', '--initial-branch=master', str(seed)],
+        ['-C', str(seed), 'commit', '--quiet', '--allow-empty', '-m', 'Start.'],
+        ['-C', str(seed), 'push', '--quiet', str(bare), 'master'],
+    ):
+        subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] + args, check=True)
+    for variable in ('GIT_AUTHOR_NAME', 'GIT_COMMITTER_NAME'):
+        monkeypatch.setenv(variable, 'test')
+    for variable in ('GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_EMAIL'):
+        monkeypatch.setenv(variable, 'test@example.com')
+    monkeypatch.setattr(git_logger, 'REPO_URL', bare.as_uri())
+    return bare
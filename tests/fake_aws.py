@@ -0,0 +1,307 @@
+import datetime
+import threading
+
+from safecast_deploy import grafana_updater
+
+APPS = ['api', 'ingest', 'reporting']
+HAS_WORKER = {'api': True, 'ingest': True, 'reporting': False}
+
+
+# How long, in virtual seconds, each scripted transition takes.
+class Timeline:
+    def __init__(self, update=90, create=300, drain=150, scale_update=30):
+        self.update = update
+        self.create = create
+        self.drain = drain
+        self.scale_update = scale_update
+
+
+class FakeEnvironment:
+    def __init__(self, app, name, version, now, instance_ids):
+        self.app = app
+        self.name = name
+        self.env_id = 'e-' + name
+        self.version = version
+        self.status = 'Ready'
+        self.health = 'Ok'
+        self.busy_until = now
+        self.busy_status = None
+        self.busy_health = None
+        self.instance_ids = instance_ids
+        self.drain_at = None
+        self.fail = False
+        self.date_updated = datetime.datetime.now(datetime.timezone.utc)
+        self.option_settings = {
+            ('aws:autoscaling:asg', 'MinSize'): '1',
+            ('aws:autoscaling:asg', 'MaxSize'): '2',
+        }
+
+
+# Carries an error code the way botocore's ClientError does.
+class FakeError(Exception):
+    def __init__(self, message, code='ValidationError', status=400):
+        super().__init__(message)
+        self.response = {'Error': {'Code': code, 'Message': message}, 'ResponseMetadata': {'HTTPStatusCode': status}}
+
+
+# An in-process stand-in for the Elastic Beanstalk and EC2 APIs used by
+# safecast_deploy. Mutations start scripted transitions on the virtual
+# clock; describe calls report where those transitions have got to.
+class FakeAws:
+    def __init__(self, clock, timeline=None, fail_envs=()):
+        self.clock = clock
+        self.timeline = timeline or Timeline()
+        self.fail_envs = set(fail_envs)
+        # When set, every throttle_every-th call is rejected as throttled.
+        self.throttle_every = None
+        self.calls = {}
+        self.envs = {}
+        self.events = []
+        self.templates = {}
+        self.versions = {}
+        self._lock = threading.RLock()
+        self._next_instance = 0
+        for app in APPS:
+            self.versions[app] = [self._version(app, build) for build in range(1, 4)]
+            for env in ['dev', 'prd']:
+                roles = ['', '-wrk'] if HAS_WORKER[app] else ['']
+                for role in roles:
+                    name = f'safecast{app}-{env}{role}-001'
+                    self.envs[name] = FakeEnvironment(app, name, self.versions[app][0]['VersionLabel'], 0,
+                                                      self._instances(2))
+                    self.templates[(app, env + role)] = dict(self.envs[name].option_settings)
+        # One saved template has drifted from its environment.
+        self.templates[('api', 'prd')][('aws:autoscaling:asg', 'MaxSize')] = '4'
+
+    def client(self, service_name):
+        return FakeClient(self, service_name)
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def call(self, operation, kwargs):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            if self.throttle_every and self.total_calls() % self.throttle_every == 0:
+                raise FakeError('Rate exceeded', code='Throttling')
+            for env in self.envs.values():
+                self._advance(env)
+            return getattr(self, '_' + operation)(**kwargs)
+
+    def _version(self, app, build):
+        return {
+            'ApplicationName': app,
+            'VersionLabel': f'{app}-master-{build}-{build:040x}',
+            'Status': 'PROCESSED',
+            'DateUpdated': datetime.datetime(2020, 1, build, tzinfo=datetime.timezone.utc),
+        }
+
+    def _instances(self, count):
+        ids = [f'i-{self._next_instance + n:08x}' for n in range(count)]
+        self._next_instance += count
+        return ids
+
+    def _event(self, env, severity, message):
+        self.events.append({
+            'ApplicationName': env.app,
+            'EnvironmentName': env.name,
+            'EventDate': datetime.datetime.now(datetime.timezone.utc),
+            'Message': message,
+            'Severity': severity,
+        })
+
+    def _start(self, env, status, health, seconds):
+        env.busy_until = self.clock.monotonic() + seconds
+        env.busy_status = status
+        env.busy_health = health
+        env.status = status
+        env.health = health
+        env.fail = env.name in self.fail_envs
+        env.date_updated = datetime.datetime.now(datetime.timezone.utc)
+
+    def _advance(self, env):
+        now = self.clock.monotonic()
+        if env.drain_at is not None and now >= env.drain_at:
+            env.instance_ids = []
+            env.drain_at = None
+            self._event(env, 'INFO', 'Removed instances from the environment.')
+        if env.busy_status is not None and now >= env.busy_until:
+            env.busy_status = None
+            env.date_updated = datetime.datetime.now(datetime.timezone.utc)
+            if env.fail:
+                env.status, env.health = 'Ready', 'Severe'
+                self._event(env, 'ERROR', 'Failed to deploy application.')
+            else:
+                env.status, env.health = 'Ready', 'Ok'
+                self._event(env, 'INFO', 'Environment health has transitioned to Ok.')
+
+    def _env(self, name):
+        if name not in self.envs:
+            raise FakeError(f'No Environment found for EnvironmentName = {name}.')
+        return self.envs[name]
+
+    def _describe_environments(self, ApplicationName=None, EnvironmentNames=None, IncludeDeleted=False, **kwargs):
+        return {'Environments': [
+            {
+                'ApplicationName': env.app,
+                'CNAME': env.name + '.elasticbeanstalk.com',
+                'DateUpdated': env.date_updated,
+                'EnvironmentId': env.env_id,
+                'EnvironmentName': env.name,
+                'Health': 'Green' if env.health == 'Ok' else 'Yellow',
+                'HealthStatus': env.health,
+                'PlatformArn': 'arn:aws:elasticbeanstalk:us-west-2::platform/Ruby',
+                'Status': env.status,
+                'VersionLabel': env.version,
+            }
+            for env in self.envs.values()
+            if (ApplicationName is None or env.app == ApplicationName)
+            and (EnvironmentNames is None or env.name in EnvironmentNames)
+        ]}
+
+    def _describe_environment_resources(self, EnvironmentName):
+        env = self._env(EnvironmentName)
+        return {'EnvironmentResources': {
+            'AutoScalingGroups': [{'Name': 'asg-' + env.name}],
+            'EnvironmentName': env.name,
+            'Instances': [{'Id': instance_id} for instance_id in env.instance_ids],
+            'LoadBalancers': [{'Name': 'lb-' + env.name}],
+            'Queues': [{'Name': 'WorkerQueue', 'URL': f'https://sqs.us-west-2.amazonaws.com/1/queue-{env.name}'}],
+        }}
+
+    def _describe_environment_health(self, EnvironmentName, AttributeNames):
+        env = self._env(EnvironmentName)
+        return {'EnvironmentName': env.name, 'HealthStatus': env.health, 'Status': env.status}
+
+    def _describe_events(self, ApplicationName=None, EnvironmentName=None, StartTime=None, NextToken=None, **kwargs):
+        return {'Events': sorted(
+            (event for event in self.events
+             if (ApplicationName is None or event['ApplicationName'] == ApplicationName)
+             and (EnvironmentName is None or event['EnvironmentName'] == EnvironmentName)
+             and (StartTime is None or event['EventDate'] >= StartTime)),
+            key=lambda event: event['EventDate'], reverse=True)}
+
+    # Newest first, in pages of MaxRecords, like the real API.
+    def _describe_application_versions(self, ApplicationName, VersionLabels=None, MaxRecords=None, NextToken=None):
+        versions = [
+            version for version in reversed(self.versions[ApplicationName])
+            if VersionLabels is None or version['VersionLabel'] in VersionLabels
+        ]
+        start = 0 if NextToken is None else int(NextToken)
+        end = len(versions) if MaxRecords is None else start + MaxRecords
+        res = {'ApplicationVersions': versions[start:end]}
+        if end < len(versions):
+            res['NextToken'] = str(end)
+        return res
+
+    def _delete_application_version(self, ApplicationName, VersionLabel, DeleteSourceBundle=False):
+        self.versions[ApplicationName] = [
+            version for version in self.versions[ApplicationName] if version['VersionLabel'] != VersionLabel]
+        return {}
+
+    def _update_environment(self, EnvironmentName, ApplicationName=None, VersionLabel=None, OptionSettings=None):
+        env = self._env(EnvironmentName)
+        if VersionLabel is not None:
+            env.version = VersionLabel
+            self._start(env, 'Updating', 'Info', self.timeline.update)
+        if OptionSettings and any(o['OptionName'] == 'MaxSize' and o['Value'] == '0' for o in OptionSettings):
+            self._start(env, 'Updating', 'Ok', self.timeline.scale_update)
+            env.drain_at = self.clock.monotonic() + self.timeline.drain
+        for option in OptionSettings or []:
+            env.option_settings[(option['Namespace'], option['OptionName'])] = option['Value']
+        self._event(env, 'INFO', 'Environment update is starting.')
+        return {}
+
+    def _create_environment(self, ApplicationName, EnvironmentName, VersionLabel, TemplateName=None, PlatformArn=None):
+        env = FakeEnvironment(ApplicationName, EnvironmentName, VersionLabel, self.clock.monotonic(), self._instances(2))
+        if TemplateName is not None:
+            env.option_settings = dict(self.templates[(ApplicationName, TemplateName)])
+        self.envs[EnvironmentName] = env
+        self._start(env, 'Launching', 'Pending', self.timeline.create)
+        self._event(env, 'INFO', 'createEnvironment is starting.')
+        return {}
+
+    def _terminate_environment(self, EnvironmentName):
+        self.envs.pop(self._env(EnvironmentName).name)
+        return {}
+
+    def _swap_environment_cnames(self, SourceEnvironmentName, DestinationEnvironmentName):
+        self._env(SourceEnvironmentName)
+        self._env(DestinationEnvironmentName)
+        return {}
+
+    def _delete_configuration_template(self, ApplicationName, TemplateName):
+        self.templates.pop((ApplicationName, TemplateName), None)
+        return {}
+
+    def _create_configuration_template(self, ApplicationName, TemplateName, EnvironmentId=None):
+        env = next(env for env in self.envs.values() if env.env_id == EnvironmentId)
+        self.templates[(ApplicationName, TemplateName)] = dict(env.option_settings)
+        return {}
+
+    def _describe_applications(self, ApplicationNames):
+        return {'Applications': [
+            {
+                'ApplicationName': app,
+                'ConfigurationTemplates': sorted(name for template_app, name in self.templates if template_app == app),
+            }
+            for app in ApplicationNames
+        ]}
+
+    def _describe_configuration_settings(self, ApplicationName, TemplateName=None, EnvironmentName=None):
+        if TemplateName is None:
+            option_settings = self._env(EnvironmentName).option_settings
+        elif (ApplicationName, TemplateName) in self.templates:
+            option_settings = self.templates[(ApplicationName, TemplateName)]
+        else:
+            raise FakeError(f'No Configuration Template named {ApplicationName}/{TemplateName} found.')
+        return {'ConfigurationSettings': [{
+            'ApplicationName': ApplicationName,
+            'PlatformArn': 'arn:aws:elasticbeanstalk:us-west-2::platform/Ruby',
+            'OptionSettings': [
+                {'Namespace': namespace, 'OptionName': name, 'Value': value}
+                for (namespace, name), value in sorted(option_settings.items())
+            ],
+        }]}
+
+    def _describe_instances(self, InstanceIds):
+        return {'Reservations': [{'Instances': [
+            {'InstanceId': instance_id, 'PublicDnsName': f'ec2-{instance_id}.compute.amazonaws.com'}
+            for instance_id in InstanceIds
+        ]}]}
+
+
+class FakeClient:
+    def __init__(self, backend, service_name):
+        self._backend = backend
+        self.service_name = service_name
+
+    def __getattr__(self, operation):
+        if operation.startswith('_') or not hasattr(self._backend, '_' + operation):
+            raise AttributeError(operation)
+        return lambda **kwargs: self._backend.call(operation, kwargs)
+
+
+# Grafana is not part of the fake, so the dashboard is synthetic and never
+# pushed.
+class OfflineGrafanaUpdater(grafana_updater.GrafanaUpdater):
+    def _get_dashboard(self):
+        return synthetic_dashboard(200)
+
+    def _push_dashboard(self, dashboard):
+        pass
+
+
+def synthetic_dashboard(panel_count):
+    titles = ['prd web CPU', 'prd web network', 'Worker CPU', 'Worker Network', 'Queue depth']
+    return {'panels': [
+        {
+            'title': titles[n % len(titles)],
+            'targets': [{'dimensions': {'AutoScalingGroupName': 'old', 'LoadBalancerName': 'old', 'QueueName': 'old'}}],
+        }
+        for n in range(panel_count)
+    ]}
+
+
+def new_version(backend, app):
+    return backend.versions[app][-1]['VersionLabel']
@@ -0,0 +1,93 @@
+import datetime
+import os
+import sys
+
+import pytest
+
+import deploy
+from safecast_deploy import aws, cache, config_saver, new_env, same_env, state
+
+from fake_aws import new_version
+
+
+@pytest.fixture
+def response_cache(backend, tmp_path):
+    return cache.ResponseCache(str(tmp_path / 'cache'))
+
+
+# The applications with cached responses.
+def cached_apps():
+    responses = os.path.join(cache.cache_dir(), 'responses')
+    return sorted(os.listdir(responses)) if os.path.isdir(responses) else []
+
+
+# Caches responses the way the commands do, which always fetch afresh but
+# keep what they fetched.
+@pytest.fixture
+def enabled_cache(backend):
+    cache.configure(enabled=True, refresh=True)
+    state.State('api').env_metadata
+    state.State('ingest').env_metadata
+    assert cached_apps() == ['api', 'ingest']
+
+
+def test_responses_expire_after_the_ttl_of_their_operation(backend, clock, response_cache):
+    c = aws.client('elasticbeanstalk')
+    for _ in range(2):
+        response_cache.call(c, 'describe_environments', 'api', ApplicationName='api')
+        response_cache.call(c, 'describe_application_versions', 'api', ApplicationName='api')
+    assert backend.calls == {'describe_environments': 1, 'describe_application_versions': 1}
+    clock.sleep(cache.TTLS['describe_environments'] + 1)
+    response_cache.call(c, 'describe_environments', 'api', ApplicationName='api')
+    response_cache.call(c, 'describe_application_versions', 'api', ApplicationName='api')
+    assert backend.calls == {'describe_environments': 2, 'describe_application_versions': 1}
+    clock.sleep(cache.TTLS['describe_application_versions'])
+    response_cache.call(c, 'describe_application_versions', 'api', ApplicationName='api')
+    assert backend.calls == {'describe_environments': 2, 'describe_application_versions': 2}
+
+
+def test_cached_responses_keep_their_datetimes(backend, response_cache):
+    c = aws.client('elasticbeanstalk')
+    since = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    fetched = response_cache.call(c, 'describe_application_versions', 'api', ApplicationName='api')
+    cached = response_cache.call(c, 'describe_application_versions', 'api', ApplicationName='api')
+    assert cached == fetched
+    assert cached['ApplicationVersions'][0]['DateUpdated'] == datetime.datetime(2020, 1, 3, tzinfo=datetime.timezone.utc)
+    assert backend.calls == {'describe_application_versions': 1}
+    # Datetimes in the arguments are part of the key.
+    assert response_cache._path('api', 'describe_events', {'StartTime': since}) \
+        != response_cache._path('api', 'describe_events', {'StartTime': since + datetime.timedelta(seconds=1)})
+
+
+def test_same_env_clears_the_cache_of_its_app(backend, enabled_cache):
+    same_env.SameEnv(state.State('api', 'prd', new_version=new_version(backend, 'api'))).run()
+    assert cached_apps() == ['ingest']
+
+
+def test_new_env_clears_the_cache_of_its_app(backend, enabled_cache):
+    new_env.NewEnv(state.State('api', 'prd', new_version=new_version(backend, 'api'), new_arn='arn'), False).run()
+    assert cached_apps() == ['ingest']
+
+
+def test_save_configs_clears_the_cache_of_apps_whose_templates_changed(backend, enabled_cache):
+    # Only api's prd template has drifted.
+    config_saver.ConfigSaver().run()
+    assert cached_apps() == ['ingest']
+
+
+def run_versions(monkeypatch, *options):
+    monkeypatch.setattr(sys, 'argv', ['deploy.py', *options, 'versions', 'api'])
+    deploy.parse_args()
+
+
+def test_refresh_fetches_afresh_and_no_cache_bypasses_the_cache(backend, monkeypatch):
+    run_versions(monkeypatch)
+    run_versions(monkeypatch)
+    assert backend.calls == {'describe_application_versions': 1}
+    run_versions(monkeypatch, '--refresh')
+    assert backend.calls == {'describe_application_versions': 2}
+    run_versions(monkeypatch)
+    assert backend.calls == {'describe_application_versions': 2}
+    run_versions(monkeypatch, '--no-cache')
+    assert backend.calls == {'describe_application_versions': 3}
+    assert cached_apps() == ['api']
@@ -0,0 +1,77 @@
+import contextvars
+import threading
+
+import pytest
+
+import safecast_deploy
+
+from clock import DeterministicClock
+
+PREFIX = contextvars.ContextVar('prefix', default=None)
+
+
+def test_sleepers_wake_in_order_of_their_deadlines():
+    clock = DeterministicClock()
+    woken = []
+
+    def sleep(secs):
+        clock.sleep(secs)
+        woken.append((secs, clock.monotonic()))
+
+    with clock.executor(3) as executor:
+        for secs in (30, 10, 20):
+            executor.submit(sleep, secs)
+    assert woken == [(10, 10), (20, 20), (30, 30)]
+    assert clock.monotonic() == 30
+
+
+def test_time_waits_for_threads_that_are_still_running():
+    clock = DeterministicClock()
+    started = threading.Event()
+    release = threading.Event()
+
+    def busy():
+        started.set()
+        # Blocked outside the clock, so time must not move meanwhile.
+        release.wait()
+        return clock.monotonic()
+
+    with clock.executor(2) as executor:
+        sleeper = executor.submit(clock.sleep, 60)
+        worker = executor.submit(busy)
+        started.wait()
+        assert clock.monotonic() == 0
+        release.set()
+        assert worker.result() == 0
+        sleeper.result()
+    assert clock.monotonic() == 60
+
+
+def test_a_set_event_wakes_its_waiter_without_moving_time():
+    clock = DeterministicClock()
+    event = threading.Event()
+
+    def set_later():
+        clock.sleep(5)
+        event.set()
+
+    with clock.executor(1) as executor:
+        executor.submit(set_later)
+        assert clock.wait(event, 600)
+    assert clock.monotonic() == 5
+
+
+def test_queued_tasks_do_not_hold_time_back():
+    clock = DeterministicClock()
+    with clock.executor(2) as executor:
+        list(executor.map(clock.sleep, [10] * 6))
+    assert clock.monotonic() == 30
+
+
+@pytest.mark.parametrize('clock', [safecast_deploy.SystemClock(), DeterministicClock()], ids=['system', 'deterministic'])
+def test_threads_inherit_context_variables(clock):
+    PREFIX.set('api')
+    with clock.executor(1) as executor:
+        assert executor.submit(PREFIX.get).result() == 'api'
+    assert clock.start(PREFIX.get, 'prefix').result() == 'api'
+    PREFIX.set(None)
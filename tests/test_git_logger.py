@@ -0,0 +1,171 @@
+import datetime
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from safecast_deploy import cache, git_logger
+
+
+def entry(app, day, month=1, **fields):
+    return dict({
+        'app': app,
+        'completed_at': datetime.datetime(2020, month, day, tzinfo=datetime.timezone.utc),
+        'env': 'prd',
+        'event': 'same_env',
+    }, **fields)
+
+
+def git(*args):
+    return subprocess.run(['git', *args], check=True, capture_output=True, text=True).stdout
+
+
+# The entries of a file on master in the history repository.
+def pushed_lines(bare, path):
+    return [json.loads(line) for line in git('-C', str(bare), 'show', f'master:{path}').splitlines()]
+
+
+def pushed_files(bare):
+    return git('-C', str(bare), 'ls-tree', '-r', '--name-only', 'master').split()
+
+
+# Pushes files to the history repository as if written by an older version.
+def push_files(bare, tmp_path, files):
+    work = tmp_path / 'work'
+    git('clone', '--quiet', bare.as_uri(), str(work))
+    for path, content in files.items():
+        (work / path).parent.mkdir(parents=True, exist_ok=True)
+        (work / path).write_text(content)
+    git('-C', str(work), 'add', '--all')
+    git('-C', str(work), 'commit', '--quiet', '-m', 'Legacy history.')
+    git('-C', str(work), 'push', '--quiet', 'origin', 'master')
+
+
+def test_write_entry_appends_to_monthly_shards(history_repo):
+    release = {
+        'apps': {'api': {}},
+        'completed_at': datetime.datetime(2020, 2, 3, tzinfo=datetime.timezone.utc),
+        'env': 'prd',
+        'event': 'release',
+    }
+    git_logger.spool_entries([entry('api', 1), entry('api', 2, month=2), entry('api', 3), release])
+    assert git_logger.flush() == 4
+    assert sorted(pushed_files(history_repo)) == ['api/prd/2020-01.jsonl', 'api/prd/2020-02.jsonl', 'release/prd/2020-02.jsonl']
+    assert [e['completed_at'] for e in pushed_lines(history_repo, 'api/prd/2020-01.jsonl')] \
+        == ['2020-01-01T00:00:00+00:00', '2020-01-03T00:00:00+00:00']
+    git_logger.spool_entries([entry('api', 4)])
+    git_logger.flush()
+    assert [e['completed_at'][:10] for e in pushed_lines(history_repo, 'api/prd/2020-01.jsonl')] \
+        == ['2020-01-01', '2020-01-03', '2020-01-04']
+    assert git('-C', str(history_repo), 'log', '--format=%s', 'master').splitlines()[:2] \
+        == ['Updated entry.', 'Updated 4 entries.']
+
+
+def test_read_history_is_newest_first_across_shards_then_legacy(tmp_path):
+    env_dir = tmp_path / 'api' / 'prd'
+    env_dir.mkdir(parents=True)
+    for month, days in [('2020-01', [3, 4]), ('2020-02', [1, 2])]:
+        (env_dir / f'{month}.jsonl').write_text(''.join(json.dumps({'day': f'{month}-{day}'}) + '\n' for day in days))
+    (tmp_path / 'api' / 'prd.json').write_text(json.dumps([{'day': '2019-12-2'}, {'day': '2019-12-1'}]))
+    assert [e['day'] for e in git_logger.read_history('api', 'prd', str(tmp_path))] \
+        == ['2020-02-2', '2020-02-1', '2020-01-4', '2020-01-3', '2019-12-2', '2019-12-1']
+    assert list(git_logger.read_history('api', 'dev', str(tmp_path))) == []
+
+
+def test_migrate_legacy_files(history_repo, tmp_path):
+    push_files(history_repo, tmp_path, {
+        'api/prd.json': json.dumps([entry('api', 20), entry('api', 10)], cls=git_logger.Iso8601DateTimeEncoder),
+        'api/dev.json': '[]',
+        'README.md': 'History.\n',
+    })
+    # Entries written in the new format before the migration.
+    git_logger.spool_entries([entry('api', 25), entry('api', 1, month=2)])
+    git_logger.flush()
+    with git_logger.history_lock():
+        history = list(git_logger.read_history('api', 'prd'))
+    assert [e['completed_at'][:10] for e in history] == ['2020-02-01', '2020-01-25', '2020-01-20', '2020-01-10']
+    git_logger.run_migrate_cli(None)
+    assert sorted(pushed_files(history_repo)) == ['README.md', 'api/prd/2020-01.jsonl', 'api/prd/2020-02.jsonl']
+    assert [e['completed_at'][:10] for e in pushed_lines(history_repo, 'api/prd/2020-01.jsonl')] \
+        == ['2020-01-10', '2020-01-20', '2020-01-25']
+    with git_logger.history_lock():
+        git_logger.open_mirror()
+        assert list(git_logger.read_history('api', 'prd')) == history
+
+
+def test_spool_entries_are_read_back_until_flushed(history_repo):
+    git_logger.spool_entries([entry('api', 1)])
+    git_logger.spool_entries([entry('ingest', 2), entry('ingest', 3)])
+    assert [e['completed_at'] for e in git_logger.read_spool()] \
+        == ['2020-01-01T00:00:00+00:00', '2020-01-02T00:00:00+00:00', '2020-01-03T00:00:00+00:00']
+    assert sorted(name[-5:] for name in os.listdir(git_logger.spool_dir())) == ['.json', '.json']
+    assert git_logger.flush() == 3
+    assert git_logger.read_spool() == []
+    assert git_logger.flush() == 0
+    assert pushed_files(history_repo) == ['api/prd/2020-01.jsonl', 'ingest/prd/2020-01.jsonl']
+
+
+def test_flush_quarantines_unreadable_spool_files(history_repo, capsys):
+    os.makedirs(git_logger.spool_dir())
+    for name, content in [('1-truncated.json', '[{"app": "api"'), ('2-no-env.json', '[{"app": "api", "event": "same_env"}]')]:
+        with open(os.path.join(git_logger.spool_dir(), name), 'w') as f:
+            f.write(content)
+    git_logger.spool_entries([entry('api', 1)])
+    assert len(git_logger.read_spool()) == 1
+    assert git_logger.flush() == 1
+    assert pushed_files(history_repo) == ['api/prd/2020-01.jsonl']
+    assert sorted(os.listdir(os.path.join(git_logger.spool_dir(), 'quarantine'))) == ['1-truncated.json', '2-no-env.json']
+    assert capsys.readouterr().err.count("moved it to") == 2
+    assert git_logger.read_spool() == []
+
+
+def test_flush_retries_on_top_of_a_concurrent_push(history_repo, tmp_path, monkeypatch, capsys):
+    open_mirror = git_logger.open_mirror
+
+    # Someone else pushes after the mirror was brought up to date.
+    def open_stale_mirror(url=None, path=None):
+        repo = open_mirror(url, path)
+        push_files(history_repo, tmp_path, {'ingest/prd/2020-01.jsonl': json.dumps({'app': 'ingest'}) + '\n'})
+        return repo
+
+    monkeypatch.setattr(git_logger, 'open_mirror', open_stale_mirror)
+    git_logger.spool_entries([entry('api', 1)])
+    assert git_logger.flush() == 1
+    assert "retrying on top of the remote changes" in capsys.readouterr().err
+    assert pushed_files(history_repo) == ['api/prd/2020-01.jsonl', 'ingest/prd/2020-01.jsonl']
+    assert git('-C', str(history_repo), 'log', '--format=%s', 'master').splitlines() \
+        == ['Updated entry.', 'Legacy history.', 'Start.']
+
+
+def test_background_flush_keeps_entries_spooled_while_the_push_fails(history_repo, clock, tmp_path, monkeypatch):
+    monkeypatch.setattr(git_logger, 'REPO_URL', (tmp_path / 'missing.git').as_uri())
+    git_logger.spool_entries([entry('api', 1)])
+    with pytest.raises(SystemExit):
+        git_logger._flush_with_retries()
+    assert clock.monotonic() == sum(git_logger.FLUSH_RETRY_DELAYS)
+    assert len(git_logger.read_spool()) == 1
+
+
+# Another process cannot take the lock while it is held.
+def test_history_lock_excludes_other_processes(history_repo):
+    try_lock = textwrap.dedent('''
+        import fcntl, sys
+        with open(sys.argv[1], 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print('locked')
+            else:
+                print('free')
+    ''')
+    lock_path = os.path.join(cache.cache_dir(), 'deployment-history.lock')
+
+    def lock_state():
+        return subprocess.run([sys.executable, '-c', try_lock, lock_path], check=True, capture_output=True, text=True).stdout
+
+    with git_logger.history_lock():
+        assert lock_state() == 'locked\n'
+    assert lock_state() == 'free\n'
@@ -0,0 +1,137 @@
+import copy
+import http.server
+import json
+import random
+import threading
+
+import pytest
+
+from safecast_deploy import grafana_updater
+
+from bench.grafana_rewrite import TITLES, dashboard, four_pass_rewrite, rules
+from fake_aws import synthetic_dashboard
+
+KEYS = ['LoadBalancerName', 'AutoScalingGroupName', 'QueueName', 'targets', 'dimensions', 'panels']
+
+
+# An irregular dashboard: nested titled and untitled objects and lists,
+# titles matching one, both or neither pattern, and values that are
+# already up to date or are themselves objects.
+def random_dashboard(rng, depth=0):
+    obj = {}
+    if rng.random() < 0.5:
+        obj['title'] = rng.choice(TITLES + ['Worker CPU vs web CPU', ''])
+    for key in rng.sample(KEYS, rng.randint(1, 4)):
+        roll = rng.random()
+        if depth < 4 and roll < 0.3:
+            obj[key] = [random_dashboard(rng, depth + 1) for _ in range(rng.randint(0, 3))]
+        elif depth < 4 and roll < 0.5:
+            obj[key] = random_dashboard(rng, depth + 1)
+        else:
+            obj[key] = rng.choice(['old', 'awseb-lb', 'awseb-web-asg', 'awseb-wrk-asg', 'awseb-queue'])
+    return obj
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_rewrite_matches_the_four_passes(seed):
+    board = random_dashboard(random.Random(seed))
+    expected = copy.deepcopy(board)
+    four_pass_rewrite(expected, rules())
+    changes = grafana_updater.rewrite(board, rules())
+    assert board == expected
+    assert all(change['old'] != change['new'] for change in changes)
+    assert grafana_updater.rewrite(board, rules()) == []
+
+
+def test_rewrite_matches_the_four_passes_on_a_large_dashboard():
+    board = dashboard(1000)
+    expected = copy.deepcopy(board)
+    four_pass_rewrite(expected, rules())
+    changes = grafana_updater.rewrite(board, rules())
+    assert board == expected
+    # Each panel has three targets. All of them get a new load balancer
+    # and queue; those of the 668 web and worker panels also a new group.
+    assert len(changes) == 3 * (2 * 1000 + 668)
+
+
+# Serves one dashboard like Grafana's HTTP API, keeping connections open,
+# and records the requests and connections it gets.
+class FakeGrafanaHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self._record()
+        if self.path != f"/api/dashboards/uid/{grafana_updater.DASHBOARD_UIDS['api']}":
+            self._respond(404, {})
+            return
+        self._respond(200, {'dashboard': self.server.dashboard})
+
+    def do_POST(self):
+        self._record()
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.dashboard = body['dashboard']
+        self._respond(200, {'status': 'success'})
+
+    def log_message(self, format, *args):
+        pass
+
+    def _record(self):
+        self.server.requests.append((self.command, self.path, self.headers['Authorization']))
+
+    def _respond(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        # Drops the connection without saying so, as servers do with
+        # connections that sit idle.
+        self.close_connection = self.server.drop_connections
+
+
+@pytest.fixture
+def grafana():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeGrafanaHandler)
+    server.dashboard = synthetic_dashboard(20)
+    server.requests = []
+    server.connections = 0
+    server.drop_connections = False
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_unchanged_dashboard_is_not_pushed(backend, grafana):
+    pool = grafana_updater.ConnectionPool(f'http://127.0.0.1:{grafana.server_port}')
+    try:
+        grafana_updater.GrafanaUpdater('api', 'key', pool).run()
+        assert [method for method, _, _ in grafana.requests] == ['GET', 'POST']
+        assert all(target['dimensions']['QueueName'] != 'old' for panel in grafana.dashboard['panels']
+                   for target in panel['targets'])
+        grafana_updater.GrafanaUpdater('api', 'key', pool).run()
+    finally:
+        pool.close()
+    assert [method for method, _, _ in grafana.requests] == ['GET', 'POST', 'GET']
+    assert all(authorization == 'Bearer key' for _, _, authorization in grafana.requests)
+    assert grafana.connections == 1
+
+
+def test_pool_retries_on_a_fresh_connection_when_the_server_dropped_one(backend, grafana):
+    grafana.drop_connections = True
+    pool = grafana_updater.ConnectionPool(f'http://127.0.0.1:{grafana.server_port}')
+    try:
+        grafana_updater.GrafanaUpdater('api', 'key', pool).run()
+        grafana_updater.GrafanaUpdater('api', 'key', pool).run()
+    finally:
+        pool.close()
+    assert [method for method, _, _ in grafana.requests] == ['GET', 'POST', 'GET']
+    assert grafana.connections == 3
@@ -0,0 +1,152 @@
+import os
+import socket
+
+import pytest
+
+from safecast_deploy import metrics, timing
+
+from clock import EPOCH
+
+LABELS = {'command': 'same_env', 'app': 'api', 'env': 'prd'}
+TAGS = '|#app:api,command:same_env,env:prd'
+
+
+@pytest.fixture
+def statsd():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(5)
+    try:
+        yield sock
+    finally:
+        sock.close()
+
+
+def receive_lines(sock, count):
+    packets = []
+    lines = []
+    while len(lines) < count:
+        packet = sock.recv(65536)
+        packets.append(packet)
+        lines += packet.decode('utf-8').split('\n')
+    return packets, lines
+
+
+def test_send_statsd(statsd):
+    samples = [
+        ('duration_seconds', LABELS, 191.8754),
+        ('success', LABELS, 0),
+        ('aws_calls', LABELS, 33),
+        ('completed_timestamp_seconds', LABELS, 1700000000.0),
+        ('phase_duration_seconds', dict(LABELS, phase='same_env/web', role='web'), 90.5),
+    ]
+    metrics.send_statsd(statsd.getsockname(), samples, succeeded=False)
+    packets, lines = receive_lines(statsd, 5)
+    assert len(packets) == 1
+    # The timestamp only makes sense to Prometheus.
+    assert lines == [
+        'safecast_deploy.duration:191875|ms' + TAGS,
+        'safecast_deploy.success:0|g' + TAGS,
+        'safecast_deploy.aws_calls:33|c' + TAGS,
+        'safecast_deploy.phase_duration:90500|ms|#app:api,command:same_env,env:prd,phase:same_env/web,role:web',
+        'safecast_deploy.runs:1|c' + TAGS + ',outcome:failure',
+    ]
+
+
+def test_send_statsd_splits_lines_across_packets(statsd):
+    samples = [('duration_seconds', LABELS, 10.0)]
+    samples += [
+        ('phase_duration_seconds', dict(LABELS, phase=f'new_env/web/create_environment_{n}'), n)
+        for n in range(200)
+    ]
+    metrics.send_statsd(statsd.getsockname(), samples, succeeded=True)
+    packets, lines = receive_lines(statsd, 202)
+    assert len(packets) > 1
+    assert all(len(packet) <= metrics.MAX_PACKET for packet in packets)
+    # No line is cut in two.
+    assert lines[1:-1] == [
+        f'safecast_deploy.phase_duration:{n * 1000}|ms' + TAGS + f',phase:new_env/web/create_environment_{n}'
+        for n in range(200)
+    ]
+    assert lines[-1] == 'safecast_deploy.runs:1|c' + TAGS + ',outcome:success'
+
+
+# A release of api, whose web rollout waits for health.
+def record_release(clock):
+    recorder = timing.Recorder()
+    with recorder.span('release'):
+        with recorder.span('api'):
+            with recorder.span('web'):
+                clock.sleep(10)
+                with recorder.span('wait_for_green'):
+                    clock.sleep(20)
+        recorder.record_call('describe_environments', 1.0, retries=2)
+        recorder.record_call('describe_environments', 1.0)
+        recorder.record_call('update_environment', 1.0, retries=1)
+    return recorder
+
+
+def test_collect(clock):
+    recorder = record_release(clock)
+    labels = {'command': 'release', 'app': None, 'env': 'prd', 'role': None}
+    release_labels = {'command': 'release', 'env': 'prd'}
+    api_labels = dict(release_labels, app='api')
+    # A span still open counts up to the time of collection.
+    with recorder.span('history'):
+        clock.sleep(5)
+        samples = metrics.collect(labels, False, recorder)
+    assert samples == [
+        ('duration_seconds', release_labels, 35.0),
+        ('success', release_labels, 0),
+        ('aws_calls', release_labels, 3),
+        ('aws_retries', release_labels, 3),
+        ('completed_timestamp_seconds', release_labels, EPOCH + 35.0),
+        ('phase_duration_seconds', dict(api_labels, phase='release'), 30.0),
+        ('phase_duration_seconds', dict(api_labels, phase='release/web', role='web'), 30.0),
+        ('phase_duration_seconds', dict(api_labels, phase='release/web/wait_for_green', role='web'), 20.0),
+        ('phase_duration_seconds', dict(release_labels, phase='history'), 5.0),
+        ('phase_duration_seconds', dict(release_labels, phase='release'), 30.0),
+        ('health_wait_seconds', dict(api_labels, role='web'), 20.0),
+    ]
+
+
+def test_write_textfile(tmp_path):
+    path = tmp_path / 'safecast_deploy_same_env.prom'
+    samples = [
+        ('duration_seconds', LABELS, 191.8754),
+        ('success', LABELS, 1),
+        ('phase_duration_seconds', dict(LABELS, phase='same_env/web', role='web'), 90.5),
+        ('phase_duration_seconds', dict(LABELS, phase='a "quoted"\\path\n'), 1.0),
+    ]
+    metrics.write_textfile(str(path), samples)
+    assert path.read_text() == '\n'.join([
+        '# HELP safecast_deploy_duration_seconds Wall time of the whole command.',
+        '# TYPE safecast_deploy_duration_seconds gauge',
+        'safecast_deploy_duration_seconds{app="api",command="same_env",env="prd"} 191.875',
+        '# HELP safecast_deploy_phase_duration_seconds '
+        + 'Wall time of each phase, summed when a phase runs more than once.',
+        '# TYPE safecast_deploy_phase_duration_seconds gauge',
+        'safecast_deploy_phase_duration_seconds{app="api",command="same_env",env="prd",phase="same_env/web",role="web"} 90.500',
+        'safecast_deploy_phase_duration_seconds{app="api",command="same_env",env="prd",phase="a \\"quoted\\"\\\\path\\n"} 1.000',
+        '# HELP safecast_deploy_success 1 if the command succeeded, 0 if it failed.',
+        '# TYPE safecast_deploy_success gauge',
+        'safecast_deploy_success{app="api",command="same_env",env="prd"} 1',
+    ]) + '\n'
+
+
+# The collector only ever sees the old file or the complete new one.
+def test_write_textfile_replaces_the_file_atomically(tmp_path, monkeypatch):
+    path = tmp_path / 'safecast_deploy_same_env.prom'
+    path.write_text('old\n')
+    replace = os.replace
+
+    def check_replace(source, destination):
+        assert path.read_text() == 'old\n'
+        with open(source) as f:
+            assert f.read().endswith('safecast_deploy_success{app="api",command="same_env",env="prd"} 0\n')
+        replace(source, destination)
+
+    monkeypatch.setattr(os, 'replace', check_replace)
+    metrics.write_textfile(str(path), [('success', LABELS, 0)])
+    assert path.read_text().endswith(' 0\n')
+    assert os.listdir(tmp_path) == [path.name]
@@ -0,0 +1,136 @@
+import argparse
+import random
+
+import pytest
+
+from safecast_deploy import config_saver, new_env, release, same_env, ssh, state
+
+from fake_aws import APPS, OfflineGrafanaUpdater, new_version
+
+
+def run(clock, scenario):
+    start = clock.monotonic()
+    scenario()
+    return clock.monotonic() - start
+
+
+def test_desc_metadata(backend, clock):
+    run(clock, lambda: state.State('api').prefetch_resources())
+    assert backend.calls == {'describe_environments': 1, 'describe_environment_resources': 4}
+
+
+def test_versions_reads_one_page(backend, clock):
+    state.State('api').available_versions
+    assert backend.calls == {'describe_application_versions': 1}
+
+
+def test_same_env(backend, clock):
+    seconds = run(clock, lambda: same_env.SameEnv(state.State('api', 'prd', new_version=new_version(backend, 'api'))).run())
+    assert backend.envs['safecastapi-prd-001'].version == new_version(backend, 'api')
+    # The worker and then the web tier each update for 90 seconds.
+    assert 180 <= seconds <= 200
+    assert backend.total_calls() == 33
+
+
+def test_new_env(backend, clock):
+    app_state = state.State('api', 'prd', new_version=new_version(backend, 'api'), new_arn='arn')
+    seconds = run(clock, lambda: new_env.NewEnv(app_state, True).run())
+    assert sorted(backend.envs)[:2] == ['safecastapi-dev-001', 'safecastapi-dev-wrk-001']
+    assert 'safecastapi-prd-002' in backend.envs and 'safecastapi-prd-wrk-002' in backend.envs
+    # Scaling down, draining and creating the worker, creating the web
+    # environment and letting DNS settle.
+    assert 880 <= seconds <= 900
+    assert backend.total_calls() == 115
+
+
+def test_new_env_parallel_web_overlaps_the_worker(backend, clock):
+    app_state = state.State('api', 'prd', new_version=new_version(backend, 'api'), new_arn='arn')
+    seconds = run(clock, lambda: new_env.NewEnv(app_state, True, True).run())
+    assert 570 <= seconds <= 590
+    assert backend.total_calls() == 100
+
+
+def test_new_env_stops_waiting_for_web_when_the_worker_fails(backend, clock):
+    app_state = state.State('api', 'prd', new_version=new_version(backend, 'api'), new_arn='arn')
+    with pytest.raises(SystemExit):
+        run(clock, lambda: new_env.NewEnv(app_state, True, True, drain_timeout=60).run())
+    # The drain times out after 60 seconds, and the web environment, which
+    # needs 300 to come up, is not waited for.
+    assert clock.monotonic() < 70
+    assert 'safecastapi-prd-002' not in backend.envs
+
+
+def test_new_env_stops_the_worker_when_the_web_environment_fails(backend, clock, capsys):
+    backend.fail_envs.add('safecastapi-prd-002')
+    app_state = state.State('api', 'prd', new_version=new_version(backend, 'api'), new_arn='arn')
+    with pytest.raises(SystemExit):
+        new_env.NewEnv(app_state, True, True).run()
+    assert "stopping the worker rollout" in capsys.readouterr().err
+    # The worker rollout stopped before replacing the old worker, and well
+    # before its own health wait would have timed out.
+    assert 'safecastapi-prd-wrk-001' in backend.envs
+    assert clock.monotonic() < 2000
+
+
+def test_release(backend, clock):
+    versions = {app: new_version(backend, app) for app in APPS}
+    seconds = run(clock, lambda: release.Release('prd', versions).run())
+    for app in APPS:
+        assert backend.envs[f'safecast{app}-prd-001'].version == versions[app]
+    # The apps deploy concurrently, so the release takes as long as one.
+    assert 180 <= seconds <= 200
+    assert backend.total_calls() == 83
+
+
+def test_release_prefixes_the_output_of_every_thread_of_a_deploy(backend, clock, capsys):
+    versions = {app: new_version(backend, app) for app in ['api', 'ingest']}
+    release.Release('prd', versions, arn='arn', parallel_web=True).run()
+    lines = capsys.readouterr().err.splitlines()
+    for app in versions:
+        # Printed by the event tailer and by the parallel worker rollout.
+        for text in [f' INFO safecast{app}-prd-wrk-001: ', f'Environment safecast{app}-prd-wrk-001 is Updating']:
+            matches = [line for line in lines if text in line]
+            assert matches and all(line.startswith(f'[{app}] ') for line in matches)
+
+
+def test_release_with_an_invalid_version_deploys_nothing(backend, clock):
+    versions = {'api': new_version(backend, 'api'), 'ingest': 'ingest-typo-9'}
+    with pytest.raises(SystemExit):
+        release.Release('prd', versions).run()
+    assert 'update_environment' not in backend.calls
+
+
+def test_release_survives_throttling(backend, clock):
+    random.seed(0)
+    backend.throttle_every = 4
+    versions = {app: new_version(backend, app) for app in APPS}
+    seconds = run(clock, lambda: release.Release('prd', versions).run())
+    for app in APPS:
+        assert backend.envs[f'safecast{app}-prd-001'].version == versions[app]
+    assert seconds <= 260
+
+
+def test_save_configs_only_rewrites_drifted_templates(backend, clock):
+    run(clock, lambda: config_saver.ConfigSaver().run())
+    assert backend.calls.get('delete_configuration_template') == 1
+    assert backend.calls.get('create_configuration_template') == 1
+    assert backend.templates[('api', 'prd')] == backend.envs['safecastapi-prd-001'].option_settings
+    assert backend.total_calls() <= 25
+
+
+def test_save_configs_only_rewrites_worker_templates_when_asked(backend, clock):
+    backend.templates[('api', 'prd-wrk')][('aws:autoscaling:asg', 'MaxSize')] = '4'
+    config_saver.ConfigSaver(app='api', env='prd').run()
+    assert backend.templates[('api', 'prd-wrk')][('aws:autoscaling:asg', 'MaxSize')] == '4'
+    config_saver.ConfigSaver(app='api', env='prd', role='wrk').run()
+    assert backend.templates[('api', 'prd-wrk')] == backend.envs['safecastapi-prd-wrk-001'].option_settings
+
+
+def test_ssh_resolves_hosts_in_one_batch(backend, clock):
+    ssh.Ssh(state.State('api', 'prd'), argparse.Namespace(role='web', select=False)).resolve_public_dns()
+    assert backend.total_calls() == 3
+
+
+def test_update_grafana(backend, clock):
+    OfflineGrafanaUpdater('api', None).run()
+    assert backend.total_calls() <= 3
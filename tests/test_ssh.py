@@ -0,0 +1,107 @@
+import argparse
+import os
+import sys
+import textwrap
+
+import pytest
+
+from safecast_deploy import cache, ssh, state
+
+# Stands in for OpenSSH: prints two lines naming the host and the command,
+# takes a moment, and exits with the code listed for the host in
+# STUB_SSH_EXIT_CODES. It also records how many copies were running at
+# once when it started.
+STUB_SSH = '''
+import os
+import sys
+import time
+
+args = sys.argv[1:]
+host = args[args.index('--') - 1]
+command = args[args.index('--') + 1:]
+running = os.path.join(os.environ['STUB_SSH_DIR'], 'running')
+marker = os.path.join(running, str(os.getpid()))
+open(marker, 'w').close()
+with open(os.path.join(os.environ['STUB_SSH_DIR'], 'concurrency'), 'a') as f:
+    f.write(f'{len(os.listdir(running))}\\n')
+print(f'{host} ran {" ".join(command)}', flush=True)
+time.sleep(0.5)
+print('done', flush=True)
+os.remove(marker)
+exit_codes = dict(code.split('=') for code in os.environ['STUB_SSH_EXIT_CODES'].split(',') if code)
+sys.exit(int(exit_codes.get(host, 0)))
+'''
+
+
+@pytest.fixture
+def stub_ssh(backend, tmp_path, monkeypatch):
+    stub_dir = tmp_path / 'stub-ssh'
+    (stub_dir / 'running').mkdir(parents=True)
+    (stub_dir / 'ssh').write_text(f'#!{sys.executable}\n' + textwrap.dedent(STUB_SSH))
+    (stub_dir / 'ssh').chmod(0o755)
+    monkeypatch.setenv('PATH', str(stub_dir) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('STUB_SSH_DIR', str(stub_dir))
+    monkeypatch.setenv('STUB_SSH_EXIT_CODES', '')
+    # api's prd web tier has five instances.
+    backend.envs['safecastapi-prd-001'].instance_ids = [f'i-{n:08x}' for n in range(100, 105)]
+    return stub_dir
+
+
+def dns(instance_id):
+    return f'ec2-{instance_id}.compute.amazonaws.com'
+
+
+def run_exec(max_parallel=10):
+    args = argparse.Namespace(role='web', command=['uptime', '-p'], max_parallel=max_parallel)
+    ssh.Exec(state.State('api', 'prd'), args).run()
+
+
+def test_resolve_hosts_describes_every_instance_at_once_and_caches_them(backend, stub_ssh):
+    cache.configure(enabled=True)
+    hosts = ssh.resolve_hosts(state.State('api', 'prd'), 'web')
+    assert hosts == [(f'i-{n:08x}', dns(f'i-{n:08x}')) for n in range(100, 105)]
+    assert backend.calls['describe_instances'] == 1
+    assert ssh.resolve_hosts(state.State('api', 'prd'), 'web') == hosts
+    assert backend.calls == {'describe_environments': 1, 'describe_environment_resources': 1, 'describe_instances': 1}
+
+
+def test_exec_prefixes_each_line_with_its_instance(backend, stub_ssh, capsys):
+    run_exec()
+    lines = capsys.readouterr().out.splitlines()
+    for n in range(100, 105):
+        instance_id = f'i-{n:08x}'
+        assert [line for line in lines if line.startswith(f'[{instance_id}] ')] \
+            == [f'[{instance_id}] ec2-user@{dns(instance_id)} ran uptime -p', f'[{instance_id}] done']
+    assert len(lines) == 10
+
+
+def test_exec_runs_at_most_max_parallel_at_once(backend, stub_ssh):
+    run_exec(max_parallel=2)
+    concurrency = [int(line) for line in (stub_ssh / 'concurrency').read_text().split()]
+    assert len(concurrency) == 5
+    assert max(concurrency) == 2
+
+
+def test_exec_reports_the_exit_code_of_every_instance(backend, stub_ssh, monkeypatch, capsys):
+    monkeypatch.setenv('STUB_SSH_EXIT_CODES', f'ec2-user@{dns("i-00000065")}=2,ec2-user@{dns("i-00000067")}=255')
+    with pytest.raises(SystemExit) as e:
+        run_exec()
+    assert e.value.code == 1
+    err = capsys.readouterr().err.splitlines()
+    table = err[err.index('Instance             Public DNS                                          Exit code') + 1:]
+    assert [line.split() for line in table] == [
+        ['i-00000064', dns('i-00000064'), '0'],
+        ['i-00000065', dns('i-00000065'), '2'],
+        ['i-00000066', dns('i-00000066'), '0'],
+        ['i-00000067', dns('i-00000067'), '255'],
+        ['i-00000068', dns('i-00000068'), '0'],
+        ['The', 'command', 'failed', 'on', '2', 'of', '5', 'instances.'],
+    ]
+
+
+def test_exec_without_instances_fails(backend, stub_ssh, capsys):
+    backend.envs['safecastapi-prd-001'].instance_ids = []
+    with pytest.raises(SystemExit):
+        run_exec()
+    assert "The environment has no instances." in capsys.readouterr().err
+    assert not (stub_ssh / 'concurrency').exists()
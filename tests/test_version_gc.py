@@ -0,0 +1,116 @@
+import argparse
+import datetime
+
+import pytest
+
+from safecast_deploy import git_logger, state, version_gc
+
+NOW = datetime.datetime(2020, 3, 1, tzinfo=datetime.timezone.utc)
+# Every version is dated in January 2020, so none counts as recently
+# updated.
+KEEP_SINCE = NOW - datetime.timedelta(days=30)
+DEPLOYED_SINCE = datetime.datetime(2020, 1, 15, tzinfo=datetime.timezone.utc)
+
+
+def label(branch, build):
+    return f'reporting-{branch}-{build}-{build:040x}'
+
+
+# reporting runs master build 1 in dev and prd. master has builds 1 to 6,
+# of which 6 failed, and feature has builds 7 and 8.
+@pytest.fixture
+def versions(backend):
+    backend.versions['reporting'] = [
+        {
+            'ApplicationName': 'reporting',
+            'VersionLabel': label(branch, build),
+            'Status': 'FAILED' if build == 6 else 'PROCESSED',
+            'DateUpdated': datetime.datetime(2020, 1, build, tzinfo=datetime.timezone.utc),
+        }
+        for branch, build in [('master', n) for n in range(1, 7)] + [('feature', 7), ('feature', 8)]
+    ]
+    for env in ('dev', 'prd'):
+        backend.envs[f'safecastreporting-{env}-001'].version = label('master', 1)
+    return backend
+
+
+# A deploy of master build 1 to prd that replaced build 2.
+def deploy_entry(completed_at):
+    return {
+        'app': 'reporting',
+        'completed_at': completed_at.isoformat(),
+        'env': 'prd',
+        'event': 'same_env',
+        'web': {'new_version': label('master', 1), 'old_version': label('master', 2)},
+    }
+
+
+def collector(keep_per_branch=2):
+    return version_gc.VersionCollector(
+        state.State('reporting'), keep_per_branch=keep_per_branch, keep_since=KEEP_SINCE, deployed_since=DEPLOYED_SINCE)
+
+
+def test_keep_rules(versions, history_repo):
+    git_logger.spool_entries([deploy_entry(datetime.datetime(2020, 1, 20, tzinfo=datetime.timezone.utc))])
+    git_logger.flush()
+    gc = collector()
+    keep, delete = gc.plan()
+    assert keep == {
+        label('master', 1): 'deployed now',
+        label('master', 2): 'recently deployed',
+        label('master', 4): 'newest on their branch',
+        label('master', 5): 'newest on their branch',
+        label('feature', 7): 'newest on their branch',
+        label('feature', 8): 'newest on their branch',
+    }
+    # Failed builds do not take up one of the two slots per branch.
+    assert [version.label for version in delete] == [label('master', 3), label('master', 6)]
+    assert gc.history_problem is None
+    assert gc.run((keep, delete), rate=100)
+    assert sorted(version['VersionLabel'] for version in versions.versions['reporting']) == sorted(keep)
+
+
+def test_deploys_still_in_the_spool_are_kept(versions, history_repo):
+    # The background flush has not pushed this entry yet.
+    git_logger.spool_entries([deploy_entry(datetime.datetime(2020, 2, 20, tzinfo=datetime.timezone.utc))])
+    keep, _ = collector().plan()
+    assert keep[label('master', 2)] == 'recently deployed'
+
+
+def test_old_deploys_are_not_kept(versions, history_repo):
+    git_logger.spool_entries([deploy_entry(datetime.datetime(2020, 1, 10, tzinfo=datetime.timezone.utc))])
+    keep, _ = collector().plan()
+    assert label('master', 2) not in keep
+
+
+def test_keep_zero_keeps_no_versions_per_branch(versions, history_repo):
+    git_logger.spool_entries([deploy_entry(datetime.datetime(2020, 1, 20, tzinfo=datetime.timezone.utc))])
+    keep, delete = collector(keep_per_branch=0).plan()
+    assert set(keep) == {label('master', 1), label('master', 2)}
+    assert len(delete) == 6
+
+
+def gc_args(**kwargs):
+    args = dict(app='reporting', keep=2, keep_days=30, deployed_days=36500, dry_run=False, ignore_history=False,
+                max_parallel=4, rate=100)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def test_refuses_to_delete_without_history(versions, history_repo, capsys):
+    with pytest.raises(SystemExit) as e:
+        version_gc.run_cli(gc_args())
+    assert e.value.code == 1
+    assert "No deployment history found for reporting" in capsys.readouterr().err
+    assert 'delete_application_version' not in versions.calls
+
+
+def test_dry_run_reports_without_history(versions, history_repo, capsys):
+    version_gc.run_cli(gc_args(dry_run=True))
+    assert "may not be protected" in capsys.readouterr().err
+    assert 'delete_application_version' not in versions.calls
+
+
+def test_ignore_history_deletes_anyway(versions, history_repo):
+    version_gc.run_cli(gc_args(ignore_history=True))
+    assert versions.calls['delete_application_version'] == 3
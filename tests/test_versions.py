@@ -0,0 +1,48 @@
+import datetime
+
+import pytest
+
+from safecast_deploy import aws, versions
+
+
+def label(build):
+    return f'reporting-master-{build}-{build:040x}'
+
+
+# reporting has builds 1 to 7 of master, listed three to a page, newest
+# first: builds 7-5, 4-2 and 1.
+@pytest.fixture
+def catalog(backend, monkeypatch):
+    backend.versions['reporting'] = [
+        {
+            'ApplicationName': 'reporting',
+            'VersionLabel': label(build),
+            'Status': 'PROCESSED',
+            'DateUpdated': datetime.datetime(2020, 1, build, tzinfo=datetime.timezone.utc),
+        }
+        for build in range(1, 8)
+    ]
+    monkeypatch.setattr(versions.VersionCatalog, 'PAGE_SIZE', 3)
+    return versions.VersionCatalog(aws.client('elasticbeanstalk'), 'reporting')
+
+
+def test_lookup_reads_later_pages(backend, catalog):
+    assert catalog.lookup(label(1)).build_num == 1
+    assert backend.calls['describe_application_versions'] == 3
+    assert catalog.lookup('reporting-master-9') is None
+    assert backend.calls['describe_application_versions'] == 3
+
+
+def test_lookup_stops_at_the_page_with_the_label(backend, catalog):
+    assert label(6) in catalog
+    assert backend.calls['describe_application_versions'] == 1
+    assert catalog.lookup(label(3)).build_num == 3
+    assert backend.calls['describe_application_versions'] == 2
+    assert catalog.lookup(label(7)).build_num == 7
+    assert backend.calls['describe_application_versions'] == 2
+
+
+def test_all_reads_every_page(backend, catalog):
+    assert [version.build_num for version in catalog.all()] == list(range(1, 8))
+    assert [version.build_num for version in catalog.filter(branch='master', limit=2)] == [6, 7]
+    assert backend.calls['describe_application_versions'] == 3
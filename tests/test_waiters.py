@@ -0,0 +1,91 @@
+import datetime
+
+import pytest
+
+from safecast_deploy import waiters
+
+START = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+# Plays back a scripted environment: health changes and events, each a
+# number of seconds after the environment was created.
+class ScriptedEnvironment:
+    def __init__(self, clock, health, events=()):
+        self.clock = clock
+        self.health = health
+        self.events = events
+        self.health_polls = 0
+        self.origin = clock.monotonic()
+
+    def describe_environment_health(self, EnvironmentName, AttributeNames):
+        self.health_polls += 1
+        now = self.clock.monotonic() - self.origin
+        status, health = [(status, health) for at, status, health in self.health if at <= now][-1]
+        return {'Status': status, 'HealthStatus': health}
+
+    def describe_events(self, StartTime, EnvironmentName=None, ApplicationName=None):
+        now = self.clock.monotonic() - self.origin
+        return {'Events': [
+            {
+                'EventDate': START + datetime.timedelta(seconds=at),
+                'Severity': severity,
+                'EnvironmentName': 'safecastapi-prd-001',
+                'Message': message,
+            }
+            for at, severity, message in self.events
+            if at <= now and START + datetime.timedelta(seconds=at) >= StartTime
+        ]}
+
+
+# When the old fixed schedule, a 70 second sleep followed by a check
+# every 40 seconds, noticed health that returned at `ready`.
+def old_schedule(ready):
+    checked = 70
+    while checked < ready:
+        checked += 40
+    return checked
+
+
+def wait_for_health(clock, ready):
+    env = ScriptedEnvironment(clock, [(0, 'Updating', 'Info'), (ready, 'Ready', 'Ok')])
+    start = clock.monotonic()
+    waiters.HealthWaiter(env, 'safecastapi-prd-001', timeout=600, since=START).wait()
+    return clock.monotonic() - start
+
+
+@pytest.mark.parametrize('ready', [10, 20, 45, 90, 150, 300])
+def test_returns_soon_after_health_is_ok(clock, ready):
+    waited = wait_for_health(clock, ready)
+    assert ready <= waited <= ready + 30
+
+
+def test_returns_sooner_than_the_old_schedule(clock):
+    readies = range(0, 300, 5)
+    waited = [wait_for_health(clock, ready) for ready in readies]
+    # Environments that settle within 20 seconds are no longer held for 70.
+    assert max(waited[:5]) < 30
+    assert sum(waited) < sum(old_schedule(ready) for ready in readies)
+
+
+def test_aborts_on_an_error_event_at_the_next_poll(clock):
+    env = ScriptedEnvironment(clock, [(0, 'Updating', 'Info')], [(12, 'ERROR', 'Instance deployment failed.')])
+    with pytest.raises(SystemExit):
+        waiters.HealthWaiter(env, 'safecastapi-prd-001', timeout=600, since=START).wait()
+    assert clock.monotonic() < 20
+
+
+def test_tailer_cuts_the_wait_short_on_an_error_event(clock):
+    env = ScriptedEnvironment(clock, [(0, 'Updating', 'Info')], [(100, 'ERROR', 'Instance deployment failed.')])
+    with waiters.EventTailer(env, 'api', since=START, max_interval=5) as tailer:
+        with pytest.raises(SystemExit):
+            waiters.HealthWaiter(env, 'safecastapi-prd-001', timeout=600, since=START, tailer=tailer).wait()
+        aborted = clock.monotonic()
+    # Health is next polled at 125.9 seconds, but the tailer sees the
+    # error within its 5 second interval.
+    assert 100 <= aborted <= 105
+    assert env.health_polls == 7
+
+
+def test_waiters_must_define_their_check(clock):
+    with pytest.raises(TypeError):
+        waiters.Waiter(ScriptedEnvironment(clock, []), 'safecastapi-prd-001', timeout=600, since=START)